@@ -4,12 +4,21 @@ from flask import Flask
 def create_app():
     app = Flask(__name__)
 
+    import app.compression as compression
+    import app.metrics as metrics
+
+    metrics.init_app(app)
+    # Registered after the metrics hooks so that they run first and record the compressed size
+    compression.init_app(app)
+
     from app.routes.connection_manager import connections_bp
     from app.routes.table_manager import table_manager_bp
     from app.routes.data_manager import data_bp
+    from app.routes.batch_manager import batch_bp
 
     app.register_blueprint(connections_bp)
     app.register_blueprint(table_manager_bp)
     app.register_blueprint(data_bp)
+    app.register_blueprint(batch_bp)
 
     return app
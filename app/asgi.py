@@ -0,0 +1,331 @@
+import json
+import uuid
+from contextlib import asynccontextmanager
+
+import psycopg
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.http import quote_etag
+
+from app import create_app
+import app.change_feed as change_feed
+import app.compression as compression
+import app.params as params
+import app.parallel_scan as parallel_scan
+from app.async_pool import async_pool, share_limits
+from app.metrics import metrics
+from app.pool import pool
+from app.routes.data_manager import EVENT_STREAM_HEADERS
+from app.result_cache import result_cache
+from app.schema_cache import schema_cache
+from app.serializers import serializer
+from app.table_versions import table_versions
+import app.selects as selects
+import app.streaming as streaming
+
+# Error message prefixes of the endpoints whose Flask handlers use them
+ERROR_PREFIXES = {"select_table": ("Database error: ", "Error: ")}
+
+
+async def _table(cursor, table_name):
+    table = await schema_cache.table_async(cursor, table_name)
+    return table or {"columns": {}, "primary_key": [], "not_null": []}
+
+
+async def stream_select(select):
+    """
+    This is a helper function that runs a select on a named (server-side) cursor of the async
+    pool and streams the rows batch by batch, like `streaming.stream_query`.
+
+    :param select: The `select` parameter is a validated `Select` with `stream` set.
+    :return: Returns a streaming response.
+    """
+    fetch_size = streaming.parse_fetch_size(select.fetch_size)
+    conn = await async_pool.getconn(*select.credentials)
+    try:
+        if select.where is not None:
+            async with conn.cursor() as cursor:
+                select.compile((await _table(cursor, select.table_name))["columns"])
+        cursor = conn.cursor(name=f"oyda_stream_{uuid.uuid4().hex}")
+        cursor.itersize = fetch_size
+        await cursor.execute(*select.statement())
+        # Fetching the first batch up front surfaces query errors before the response starts.
+        first_batch = await cursor.fetchmany(fetch_size)
+    except BaseException:
+        await async_pool.putconn(conn, discard=conn.closed)
+        raise
+
+    columns = [desc[0] for desc in cursor.description]
+
+    async def body():
+        try:
+            if select.stream == "json":
+                yield b"["
+            batch, first = first_batch, True
+            while batch:
+                yield streaming.encode_batch(serializer, select.stream, columns, batch, first)
+                first = False
+                batch = await cursor.fetchmany(fetch_size)
+            if select.stream == "json":
+                yield b"]"
+        finally:
+            try:
+                await cursor.close()
+            except Exception:
+                pass
+            await async_pool.putconn(conn, discard=conn.closed)
+
+    return StreamingResponse(body(), media_type=streaming.STREAM_FORMATS[select.stream])
+
+
+async def iterate_in_threads(body):
+    """
+    This is a helper function that iterates a blocking response body on the thread pool, and
+    closes it when the response ends or the client goes away.
+    """
+    chunks = iter(body)
+    try:
+        while True:
+            chunk = await run_in_threadpool(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        await run_in_threadpool(body.close)
+
+
+async def run_select(select):
+    """
+    This is a helper function that runs a select on the async pool, the counterpart of
+    `selects.respond`. Results share the result cache with the Flask endpoints, so writes served
+    by either app invalidate them.
+
+    :param select: The `select` parameter is a validated `Select`.
+    :return: Returns a Starlette response.
+    """
+    if select.stream:
+        if select.parallel:
+            body = await run_in_threadpool(parallel_scan.scan_select, select)
+            if body is not None:
+                return StreamingResponse(
+                    iterate_in_threads(body), media_type=streaming.STREAM_FORMATS[select.stream]
+                )
+        return await stream_select(select)
+
+    if select.use_cache:
+        cached = result_cache.lookup(
+            select.credentials,
+            select.table_name,
+            select.query,
+            select.cache_params,
+            connections=async_pool,
+        )
+        if cached is not None:
+            return Response(cached[0], media_type=cached[1])
+    generation = result_cache.generation(select.credentials, select.table_name)
+
+    async with async_pool.connection(*select.credentials) as conn:
+        async with conn.cursor() as cursor:
+            if select.where is not None:
+                select.compile((await _table(cursor, select.table_name))["columns"])
+
+            if select.limit is not None:
+                await cursor.execute(*select.page_query(await _table(cursor, select.table_name)))
+            else:
+                await cursor.execute(*select.statement())
+
+            columns = [desc[0] for desc in cursor.description]
+            rows = await cursor.fetchall()
+
+    # Encoding a large result takes long enough to stall every other request on the event loop.
+    body = await run_in_threadpool(select.encode, columns, rows)
+    if select.use_cache:
+        result_cache.store(
+            select.credentials,
+            select.table_name,
+            select.query,
+            select.cache_params,
+            generation,
+            body,
+            select.mimetype,
+        )
+    return Response(body, media_type=select.mimetype)
+
+
+async def compress(request, response, endpoint):
+    """
+    This is a helper function that compresses a response of the native endpoints like the Flask
+    app's `compression` hook does.
+
+    :return: Returns the response, with its body compressed if the client accepts it.
+    """
+    if not compression.compressible(response.status_code, response.headers):
+        return response
+    if not compression.enabled(endpoint):
+        return response
+    response.headers.add_vary_header("Accept-Encoding")
+    encoding = compression.negotiate(request.headers.get("accept-encoding"), endpoint)
+    if encoding is None:
+        return response
+
+    level = compression.level(encoding, endpoint)
+    if isinstance(response, StreamingResponse):
+        response.body_iterator = compression.compress_stream_async(
+            encoding, level, response.body_iterator
+        )
+    else:
+        if len(response.body) < compression.min_size(endpoint):
+            return response
+        response.body = await run_in_threadpool(
+            compression.compress, encoding, level, response.body
+        )
+        response.headers["content-length"] = str(len(response.body))
+    response.headers["content-encoding"] = encoding
+    return response
+
+
+async def respond(select):
+    """
+    This is a helper function that answers a select like `selects.respond`, with 304 Not Modified
+    when a conditional select's table has not changed.
+
+    :param select: The `select` parameter is a validated `Select`.
+    :return: Returns a Starlette response.
+    """
+    if select.conditional:
+        generation = result_cache.generation(select.credentials, select.table_name)
+        async with async_pool.connection(*select.credentials) as conn:
+            async with conn.cursor() as cursor:
+                version = await table_versions.version_async(cursor, select.table_name)
+        select.set_version(version, generation)
+
+    if select.not_modified:
+        response = Response(status_code=304)
+    else:
+        response = await run_select(select)
+    if select.etag is not None:
+        response.headers["etag"] = quote_etag(select.etag, weak=True)
+    return response
+
+
+def select_endpoint(endpoint):
+    """
+    This is a helper function that builds the async handler of a select endpoint.
+
+    :param endpoint: The `endpoint` parameter is one of the names in `selects.ENDPOINTS`.
+    :return: Returns a Starlette request handler.
+    """
+    database_error, error = ERROR_PREFIXES.get(endpoint, ("", ""))
+
+    async def handle(request):
+        body = await request.body()
+        if not body:
+            return JSONResponse({"error": "No data provided"}, status_code=400)
+        try:
+            data = json.loads(body)
+            select = selects.Select(
+                endpoint, data, request.headers.get("accept"), request.headers.get("if-none-match")
+            )
+            return await respond(select)
+
+        except selects.REQUEST_ERRORS as e:
+            return JSONResponse({"error": f"{e}"}, status_code=400)
+        except psycopg.DatabaseError as e:
+            return JSONResponse({"error": f"{database_error}{e}"}, status_code=500)
+        except Exception as e:
+            return JSONResponse({"error": f"{error}{e}"}, status_code=500)
+
+    return instrument(endpoint, handle)
+
+
+def instrument(endpoint, handle):
+    """
+    This is a helper function that records the metrics of a native endpoint and compresses its
+    responses.
+
+    :param endpoint: The `endpoint` parameter is the name of the endpoint.
+    :param handle: The `handle` parameter is the async function that answers a request.
+    :return: Returns a Starlette request handler.
+    """
+
+    async def handler(request):
+        timer, token = metrics.start(endpoint)
+        try:
+            response = await compress(request, await handle(request), endpoint)
+        finally:
+            metrics.stop(token)
+        if timer is not None:
+            if isinstance(response, StreamingResponse):
+                response.body_iterator = timer.wrap_async(response.body_iterator)
+            else:
+                timer.finish(len(response.body))
+        return response
+
+    return handler
+
+
+async def subscribe(request):
+    """
+    Answers `/api/subscribe` like the Flask handler, but waits for events on the event loop, so
+    that open subscriptions don't hold worker threads. Checking the table and connecting the
+    database's listener still run on the thread pool.
+    """
+    body = await request.body()
+    if not body:
+        return JSONResponse({"error": "No data provided"}, status_code=400)
+    try:
+        data = json.loads(body)
+        credentials, table_name, operations = change_feed.parse(data)
+        table = await run_in_threadpool(change_feed.prepare, credentials, table_name)
+        subscription = change_feed.AsyncSubscription(credentials, table, operations)
+        await run_in_threadpool(change_feed.change_feed.subscribe, credentials, subscription)
+        return StreamingResponse(
+            subscription.events(),
+            media_type="text/event-stream",
+            headers=EVENT_STREAM_HEADERS,
+        )
+
+    except (params.ParameterError, change_feed.ChangeFeedError) as e:
+        return JSONResponse({"error": f"{e}"}, status_code=400)
+    except Exception as e:
+        return JSONResponse({"error": f"{e}"}, status_code=500)
+
+
+def input_terminated(wsgi_app):
+    """
+    Marks the adapter's request bodies as terminated. The adapter's input ends with the body,
+    so Flask may read chunked uploads such as `/api/import_table` bodies without a Content-Length.
+    """
+
+    def app(environ, start_response):
+        environ["wsgi.input_terminated"] = True
+        return wsgi_app(environ, start_response)
+
+    return app
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await async_pool.close_all()
+
+
+def create_asgi_app():
+    """
+    Creates the ASGI app. The select endpoints run natively on the async pool, so one process can
+    keep many slow reads in flight, and subscriptions wait for their events on the event loop;
+    every other endpoint is served by the Flask app through a WSGI adapter, which runs it on a
+    thread pool with the sync connection pool. The two pools split the configured connection
+    limits.
+    """
+    share_limits(pool)
+    routes = [
+        Route(f"/api/{endpoint}", select_endpoint(endpoint), methods=["POST"])
+        for endpoint in selects.ENDPOINTS
+    ]
+    routes.append(Route("/api/subscribe", instrument("subscribe", subscribe), methods=["POST"]))
+    routes.append(Mount("/", WSGIMiddleware(input_terminated(create_app()))))
+    return Starlette(routes=routes, lifespan=lifespan)
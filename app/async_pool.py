@@ -0,0 +1,241 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+import psycopg
+from psycopg import pq
+
+import app.config as config
+import app.metrics as metrics
+from app.pool import WAIT, ConnectionPool, _digest
+
+
+def _timed(phase, method):
+    async def timed(self, *args, **kwargs):
+        with metrics.phase(phase):
+            return await method(self, *args, **kwargs)
+
+    timed.__name__ = method.__name__
+    return timed
+
+
+class TimedAsyncCursor(psycopg.AsyncCursor):
+    """
+    The async counterpart of `metrics.TimedCursor`.
+    """
+
+    async def execute(self, query, params=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            metrics.executed(self, query, params, time.perf_counter() - started)
+
+    executemany = _timed("execute", psycopg.AsyncCursor.executemany)
+    fetchone = _timed("fetch", psycopg.AsyncCursor.fetchone)
+    fetchmany = _timed("fetch", psycopg.AsyncCursor.fetchmany)
+    fetchall = _timed("fetch", psycopg.AsyncCursor.fetchall)
+
+
+class TimedAsyncServerCursor(psycopg.AsyncServerCursor):
+    """
+    The named-cursor counterpart of `TimedAsyncCursor`.
+    """
+
+    async def execute(self, query, params=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            metrics.executed(self, query, params, time.perf_counter() - started)
+
+    fetchone = _timed("fetch", psycopg.AsyncServerCursor.fetchone)
+    fetchmany = _timed("fetch", psycopg.AsyncServerCursor.fetchmany)
+    fetchall = _timed("fetch", psycopg.AsyncServerCursor.fetchall)
+
+
+class PooledAsyncConnection(psycopg.AsyncConnection):
+    """
+    A psycopg 3 async connection that carries the bookkeeping the pool needs to reuse it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = TimedAsyncCursor
+        self.server_cursor_factory = TimedAsyncServerCursor
+        self.pool_key = None
+        self.session = None
+        self.password_digest = None
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+
+async def _close_quietly(conn):
+    try:
+        await conn.close()
+    except Exception:
+        pass
+
+
+class AsyncConnectionPool(ConnectionPool):
+    """
+    The asyncio counterpart of `ConnectionPool`, used by the ASGI app. It shares the sync pool's
+    per-key sizing, eviction, credential and statistics bookkeeping; only waiting for capacity,
+    opening, pinging and closing connections are awaited instead of blocking a thread.
+
+    Connections prepare statements themselves: psycopg 3 prepares a query server-side once it has
+    run `PREPARE_THRESHOLD` times on a connection and keeps at most `PREPARED_MAX` of them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._available = asyncio.Condition()
+
+    @asynccontextmanager
+    async def connection(self, host, port, oydaBase, user, password):
+        """
+        Borrows a connection for the duration of an `async with` block, like `ConnectionPool.connection`.
+
+        :return: Yields a psycopg 3 async connection.
+        """
+        conn = await self.getconn(host, port, oydaBase, user, password)
+        try:
+            yield conn
+        except BaseException:
+            await self.putconn(conn, discard=conn.closed)
+            raise
+        else:
+            await self.putconn(conn)
+
+    async def getconn(self, host, port, oydaBase, user, password):
+        """
+        Checks out a connection for the given key, reusing an idle one when possible. Waits while
+        the key or the whole pool is at capacity and raises `PoolExhausted` on timeout.
+
+        :return: Returns an async connection that must be handed back with `putconn`.
+        """
+        key = (host, int(port), oydaBase, user)
+        digest = _digest(password)
+        deadline = time.monotonic() + self.checkout_timeout
+        with metrics.phase("checkout"):
+            conn = await self._getconn(key, digest, deadline, host, port, oydaBase, user, password)
+        metrics.set_database(oydaBase)
+        return conn
+
+    async def _getconn(self, key, digest, deadline, host, port, oydaBase, user, password):
+        waited_since = None
+        while True:
+            async with self._available:
+                while True:
+                    to_close = []
+                    with self._cond:
+                        now = time.monotonic()
+                        conn = self._try_reserve(key, digest, now, waited_since, to_close)
+                        remaining = self._remaining(deadline, now) if conn is WAIT else None
+                    for stale in to_close:
+                        await _close_quietly(stale)
+                    if conn is not WAIT:
+                        break
+
+                    if waited_since is None:
+                        waited_since = now
+                    try:
+                        await asyncio.wait_for(self._available.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+
+            if conn is None:
+                return await self._open_async(key, digest, host, port, oydaBase, user, password)
+            if await self._healthy_async(conn):
+                return conn
+            await self.putconn(conn, discard=True)
+            with self._cond:
+                self._stats["health_check_failures"] += 1
+
+    async def putconn(self, conn, discard=False):
+        """
+        Returns a connection to the pool, rolling back any open transaction first.
+
+        :param conn: The `conn` parameter is a connection obtained from `getconn`.
+        :param discard: The `discard` parameter closes the connection instead of keeping it idle.
+        """
+        if not discard and not conn.closed:
+            try:
+                if conn.info.transaction_status != pq.TransactionStatus.IDLE:
+                    await conn.rollback()
+            except psycopg.Error:
+                discard = True
+
+        if self._release(conn, discard or conn.closed):
+            await _close_quietly(conn)
+        async with self._available:
+            self._available.notify_all()
+
+    async def close_all(self):
+        """
+        Closes every idle connection. Connections that are checked out are closed when returned.
+        """
+        with self._cond:
+            to_close = []
+            for state in self._keys.values():
+                to_close.extend(state.idle)
+                state.idle.clear()
+            self._total -= len(to_close)
+        for conn in to_close:
+            await _close_quietly(conn)
+
+    async def _open_async(self, key, digest, host, port, oydaBase, user, password):
+        try:
+            conn = await PooledAsyncConnection.connect(
+                dbname=oydaBase,
+                user=user,
+                password=password,
+                host=host,
+                port=port,
+            )
+        except BaseException:
+            self._open_failed(key)
+            async with self._available:
+                self._available.notify_all()
+            raise
+
+        conn.prepare_threshold = config.PREPARE_THRESHOLD if config.PREPARE_THRESHOLD > 0 else None
+        conn.prepared_max = config.PREPARED_MAX
+        for stale in self._opened(key, digest, conn):
+            await _close_quietly(stale)
+        return conn
+
+    async def _healthy_async(self, conn):
+        if conn.closed:
+            return False
+        if time.monotonic() - conn.last_used < self.health_check_after:
+            return True
+        try:
+            await conn.execute("SELECT 1")
+            await conn.rollback()
+            return True
+        except psycopg.Error:
+            return False
+
+
+def _split(limit, share):
+    """
+    :return: Returns the (async, sync) parts of a connection limit, each at least one.
+    """
+    shared = min(max(1, round(limit * share)), max(1, limit - 1))
+    return shared, max(1, limit - shared)
+
+
+def share_limits(sync_pool, share=config.POOL_ASYNC_SHARE):
+    """
+    Splits the configured per-key and overall connection limits between the async pool and the
+    sync pool, so that a process serving requests through both stays within them.
+
+    :param sync_pool: The `sync_pool` parameter is the `ConnectionPool` of the Flask endpoints.
+    :param share: The `share` parameter is the fraction of each limit the async pool gets.
+    """
+    async_pool.max_size, sync_pool.max_size = _split(config.POOL_MAX_SIZE, share)
+    async_pool.max_total, sync_pool.max_total = _split(config.POOL_MAX_TOTAL, share)
+
+
+async_pool = AsyncConnectionPool()
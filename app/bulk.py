@@ -0,0 +1,237 @@
+import csv
+import io
+import itertools
+import json
+
+from psycopg2.extras import execute_values  # type: ignore
+
+import app.config as config
+import app.utilities as utils
+
+PARAMS_HEADER = "X-Oyda-Params"
+
+BODY_FORMATS = {
+    "application/json": "json",
+    "application/x-ndjson": "ndjson",
+    "text/csv": "csv",
+}
+
+
+class BulkError(ValueError):
+    """
+    Raised when the rows of a bulk request are malformed.
+    """
+
+
+def body_format(mimetype):
+    """
+    This is a helper function that maps the request content type to a bulk body format. Requests
+    without a recognised content type are treated as JSON, like every other endpoint.
+
+    :param mimetype: The `mimetype` parameter is the mimetype of the request.
+    :return: Returns "json", "ndjson" or "csv".
+    """
+    return BODY_FORMATS.get(mimetype, "json")
+
+
+def parse_batch_size(batch_size):
+    """
+    This is a helper function that validates the `batch_size` request parameter.
+
+    :param batch_size: The `batch_size` parameter is the requested number of rows per statement.
+    :return: Returns the batch size as an integer, defaulting to `BULK_BATCH_SIZE`.
+    :raises BulkError: When the batch size is not a positive integer.
+    """
+    if batch_size is None:
+        return config.BULK_BATCH_SIZE
+    if isinstance(batch_size, bool) or not isinstance(batch_size, int) or batch_size <= 0:
+        raise BulkError("batch_size must be a positive integer")
+    return batch_size
+
+
+def iter_ndjson(stream):
+    """
+    This is a helper function that lazily decodes one JSON object per line of a stream.
+
+    :param stream: The `stream` parameter is a binary file-like object, e.g. the request stream.
+    :return: Yields the decoded objects, skipping blank lines.
+    """
+    for number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            raise BulkError(f"Line {number} is not valid JSON")
+
+
+def insert_values(cursor, table_name, rows, columns=None, batch_size=None):
+    """
+    This is a helper function that inserts rows with multi-row parameterized INSERT statements, at
+    most `batch_size` rows per statement. Rows are consumed lazily, so `rows` may be a generator.
+
+    :param cursor: The `cursor` parameter is a database object to interact with a database.
+    :param table_name: The `table_name` parameter is a string that represents the name of the table.
+    :param rows: The `rows` parameter is an iterable of dictionaries mapping column names to values.
+    :param columns: The `columns` parameter fixes the column list; it defaults to the keys of the first row.
+    :param batch_size: The `batch_size` parameter is the number of rows per INSERT statement.
+    :return: Returns the number of rows inserted.
+    :raises BulkError: When a row lacks one of the columns or has others.
+    """
+    batch_size = parse_batch_size(batch_size)
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return 0
+    if not isinstance(first, dict):
+        raise BulkError("Rows must be JSON objects")
+    columns = list(columns or first.keys())
+    column_set = set(columns)
+    count = 0
+
+    def values():
+        nonlocal count
+        for row in itertools.chain([first], rows):
+            if not isinstance(row, dict):
+                raise BulkError(f"Row {count + 1} is not a JSON object")
+            try:
+                values = tuple(row[column] for column in columns)
+            except KeyError as e:
+                raise BulkError(f"Row {count + 1} is missing column {e.args[0]}")
+            if len(row) != len(columns):
+                # Rows are streamed, so columns first seen in a later row can't be added.
+                extra = next(column for column in row if column not in column_set)
+                raise BulkError(f"Row {count + 1} has column {extra}, which the first row lacks")
+            yield values
+            count += 1
+
+    column_list = ", ".join(utils.quote_ident(column) for column in columns)
+    execute_values(
+        cursor,
+        f"INSERT INTO {table_name} ({column_list}) VALUES %s",
+        values(),
+        page_size=batch_size,
+    )
+    return count
+
+
+def copy_csv(cursor, table_name, stream):
+    """
+    This is a helper function that loads a CSV stream with `COPY ... FROM STDIN`. The first line must
+    be a header naming the target columns; the rest of the stream is handed to Postgres as it is
+    read, without being parsed in Python.
+
+    :param cursor: The `cursor` parameter is a database object to interact with a database.
+    :param table_name: The `table_name` parameter is a string that represents the name of the table.
+    :param stream: The `stream` parameter is a binary file-like object, e.g. the request stream.
+    :return: Returns the number of rows copied.
+    """
+    header = stream.readline().decode("utf-8-sig")
+    columns = next(csv.reader(io.StringIO(header)), None)
+    if not columns:
+        raise BulkError("CSV body must start with a header line")
+
+    column_list = ", ".join(utils.quote_ident(column) for column in columns)
+    cursor.copy_expert(
+        f"COPY {table_name} ({column_list}) FROM STDIN WITH (FORMAT csv)", stream
+    )
+    return cursor.rowcount
+
+
+def _batches(items, batch_size):
+    for start in range(0, len(items), batch_size):
+        yield items[start : start + batch_size]
+
+
+def _column_type(column_types, table_name, column):
+    if not column_types:
+        raise BulkError(f"Table {table_name} does not exist")
+    if column not in column_types:
+        raise BulkError(f"Table {table_name} has no column {column}")
+    return column_types[column]
+
+
+def update_by_key(cursor, table_name, key, updates, batch_size=None):
+    """
+    This is a helper function that applies many single-row updates with
+    `UPDATE ... FROM (VALUES ...)` statements. Updates of the same key are merged first, later ones
+    taking precedence, since a statement can update a row only once. Updates that set the same
+    columns are then grouped, and each group is sent in statements of at most `batch_size` rows.
+    The values are cast to the column types so that, e.g., timestamps and UUIDs can be passed as
+    strings.
+
+    :param cursor: The `cursor` parameter is a database object to interact with a database.
+    :param table_name: The `table_name` parameter is a string that represents the name of the table.
+    :param key: The `key` parameter is the name of the column that identifies the rows.
+    :param updates: The `updates` parameter is a list of [key value, {column: new value}] pairs.
+    :param batch_size: The `batch_size` parameter is the number of rows per UPDATE statement.
+    :return: Returns a (rows updated, statements executed) tuple.
+    """
+    batch_size = parse_batch_size(batch_size)
+    merged = {}
+    for number, update in enumerate(updates, start=1):
+        if not isinstance(update, (list, tuple)) or len(update) != 2:
+            raise BulkError(f"Update {number} must be a [key, values] pair")
+        key_value, values = update
+        if not isinstance(values, dict) or not values:
+            raise BulkError(f"Update {number} must set at least one column")
+        if isinstance(key_value, (dict, list)):
+            raise BulkError(f"Update {number} must have a scalar key")
+        merged.setdefault(key_value, {}).update(values)
+
+    groups = {}
+    for key_value, values in merged.items():
+        columns = tuple(sorted(values))
+        groups.setdefault(columns, []).append(
+            (key_value, *(values[column] for column in columns))
+        )
+
+    column_types = utils.get_column_types(cursor, table_name)
+    key_type = _column_type(column_types, table_name, key)
+    count = 0
+    statements = 0
+    for columns, rows in groups.items():
+        types = [_column_type(column_types, table_name, column) for column in columns]
+        aliases = ", ".join(
+            [utils.quote_ident("_oyda_key")] + [utils.quote_ident(column) for column in columns]
+        )
+        assignments = ", ".join(
+            f"{utils.quote_ident(column)} = v.{utils.quote_ident(column)}" for column in columns
+        )
+        template = "(" + ", ".join(f"%s::{t}" for t in [key_type, *types]) + ")"
+        query = (
+            f"UPDATE {table_name} AS t SET {assignments} "
+            f"FROM (VALUES %s) AS v ({aliases}) "
+            f'WHERE t.{utils.quote_ident(key)} = v."_oyda_key"'
+        )
+        for batch in _batches(rows, batch_size):
+            execute_values(cursor, query, batch, template=template, page_size=len(batch))
+            count += cursor.rowcount
+            statements += 1
+    return count, statements
+
+
+def delete_by_key(cursor, table_name, key, keys, batch_size=None):
+    """
+    This is a helper function that deletes many rows by key with `DELETE ... WHERE key = ANY(%s)`
+    statements of at most `batch_size` keys each.
+
+    :param cursor: The `cursor` parameter is a database object to interact with a database.
+    :param table_name: The `table_name` parameter is a string that represents the name of the table.
+    :param key: The `key` parameter is the name of the column that identifies the rows.
+    :param keys: The `keys` parameter is the list of key values to delete.
+    :param batch_size: The `batch_size` parameter is the number of keys per DELETE statement.
+    :return: Returns a (rows deleted, statements executed) tuple.
+    """
+    batch_size = parse_batch_size(batch_size)
+    column_types = utils.get_column_types(cursor, table_name)
+    key_type = _column_type(column_types, table_name, key)
+    query = f"DELETE FROM {table_name} WHERE {utils.quote_ident(key)} = ANY(%s::{key_type}[])"
+
+    count = 0
+    statements = 0
+    for batch in _batches(list(keys), batch_size):
+        cursor.execute(query, (batch,))
+        count += cursor.rowcount
+        statements += 1
+    return count, statements
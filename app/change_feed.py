@@ -0,0 +1,585 @@
+import asyncio
+import itertools
+import json
+import queue
+import select
+import threading
+
+import psycopg2  # type: ignore
+from psycopg2 import errors, extensions  # type: ignore
+
+import app.config as config
+import app.params as params
+import app.utilities as utils
+from app.pool import PoolExhausted, pool
+from app.schema_cache import schema_cache
+
+# The change trigger of a table notifies the channel named by this prefix and the table's oid
+CHANNEL_PREFIX = "oyda_changes_"
+TRIGGER_NAME = "oyda_notify_change"
+OPERATIONS = ("insert", "update", "delete")
+
+# The first key of the advisory locks that listeners hold, shared, on the tables they listen to;
+# a trigger is only dropped when no listener of any server holds its table's lock
+LOCK_NAMESPACE = 0x6F796461
+
+# Sends only the operation and the primary key, which the trigger is created with as arguments,
+# so that listeners of the channel learn nothing the table's readers may not; subscribers read
+# the changed row with their own credentials
+NOTIFY_FUNCTION = f"""
+    CREATE FUNCTION oyda_notify_change() RETURNS trigger LANGUAGE plpgsql AS $$
+    DECLARE
+        changed JSONB := to_jsonb(CASE WHEN TG_OP = 'DELETE' THEN OLD ELSE NEW END);
+    BEGIN
+        PERFORM pg_notify(
+            '{CHANNEL_PREFIX}' || TG_RELID,
+            json_build_object(
+                'op', lower(TG_OP),
+                'key', (SELECT jsonb_object_agg(k, changed -> k) FROM unnest(TG_ARGV) AS k)
+            )::text
+        );
+        RETURN NULL;
+    END
+    $$;
+"""
+
+TABLE_QUERY = """
+    SELECT n.nspname, c.relname, c.oid, has_table_privilege(c.oid, 'SELECT')
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.oid = to_regclass(%s) AND c.relkind IN ('r', 'p')
+"""
+
+TRIGGER_QUERY = "SELECT EXISTS (SELECT 1 FROM pg_trigger WHERE tgrelid = %s AND tgname = %s)"
+
+
+class ChangeFeedError(ValueError):
+    """
+    Raised when a table can't be subscribed to.
+    """
+
+
+def parse(data):
+    """
+    This is a helper function that validates a subscription request.
+
+    :param data: The `data` parameter is the parsed request body.
+    :return: Returns the (credentials, table_name, operations) of the subscription; `operations`
+    is None when the client wants every kind of change.
+    :raises params.ParameterError: When a parameter is missing or invalid.
+    """
+    credentials = params.credentials(data)
+    error = params.missing(data, *params.CONNECTION_PARAMETERS, "table_name")
+    if error:
+        raise params.ParameterError(error)
+    operations = data.get("events")
+    if operations is not None:
+        if (
+            not isinstance(operations, list)
+            or not operations
+            or any(operation not in OPERATIONS for operation in operations)
+        ):
+            raise params.ParameterError(f"events must be a list of {', '.join(OPERATIONS)}")
+    return credentials, data["table_name"], operations
+
+
+def prepare(credentials, table_name):
+    """
+    This is a helper function that checks that the caller may read a table and that its rows
+    can be identified by a primary key.
+
+    :param credentials: The `credentials` parameter is a (host, port, oydaBase, user, password) tuple.
+    :param table_name: The `table_name` parameter is a string that represents the name of the table.
+    :return: Returns a dictionary with the table's `name` in "schema.table" form, as the change
+    events name it, its quoted `relation` and its `oid`.
+    :raises ChangeFeedError: When the table does not exist, the caller can't read it or it has no
+    primary key.
+    """
+    with pool.connection(*credentials) as conn:
+        cursor = conn.cursor()
+        cursor.execute(TABLE_QUERY, (table_name,))
+        row = cursor.fetchone()
+        if row is None:
+            raise ChangeFeedError(f"Table {table_name} does not exist")
+        schema, name, oid, readable = row
+        if not readable:
+            raise ChangeFeedError(f"Permission denied for table {table_name}")
+        if not schema_cache.primary_key(cursor, f"{schema}.{name}"):
+            raise ChangeFeedError(f"Table {table_name} has no primary key")
+        cursor.close()
+    return {
+        "name": f"{schema}.{name}",
+        "relation": f"{utils.quote_ident(schema)}.{utils.quote_ident(name)}",
+        "oid": oid,
+    }
+
+
+def install(subscription):
+    """
+    This is a helper function that installs the trigger that publishes a table's row changes,
+    unless it is installed already. It runs once the subscription's listener holds the table's
+    lock, so that the trigger can't be dropped before the subscription listens.
+
+    :param subscription: The `subscription` parameter is the `Subscription` of the table.
+    :return: Returns True when this call installed the trigger.
+    :raises ChangeFeedError: When the trigger is missing and the caller may not create it.
+    """
+    with pool.connection(*subscription.credentials) as conn:
+        cursor = conn.cursor()
+        cursor.execute(TRIGGER_QUERY, (subscription.oid, TRIGGER_NAME))
+        if cursor.fetchone()[0]:
+            cursor.close()
+            return False
+        try:
+            cursor.execute("SELECT to_regprocedure('oyda_notify_change()') IS NULL")
+            if cursor.fetchone()[0]:
+                cursor.execute(NOTIFY_FUNCTION)
+            key = schema_cache.primary_key(cursor, subscription.table)
+            cursor.execute(
+                f"CREATE TRIGGER {TRIGGER_NAME} AFTER INSERT OR UPDATE OR DELETE "
+                f"ON {subscription.relation} "
+                f"FOR EACH ROW EXECUTE PROCEDURE oyda_notify_change({', '.join(['%s'] * len(key))})",
+                key,
+            )
+            conn.commit()
+        except (errors.DuplicateObject, errors.DuplicateFunction, errors.UniqueViolation):
+            # A concurrent subscription installed them first.
+            conn.rollback()
+            return False
+        except errors.InsufficientPrivilege:
+            conn.rollback()
+            raise ChangeFeedError(
+                f"Permission denied to publish the changes of table {subscription.table}; "
+                "only its owner can start its change feed"
+            )
+        cursor.close()
+    return True
+
+
+def drop(subscription, credentials):
+    """
+    This is a helper function that drops the trigger of a table whose last subscription is gone,
+    unless a listener, possibly of another server, still holds the table's lock. The trigger
+    stays when the credentials may not drop it.
+
+    :param subscription: The `subscription` parameter is the last `Subscription` of the table.
+    :param credentials: The `credentials` parameter is the credentials tuple of the subscriber
+    that installed the trigger, or of the last subscriber when it was installed elsewhere.
+    """
+    try:
+        with pool.connection(*credentials) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT pg_try_advisory_xact_lock(%s, %s::oid::integer)",
+                (LOCK_NAMESPACE, subscription.oid),
+            )
+            if cursor.fetchone()[0]:
+                cursor.execute(f"DROP TRIGGER IF EXISTS {TRIGGER_NAME} ON {subscription.relation}")
+                conn.commit()
+            cursor.close()
+    except (psycopg2.Error, PoolExhausted):
+        pass
+
+
+def read_row(credentials, relation, key):
+    """
+    This is a helper function that reads a changed row by its primary key.
+
+    :param credentials: The `credentials` parameter is the subscriber's credentials tuple.
+    :param relation: The `relation` parameter is the quoted name of the table.
+    :param key: The `key` parameter is a dictionary of the row's primary key values.
+    :return: Returns the row as JSON text, or None when the subscriber can't see it (any more).
+    """
+    condition = " AND ".join(
+        f"oyda_row.{utils.quote_ident(column)} = oyda_key.{utils.quote_ident(column)}" for column in key
+    )
+    with pool.connection(*credentials) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"SELECT to_jsonb(oyda_row)::text FROM {relation} AS oyda_row, "
+            f"jsonb_populate_record(NULL::{relation}, %s::jsonb) AS oyda_key "
+            f"WHERE {condition or 'false'}",
+            (json.dumps(key),),
+        )
+        row = cursor.fetchone()
+        cursor.close()
+        conn.commit()
+    return row[0] if row else None
+
+
+def format_event(event_id, event, data):
+    """
+    :return: Returns a Server-Sent Event as bytes.
+    """
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {data}\n\n".encode("utf-8")
+
+
+KEEPALIVE = b": keepalive\n\n"
+
+
+class Subscription:
+    """
+    A subscriber's bounded queue of changes, read by a worker thread.
+
+    The listener never waits for a subscriber: when the queue is full the subscription is marked
+    as overflowed and gets no further events, and its stream ends with an `overflow` event, after
+    which the client should re-read the table and subscribe again.
+    """
+
+    def __init__(self, credentials, table, operations=None, size=config.SUBSCRIBE_QUEUE_SIZE):
+        self.credentials = credentials
+        self.table = table["name"]
+        self.relation = table["relation"]
+        self.oid = table["oid"]
+        self.operations = set(operations) if operations else None
+        self.queue = queue.Queue(maxsize=size)
+        self.overflowed = False
+        self.error = None
+
+    def wants(self, operation):
+        return self.operations is None or operation in self.operations
+
+    def offer(self, change):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(change)
+        except queue.Full:
+            self.overflowed = True
+
+    def close(self, error):
+        self.error = error
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def encode(self, change):
+        """
+        Encodes a change as an event whose `row` is the changed row as the subscriber reads it
+        now; it is null for deletes and for rows the subscriber can't see (any more).
+        """
+        event_id, operation, key = change
+        row = read_row(self.credentials, self.relation, key) if operation != "delete" else None
+        data = (
+            f'{{"table": {json.dumps(self.table)}, "op": {json.dumps(operation)}, '
+            f'"key": {json.dumps(key)}, "row": {row or "null"}}}'
+        )
+        return format_event(event_id, operation, data)
+
+    def events(self, heartbeat=config.SUBSCRIBE_HEARTBEAT):
+        """
+        Yields the encoded events until the stream ends, and keep-alive comments while there are
+        none. The subscription is removed from the feed when the generator is closed.
+        """
+        try:
+            yield format_event(None, "subscribed", json.dumps({"table": self.table}))
+            while True:
+                if self.overflowed:
+                    yield format_event(None, "overflow", json.dumps({"table": self.table}))
+                    return
+                try:
+                    change = self.queue.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield KEEPALIVE
+                    continue
+                if change is None:
+                    yield format_event(None, "error", json.dumps({"error": self.error}))
+                    return
+                try:
+                    event = self.encode(change)
+                except (psycopg2.Error, PoolExhausted) as e:
+                    yield format_event(None, "error", json.dumps({"error": f"{e}"}))
+                    return
+                yield event
+        finally:
+            change_feed.unsubscribe(self)
+
+
+class AsyncSubscription(Subscription):
+    """
+    A subscription read by a coroutine. Changes are handed to the subscriber's event loop, so the
+    listener thread never touches the asyncio queue directly, and the changed rows are read on
+    the loop's default executor.
+    """
+
+    def __init__(self, credentials, table, operations=None, size=config.SUBSCRIBE_QUEUE_SIZE):
+        super().__init__(credentials, table, operations, size)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=size)
+
+    def offer(self, change):
+        self._call(self._put, change)
+
+    def close(self, error):
+        self.error = error
+        self._call(self._put_sentinel)
+
+    def _call(self, function, *args):
+        try:
+            self.loop.call_soon_threadsafe(function, *args)
+        except RuntimeError:
+            # The event loop is closed; the subscriber is gone.
+            pass
+
+    def _put(self, change):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(change)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    def _put_sentinel(self):
+        try:
+            self.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+    async def events(self, heartbeat=config.SUBSCRIBE_HEARTBEAT):
+        """
+        Yields the encoded events like `Subscription.events`.
+        """
+        try:
+            yield format_event(None, "subscribed", json.dumps({"table": self.table}))
+            while True:
+                if self.overflowed:
+                    yield format_event(None, "overflow", json.dumps({"table": self.table}))
+                    return
+                try:
+                    change = await asyncio.wait_for(self.queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield KEEPALIVE
+                    continue
+                if change is None:
+                    yield format_event(None, "error", json.dumps({"error": self.error}))
+                    return
+                try:
+                    event = await self.loop.run_in_executor(None, self.encode, change)
+                except (psycopg2.Error, PoolExhausted) as e:
+                    yield format_event(None, "error", json.dumps({"error": f"{e}"}))
+                    return
+                yield event
+        finally:
+            change_feed.unsubscribe(self)
+
+
+class Listener(threading.Thread):
+    """
+    A thread that holds the one connection listening to the channels of a database's subscribed
+    tables and fans the notifications out to the subscriptions of each table. It stops listening
+    to a table, and drops its trigger, once the table's last subscription is gone, and it stops
+    and closes its connection once the last subscription of the database is gone.
+    """
+
+    def __init__(self, feed, key, credentials, poll_interval=1.0):
+        super().__init__(name=f"oyda-change-feed-{key[2]}", daemon=True)
+        host, port, oydaBase, user, password = credentials
+        self.feed = feed
+        self.key = key
+        self.poll_interval = poll_interval
+        self.subscriptions = {}
+        # The tables whose last subscription is gone, with that subscription
+        self.released = {}
+        # The credentials that installed the triggers of the tables, by table
+        self.installers = {}
+        # The tables listened to, by channel
+        self.channels = {}
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.conn = psycopg2.connect(dbname=oydaBase, user=user, password=password, host=host, port=port)
+        self.conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+    def listen(self, subscription):
+        """
+        Listens to the channel of a subscription's table, holding the table's lock, unless it
+        does already.
+        """
+        channel = f"{CHANNEL_PREFIX}{subscription.oid}"
+        with self.lock:
+            if channel in self.channels:
+                return
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "SELECT pg_advisory_lock_shared(%s, %s::oid::integer)", (LOCK_NAMESPACE, subscription.oid)
+            )
+            cursor.execute(f"LISTEN {channel}")
+            cursor.close()
+            self.channels[channel] = subscription.table
+
+    def release(self):
+        """
+        Stops listening to the tables whose last subscription is gone and drops their triggers.
+        """
+        with self.lock:
+            released = self.feed._released(self)
+            if not released:
+                return
+            cursor = self.conn.cursor()
+            for subscription, _ in released:
+                channel = f"{CHANNEL_PREFIX}{subscription.oid}"
+                cursor.execute(f"UNLISTEN {channel}")
+                cursor.execute(
+                    "SELECT pg_advisory_unlock_shared(%s, %s::oid::integer)",
+                    (LOCK_NAMESPACE, subscription.oid),
+                )
+                self.channels.pop(channel, None)
+            cursor.close()
+        for subscription, credentials in released:
+            drop(subscription, credentials)
+
+    def run(self):
+        try:
+            while True:
+                self.release()
+                if not self.feed._keep(self):
+                    # Nobody can subscribe through this listener any more.
+                    self.release()
+                    break
+                if select.select([self.conn], [], [], self.poll_interval) == ([], [], []):
+                    continue
+                with self.lock:
+                    self.conn.poll()
+                    notifies, self.conn.notifies[:] = list(self.conn.notifies), []
+                for notify in notifies:
+                    self.dispatch(notify.channel, notify.payload)
+        except (psycopg2.Error, OSError) as e:
+            self.feed._fail(self, f"Change feed connection lost: {e}")
+        finally:
+            self.close()
+
+    def dispatch(self, channel, payload):
+        try:
+            change = json.loads(payload)
+            operation, key = change["op"], change["key"]
+        except (ValueError, KeyError, TypeError):
+            return
+        subscriptions = self.feed._subscribers(self, self.channels.get(channel))
+        if not subscriptions:
+            return
+        change = (next(self._ids), operation, key)
+        for subscription in subscriptions:
+            if subscription.wants(operation):
+                subscription.offer(change)
+
+    def close(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+
+class ChangeFeed:
+    """
+    The listeners of all databases, keyed by (host, port, oydaBase), and their subscriptions.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listeners = {}
+        self._stats = {"subscribed": 0, "overflowed": 0}
+
+    def subscribe(self, credentials, subscription):
+        """
+        Adds a subscription, starting the database's listener if it has none, and installs the
+        trigger of its table if the table has none.
+
+        :param credentials: The `credentials` parameter is a (host, port, oydaBase, user, password)
+        tuple that opens the listener's connection if one is needed.
+        :param subscription: The `subscription` parameter is a `Subscription` of a prepared table.
+        :raises ChangeFeedError: When the trigger is missing and the caller may not create it.
+        """
+        host, port, oydaBase = credentials[:3]
+        key = (host, int(port), oydaBase)
+        with self._lock:
+            listener = self._listeners.get(key)
+            if listener is not None:
+                self._add(listener, subscription)
+
+        if listener is None:
+            # Connect without holding the lock; a concurrent subscription may win the race.
+            new_listener = Listener(self, key, credentials)
+            with self._lock:
+                listener = self._listeners.get(key)
+                if listener is None:
+                    listener = self._listeners[key] = new_listener
+                    listener.start()
+                self._add(listener, subscription)
+            if listener is not new_listener:
+                new_listener.close()
+
+        try:
+            listener.listen(subscription)
+            if install(subscription):
+                with self._lock:
+                    listener.installers[subscription.table] = subscription.credentials
+        except BaseException:
+            self.unsubscribe(subscription)
+            raise
+
+    def _add(self, listener, subscription):
+        listener.subscriptions.setdefault(subscription.table, []).append(subscription)
+        listener.released.pop(subscription.table, None)
+        subscription.listener = listener
+        self._stats["subscribed"] += 1
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            listener = getattr(subscription, "listener", None)
+            if listener is None:
+                return
+            subscriptions = listener.subscriptions.get(subscription.table, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+                if subscription.overflowed:
+                    self._stats["overflowed"] += 1
+                if not subscriptions:
+                    listener.subscriptions.pop(subscription.table, None)
+                    listener.released[subscription.table] = subscription
+
+    def _released(self, listener):
+        # Called by a listener holding its own lock, so a table subscribed to again from now on
+        # is listened to again only after the listener has stopped listening to it.
+        with self._lock:
+            released, listener.released = list(listener.released.values()), {}
+            return [
+                (subscription, listener.installers.pop(subscription.table, subscription.credentials))
+                for subscription in released
+            ]
+
+    def _subscribers(self, listener, table):
+        with self._lock:
+            return list(listener.subscriptions.get(table, ()))
+
+    def _keep(self, listener):
+        # Called by a listener between polls: stops it once nobody is subscribed.
+        with self._lock:
+            if listener.subscriptions:
+                return True
+            if self._listeners.get(listener.key) is listener:
+                del self._listeners[listener.key]
+            return False
+
+    def _fail(self, listener, error):
+        with self._lock:
+            if self._listeners.get(listener.key) is listener:
+                del self._listeners[listener.key]
+            subscriptions = [s for table in listener.subscriptions.values() for s in table]
+            listener.subscriptions.clear()
+        for subscription in subscriptions:
+            subscription.close(error)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "listeners": len(self._listeners),
+                "subscriptions": sum(
+                    len(subscriptions)
+                    for listener in self._listeners.values()
+                    for subscriptions in listener.subscriptions.values()
+                ),
+                **self._stats,
+            }
+
+
+change_feed = ChangeFeed()
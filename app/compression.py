@@ -0,0 +1,199 @@
+import zlib
+
+from werkzeug.http import parse_accept_header
+
+import app.config as config
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - zstandard is optional
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+# Content codings in order of preference, with their default levels and level ranges
+ENCODINGS = {
+    "zstd": {"level": 3, "levels": (1, 22), "package": zstandard},
+    "br": {"level": 4, "levels": (0, 11), "package": brotli},
+    "gzip": {"level": 6, "levels": (1, 9), "package": zlib},
+}
+
+
+def available_encodings():
+    """
+    :return: Returns the names of the content codings whose packages are installed, in order of
+    preference.
+    """
+    return [name for name, encoding in ENCODINGS.items() if encoding["package"] is not None]
+
+
+def negotiate(accept_encoding, endpoint=None):
+    """
+    This is a helper function that picks the content coding of a response from the request's
+    `Accept-Encoding` header. The client's quality values win; among equally acceptable codings
+    the server prefers zstd, then brotli, then gzip.
+
+    :param accept_encoding: The `accept_encoding` parameter is the raw `Accept-Encoding` header.
+    :param endpoint: The `endpoint` parameter is the name of the endpoint answering the request.
+    :return: Returns the name of the coding, or None if the response should not be compressed.
+    """
+    if not enabled(endpoint) or not accept_encoding:
+        return None
+    return parse_accept_header(accept_encoding).best_match(available_encodings())
+
+
+def enabled(endpoint):
+    return config.COMPRESSION_ENABLED and min_size(endpoint) >= 0
+
+
+def min_size(endpoint):
+    """
+    :return: Returns the smallest body the endpoint compresses, negative if it never compresses.
+    """
+    return int(config.COMPRESSION_MIN_SIZES.get(endpoint, config.COMPRESSION_MIN_SIZE))
+
+
+def level(encoding, endpoint):
+    """
+    :return: Returns the compression level of `encoding` on the endpoint, from
+    `OYDA_COMPRESSION_LEVELS` entries such as "gzip=6" or "select_table.gzip=1", clamped to the
+    coding's range.
+    """
+    levels = config.COMPRESSION_LEVELS
+    value = levels.get(f"{endpoint}.{encoding}", levels.get(encoding, ENCODINGS[encoding]["level"]))
+    low, high = ENCODINGS[encoding]["levels"]
+    return min(max(int(value), low), high)
+
+
+class Compressor:
+    """
+    Compresses a body incrementally. Each chunk is flushed as it is compressed, so that a client
+    reading a stream can decode every chunk it receives without waiting for the end of the body.
+    """
+
+    def __init__(self, encoding, level):
+        self.encoding = encoding
+        if encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        elif encoding == "br":
+            self._compressor = brotli.Compressor(quality=level)
+        else:
+            # wbits 31 writes the gzip header and trailer.
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, chunk):
+        """
+        :return: Returns the compressed chunk, which decodes to all the data passed so far.
+        """
+        if self.encoding == "zstd":
+            return self._compressor.compress(chunk) + self._compressor.flush(
+                zstandard.COMPRESSOBJ_FLUSH_BLOCK
+            )
+        if self.encoding == "br":
+            return self._compressor.process(chunk) + self._compressor.flush()
+        return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        """
+        :return: Returns the end of the compressed body.
+        """
+        if self.encoding == "zstd":
+            return self._compressor.flush()
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def compress(encoding, level, body):
+    """
+    This is a helper function that compresses a whole body in one go.
+
+    :return: Returns the compressed body as bytes.
+    """
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(body)
+    if encoding == "br":
+        return brotli.compress(body, quality=level)
+    return zlib.compress(body, level, 31)
+
+
+def compress_stream(encoding, level, body):
+    """
+    This is a helper function that compresses a streamed body chunk by chunk, without buffering
+    it. The underlying body is closed when the stream ends or is closed.
+
+    :param body: The `body` parameter is an iterable of byte chunks.
+    :return: Returns a generator of compressed chunks.
+    """
+    compressor = Compressor(encoding, level)
+    try:
+        for chunk in body:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.finish()
+    finally:
+        close = getattr(body, "close", None)
+        if close is not None:
+            close()
+
+
+async def compress_stream_async(encoding, level, body):
+    """
+    This is a helper function that compresses an async streamed body like `compress_stream`.
+    """
+    compressor = Compressor(encoding, level)
+    try:
+        async for chunk in body:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.finish()
+    finally:
+        close = getattr(body, "aclose", None)
+        if close is not None:
+            await close()
+
+
+def compressible(status, headers):
+    """
+    :return: Returns whether a response with this status and headers may be compressed.
+    """
+    return 200 <= status < 300 and status != 204 and "Content-Encoding" not in headers
+
+
+def init_app(app):
+    """
+    This is a helper function that compresses the responses of a Flask app when the client accepts
+    it. Bodies below the endpoint's size threshold are sent as they are; streamed bodies, whose
+    size is not known up front, are compressed chunk by chunk.
+
+    :param app: The `app` parameter is the Flask app.
+    """
+    from flask import request
+
+    @app.after_request
+    def compress_response(response):
+        if request.endpoint is None or not compressible(response.status_code, response.headers):
+            return response
+        endpoint = request.endpoint.rsplit(".", 1)[-1]
+        if not enabled(endpoint):
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = negotiate(request.headers.get("Accept-Encoding"), endpoint)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_stream(encoding, level(encoding, endpoint), response.response)
+            response.headers.pop("Content-Length", None)
+        else:
+            body = response.get_data()
+            if len(body) < min_size(endpoint):
+                return response
+            response.set_data(compress(encoding, level(encoding, endpoint), body))
+        response.headers["Content-Encoding"] = encoding
+        return response
@@ -0,0 +1,130 @@
+import os
+
+
+def env_int(name, default):
+    """
+    This is a helper function that reads an integer setting from the environment.
+
+    :param name: The `name` parameter is the name of the environment variable.
+    :param default: The `default` parameter is returned when the variable is unset or empty.
+    :return: Returns the integer value of the setting.
+    """
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def env_float(name, default):
+    """
+    This is a helper function that reads a float setting from the environment.
+
+    :param name: The `name` parameter is the name of the environment variable.
+    :param default: The `default` parameter is returned when the variable is unset or empty.
+    :return: Returns the float value of the setting.
+    """
+    value = os.environ.get(name)
+    return float(value) if value else default
+
+
+def env_float_map(name):
+    """
+    This is a helper function that reads a "key=value,key=value" setting with float values from
+    the environment.
+
+    :param name: The `name` parameter is the name of the environment variable.
+    :return: Returns a dictionary of the parsed entries, empty when the variable is unset.
+    """
+    entries = {}
+    for item in os.environ.get(name, "").split(","):
+        if "=" in item:
+            key, value = item.split("=", 1)
+            entries[key.strip()] = float(value)
+    return entries
+
+
+# Connection pool
+POOL_MIN_SIZE = env_int("OYDA_POOL_MIN_SIZE", 0)
+POOL_MAX_SIZE = env_int("OYDA_POOL_MAX_SIZE", 10)
+POOL_MAX_TOTAL = env_int("OYDA_POOL_MAX_TOTAL", 50)
+POOL_IDLE_TIMEOUT = env_float("OYDA_POOL_IDLE_TIMEOUT", 300.0)
+POOL_HEALTH_CHECK_AFTER = env_float("OYDA_POOL_HEALTH_CHECK_AFTER", 30.0)
+POOL_CHECKOUT_TIMEOUT = env_float("OYDA_POOL_CHECKOUT_TIMEOUT", 10.0)
+
+# Share of the per-key and overall connection limits given to the ASGI app's async pool; the sync
+# pool, which serves the endpoints the ASGI app hands to Flask, keeps the rest
+POOL_ASYNC_SHARE = env_float("OYDA_POOL_ASYNC_SHARE", 0.5)
+
+# Bearer token that unlocks the per-database details of the statistics endpoints; without it
+# they only report totals
+STATS_TOKEN = os.environ.get("OYDA_STATS_TOKEN") or None
+
+# Streaming responses
+STREAM_FETCH_SIZE = env_int("OYDA_STREAM_FETCH_SIZE", 2000)
+
+# Keyset pagination
+PAGE_MAX_LIMIT = env_int("OYDA_PAGE_MAX_LIMIT", 10000)
+
+# Bulk writes
+BULK_BATCH_SIZE = env_int("OYDA_BULK_BATCH_SIZE", 1000)
+
+# Schema catalog cache
+SCHEMA_CACHE_TTL = env_float("OYDA_SCHEMA_CACHE_TTL", 60.0)
+SCHEMA_CACHE_MISS_REFRESH = env_float("OYDA_SCHEMA_CACHE_MISS_REFRESH", 5.0)
+
+# pub.dev package resolution
+PUBDEV_URL = os.environ.get("OYDA_PUBDEV_URL", "https://pub.dev/api/packages")
+PUBDEV_TIMEOUT = env_float("OYDA_PUBDEV_TIMEOUT", 5.0)
+PUBDEV_CACHE_TTL = env_float("OYDA_PUBDEV_CACHE_TTL", 300.0)
+PUBDEV_CACHE_SIZE = env_int("OYDA_PUBDEV_CACHE_SIZE", 1024)
+PUBDEV_WORKERS = env_int("OYDA_PUBDEV_WORKERS", 8)
+
+# Query result cache
+RESULT_CACHE_MAX_BYTES = env_int("OYDA_RESULT_CACHE_MAX_BYTES", 0)
+RESULT_CACHE_TTL = env_float("OYDA_RESULT_CACHE_TTL", 30.0)
+RESULT_CACHE_TABLE_TTLS = env_float_map("OYDA_RESULT_CACHE_TTLS")
+
+# Row serialization; "orjson" or "json", defaulting to orjson when it is installed
+SERIALIZER = os.environ.get("OYDA_SERIALIZER")
+
+# Structured filters and prepared statements
+FILTER_SHAPE_CACHE_SIZE = env_int("OYDA_FILTER_SHAPE_CACHE_SIZE", 1024)
+PREPARE_THRESHOLD = env_int("OYDA_PREPARE_THRESHOLD", 5)
+PREPARED_MAX = env_int("OYDA_PREPARED_MAX", 100)
+
+# Request metrics at /api/metrics; 0 disables them
+METRICS_ENABLED = bool(env_int("OYDA_METRICS", 1))
+# Distinct values of the metrics' database label; requests on further databases are labeled "other"
+METRICS_MAX_DATABASES = env_int("OYDA_METRICS_MAX_DATABASES", 100)
+
+# Slow-query log at /api/slow_queries; a threshold of 0 disables it
+SLOW_QUERY_THRESHOLD = env_float("OYDA_SLOW_QUERY_THRESHOLD", 1.0)
+SLOW_QUERY_LOG_SIZE = env_int("OYDA_SLOW_QUERY_LOG_SIZE", 200)
+SLOW_QUERY_EXPLAIN = bool(env_int("OYDA_SLOW_QUERY_EXPLAIN", 0))
+SLOW_QUERY_EXPLAIN_TIMEOUT = env_float("OYDA_SLOW_QUERY_EXPLAIN_TIMEOUT", 5.0)
+
+# Response compression; per-endpoint entries such as "select_table=0" override the minimum size,
+# and a negative size turns compression off for that endpoint
+COMPRESSION_ENABLED = bool(env_int("OYDA_COMPRESSION", 1))
+COMPRESSION_MIN_SIZE = env_int("OYDA_COMPRESSION_MIN_SIZE", 1024)
+COMPRESSION_MIN_SIZES = env_float_map("OYDA_COMPRESSION_MIN_SIZES")
+COMPRESSION_LEVELS = env_float_map("OYDA_COMPRESSION_LEVELS")
+
+# Session tokens handed out by set_oydabase
+SESSION_TTL = env_float("OYDA_SESSION_TTL", 900.0)
+SESSION_MAX = env_int("OYDA_SESSION_MAX", 10000)
+
+# Row-change subscriptions at /api/subscribe
+SUBSCRIBE_QUEUE_SIZE = env_int("OYDA_SUBSCRIBE_QUEUE_SIZE", 1000)
+SUBSCRIBE_HEARTBEAT = env_float("OYDA_SUBSCRIBE_HEARTBEAT", 15.0)
+
+# Table export and import with COPY; the export holds at most COPY_QUEUE_SIZE chunks per request
+COPY_CHUNK_SIZE = env_int("OYDA_COPY_CHUNK_SIZE", 65536)
+COPY_QUEUE_SIZE = env_int("OYDA_COPY_QUEUE_SIZE", 16)
+
+# Parallel scans of select_table streams and exports; `"parallel": true` uses PARALLEL_SCAN_WORKERS
+# parts, and no request gets more than PARALLEL_SCAN_MAX
+PARALLEL_SCAN_WORKERS = env_int("OYDA_PARALLEL_SCAN_WORKERS", 4)
+PARALLEL_SCAN_MAX = env_int("OYDA_PARALLEL_SCAN_MAX", 8)
+PARALLEL_SCAN_QUEUE_SIZE = env_int("OYDA_PARALLEL_SCAN_QUEUE_SIZE", 16)
+
+# Exact row counts of /api/table_stats are cancelled after this many seconds per table
+TABLE_STATS_COUNT_TIMEOUT = env_float("OYDA_TABLE_STATS_COUNT_TIMEOUT", 5.0)
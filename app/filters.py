@@ -0,0 +1,247 @@
+import itertools
+import re
+import threading
+from collections import OrderedDict
+
+from psycopg2 import errors, extensions  # type: ignore
+
+import app.config as config
+import app.utilities as utils
+
+# Comparison operators of the filter language and their SQL, `{column}` and `{value}` being the
+# quoted column and the typed placeholder
+OPERATORS = {
+    "eq": "{column} = {value}",
+    "ne": "{column} <> {value}",
+    "gt": "{column} > {value}",
+    "gte": "{column} >= {value}",
+    "lt": "{column} < {value}",
+    "lte": "{column} <= {value}",
+    "in": "{column} = ANY({array})",
+    "nin": "NOT ({column} = ANY({array}))",
+    "like": "{column} LIKE %s",
+    "ilike": "{column} ILIKE %s",
+}
+
+
+class FilterError(ValueError):
+    """
+    Raised when a structured filter is malformed or refers to unknown columns.
+    """
+
+
+def _placeholder(column_type):
+    # An explicit cast keeps the statement valid whatever Python type the value arrives as, and
+    # gives PREPARE the parameter types. The type has no modifiers, so the cast never truncates.
+    return f"%s::{column_type}"
+
+
+def _compile(where, column_types, table_name, params):
+    if not isinstance(where, dict) or not where:
+        raise FilterError("A filter must be a non-empty object")
+
+    clauses = []
+    for name, condition in where.items():
+        if name in ("and", "or"):
+            if not isinstance(condition, list) or not condition:
+                raise FilterError(f"{name} takes a non-empty list of filters")
+            parts = [_compile(item, column_types, table_name, params) for item in condition]
+            clauses.append("(" + f" {name.upper()} ".join(parts) + ")")
+            continue
+        if name == "not":
+            clauses.append(f"NOT ({_compile(condition, column_types, table_name, params)})")
+            continue
+
+        if name not in column_types:
+            raise FilterError(f"Table {table_name} has no column {name}")
+        column = utils.quote_ident(name).replace("%", "%%")
+        column_type = column_types[name]
+
+        if not isinstance(condition, dict):
+            condition = {"null": True} if condition is None else {"eq": condition}
+        if not condition:
+            raise FilterError(f"The filter on {name} has no operator")
+        for operator, value in condition.items():
+            if operator == "null":
+                clauses.append(f"{column} IS {'' if value else 'NOT '}NULL")
+                continue
+            if operator not in OPERATORS:
+                raise FilterError(f"Unknown filter operator: {operator}")
+            if operator in ("in", "nin") and not isinstance(value, list):
+                raise FilterError(f"{operator} takes a list of values")
+            if value is None:
+                raise FilterError(f"Use null to compare {name} with null")
+            clauses.append(
+                OPERATORS[operator].format(
+                    column=column,
+                    value=_placeholder(column_type),
+                    array=_placeholder(f"{column_type}[]"),
+                )
+            )
+            params.append(value)
+
+    return " AND ".join(clauses) if len(clauses) == 1 else "(" + " AND ".join(clauses) + ")"
+
+
+def compile_filter(cursor, table_name, where):
+    """
+    This is a helper function that compiles a structured filter into a parameterized SQL
+    condition. A filter maps column names to a value (equality, or IS NULL for null) or to an
+    object of operators (`eq`, `ne`, `gt`, `gte`, `lt`, `lte`, `in`, `nin`, `like`, `ilike`,
+    `null`); `and` and `or` take lists of filters and `not` takes a filter, e.g.
+    `{"age": {"gt": 30}, "or": [{"status": {"in": ["a", "b"]}}, {"deleted_at": null}]}`.
+
+    Column names are checked against the cached schema and quoted, and values are passed as
+    parameters cast to the column types, so the SQL text depends only on the shape of the filter.
+
+    :param cursor: The `cursor` parameter is a database object to interact with a database.
+    :param table_name: The `table_name` parameter is a string that represents the name of the table.
+    :param where: The `where` parameter is the structured filter.
+    :return: Returns a (condition, params) tuple; the condition escapes literal percent signs, so it
+    must be executed with the params list, even when that is empty.
+    :raises FilterError: When the filter is malformed or refers to unknown columns.
+    """
+    return compile_where(where, utils.get_column_types(cursor, table_name), table_name)
+
+
+def compile_where(where, column_types, table_name):
+    """
+    Compiles a structured filter like `compile_filter`, against column types the caller has
+    already looked up.
+
+    :param where: The `where` parameter is the structured filter.
+    :param column_types: The `column_types` parameter maps the table's column names to their types.
+    :param table_name: The `table_name` parameter is a string that represents the name of the table.
+    :return: Returns a (condition, params) tuple.
+    :raises FilterError: When the table does not exist or the filter is invalid.
+    """
+    if not column_types:
+        raise FilterError(f"Table {table_name} does not exist")
+    params = []
+    return _compile(where, column_types, table_name, params), params
+
+
+def assignments(cursor, table_name, row):
+    """
+    This is a helper function that compiles the SET list of an UPDATE from a row of new values, in
+    the same parameterized form as `compile_filter`.
+
+    :param cursor: The `cursor` parameter is a database object to interact with a database.
+    :param table_name: The `table_name` parameter is a string that represents the name of the table.
+    :param row: The `row` parameter is a dictionary of column names and new values.
+    :return: Returns a (SET list, params) tuple.
+    :raises FilterError: When the row refers to unknown columns.
+    """
+    column_types = utils.get_column_types(cursor, table_name)
+    if not column_types:
+        raise FilterError(f"Table {table_name} does not exist")
+    parts = []
+    for name in row:
+        if name not in column_types:
+            raise FilterError(f"Table {table_name} has no column {name}")
+        column = utils.quote_ident(name).replace("%", "%%")
+        parts.append(f"{column} = {_placeholder(column_types[name])}")
+    return ", ".join(parts), list(row.values())
+
+
+class StatementCache:
+    """
+    Counts how often each compiled statement shape (its SQL text) runs and turns the frequent ones
+    into server-side prepared statements.
+
+    Once a shape has run `threshold` times in this process, the next execution on each pooled
+    connection PREPAREs it, and later executions on that connection only send EXECUTE with the
+    parameters, skipping parse and plan. Each connection keeps at most `max_prepared` statements
+    and deallocates the least recently used one beyond that. The counts are kept for the
+    `shape_cache_size` most recently used shapes. A statement is kept when an execution fails on
+    its parameters. When the session lost it or its plan no longer fits, it is prepared again and
+    the execution retried once.
+    """
+
+    def __init__(
+        self,
+        threshold=config.PREPARE_THRESHOLD,
+        max_prepared=config.PREPARED_MAX,
+        shape_cache_size=config.FILTER_SHAPE_CACHE_SIZE,
+    ):
+        self.threshold = threshold
+        self.max_prepared = max_prepared
+        self.shape_cache_size = shape_cache_size
+        self._lock = threading.Lock()
+        self._uses = OrderedDict()
+        self._names = itertools.count(1)
+
+    def _count(self, query):
+        with self._lock:
+            uses = self._uses.pop(query, 0) + 1
+            self._uses[query] = uses
+            while len(self._uses) > self.shape_cache_size:
+                self._uses.popitem(last=False)
+            return uses
+
+    def execute(self, cursor, query, params):
+        """
+        Runs a compiled statement, through a prepared statement once its shape is frequent.
+
+        :param cursor: The `cursor` parameter is a cursor of a pooled connection.
+        :param query: The `query` parameter is SQL text with `%s` placeholders.
+        :param params: The `params` parameter is the list of parameter values.
+        """
+        conn = cursor.connection
+        prepared = getattr(conn, "prepared", None)
+        if prepared is None or self.threshold <= 0 or self._count(query) < self.threshold:
+            cursor.execute(query, params)
+            return
+
+        # A failed statement aborts the transaction. Outside of one, rolling back to retry loses
+        # nothing; inside one, the EXECUTE runs in a savepoint so the transaction survives it.
+        in_transaction = conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE
+        name = prepared.get(query)
+        if name is None:
+            name = self._prepare(cursor, prepared, query)
+        else:
+            prepared.move_to_end(query)
+
+        if in_transaction:
+            cursor.execute("SAVEPOINT oyda_execute")
+        try:
+            _execute(cursor, name, params)
+        except (errors.InvalidSqlStatementName, errors.FeatureNotSupported) as e:
+            # The session lost the statement, e.g. to DISCARD ALL, or its plan no longer fits the
+            # table, e.g. after ALTER TABLE; prepare it afresh and try once more.
+            if in_transaction:
+                cursor.execute("ROLLBACK TO SAVEPOINT oyda_execute")
+            else:
+                conn.rollback()
+            del prepared[query]
+            if isinstance(e, errors.FeatureNotSupported):
+                cursor.execute(f"DEALLOCATE {name}")
+            _execute(cursor, self._prepare(cursor, prepared, query), params)
+        if in_transaction:
+            # On a cursor of its own, which leaves the rows of the EXECUTE to be fetched.
+            with conn.cursor() as savepoint:
+                savepoint.execute("RELEASE SAVEPOINT oyda_execute")
+
+    def _prepare(self, cursor, prepared, query):
+        name = f"oyda_stmt_{next(self._names)}"
+        cursor.execute(f"PREPARE {name} AS {_numbered(query)}")
+        prepared[query] = name
+        while len(prepared) > self.max_prepared:
+            _, evicted = prepared.popitem(last=False)
+            cursor.execute(f"DEALLOCATE {evicted}")
+        return name
+
+
+def _execute(cursor, name, params):
+    if params:
+        cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cursor.execute(f"EXECUTE {name}")
+
+
+def _numbered(query):
+    counter = itertools.count(1)
+    return re.sub(r"%([s%])", lambda m: f"${next(counter)}" if m.group(1) == "s" else "%", query)
+
+
+statements = StatementCache()
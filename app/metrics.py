@@ -0,0 +1,396 @@
+import bisect
+import contextvars
+import threading
+import time
+
+from psycopg2 import extensions  # type: ignore
+
+import app.config as config
+from app.slow_queries import slow_query_log
+
+# Histogram bucket bounds for durations in seconds and for response sizes in bytes
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+# The phases of a request: pool checkout (including connecting), statement execution, fetching
+# rows and encoding them
+PHASES = ("checkout", "execute", "fetch", "serialize")
+
+_current = contextvars.ContextVar("oyda_request_timer", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """
+    A thread-safe histogram with fixed buckets and one series per combination of label values,
+    rendered in the Prometheus text format.
+    """
+
+    def __init__(self, name, documentation, labels, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, label_values, value):
+        """
+        Records one observation.
+
+        :param label_values: The `label_values` parameter is a tuple of values in `labels` order.
+        :param value: The `value` parameter is the observed value.
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # One count per bucket plus +Inf, then the sum
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self, hidden=()):
+        """
+        :param hidden: The `hidden` parameter names labels to leave out; the series that differ
+        only in them are added up.
+        :return: Returns the histogram's lines in the Prometheus text format.
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        shown = [i for i, name in enumerate(self.labels) if name not in hidden]
+        series = {}
+        with self._lock:
+            for label_values, values in self._series.items():
+                key = tuple(label_values[i] for i in shown)
+                total = series.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    total[i] += value
+        names = [self.labels[i] for i in shown]
+        for label_values, values in sorted(series.items()):
+            labels = ",".join(
+                f'{name}="{_escape(value)}"' for name, value in zip(names, label_values)
+            )
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), values[:-1]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {_number(values[-1])}")
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return lines
+
+
+class Metrics:
+    """
+    The request metrics of this process: the total duration of each request, the time it spent in
+    each phase and the size of its response, labeled by endpoint and database.
+    """
+
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, enabled=config.METRICS_ENABLED, max_databases=config.METRICS_MAX_DATABASES):
+        self.enabled = enabled
+        self.max_databases = max_databases
+        self._databases = set()
+        self._databases_lock = threading.Lock()
+        self.request_seconds = Histogram(
+            "oyda_request_duration_seconds",
+            "Time from the start of a request until its response body was sent.",
+            ("endpoint", "database"),
+            LATENCY_BUCKETS,
+        )
+        self.phase_seconds = Histogram(
+            "oyda_request_phase_seconds",
+            "Time a request spent in each phase: checkout, execute, fetch or serialize.",
+            ("endpoint", "database", "phase"),
+            LATENCY_BUCKETS,
+        )
+        self.response_bytes = Histogram(
+            "oyda_response_size_bytes",
+            "Size of response bodies.",
+            ("endpoint", "database"),
+            SIZE_BUCKETS,
+        )
+
+    def start(self, endpoint):
+        """
+        Starts timing a request and makes it the current request of this context, so that pool
+        checkouts, cursors and serializers record their phases on it.
+
+        :param endpoint: The `endpoint` parameter is the endpoint name, e.g. "select_table".
+        :return: Returns a (timer, token) tuple; pass the token to `stop`. The timer is None when
+        metrics are disabled.
+        """
+        if not self.enabled:
+            return None, None
+        timer = RequestTimer(self, endpoint)
+        return timer, _current.set(timer)
+
+    def stop(self, token):
+        """
+        Detaches the request started with `start` from this context. The request is recorded once
+        its response body has been sent, see `RequestTimer.finish`.
+        """
+        if token is not None:
+            _current.reset(token)
+
+    def database_label(self, oydaBase):
+        """
+        Maps a database to its label value. Only the first `max_databases` databases get a label
+        of their own, so the number of series stays bounded.
+        """
+        with self._databases_lock:
+            if oydaBase in self._databases:
+                return oydaBase
+            if len(self._databases) < self.max_databases:
+                self._databases.add(oydaBase)
+                return oydaBase
+        return "other"
+
+    def render(self, details=True):
+        """
+        :param details: The `details` parameter keeps the `database` label; without it, the series
+        of all databases are added up.
+        :return: Returns every metric in the Prometheus text format.
+        """
+        hidden = () if details else ("database",)
+        lines = []
+        for histogram in (self.request_seconds, self.phase_seconds, self.response_bytes):
+            lines.extend(histogram.render(hidden))
+        return "\n".join(lines) + "\n"
+
+
+class RequestTimer:
+    """
+    The phase timings of one request in progress.
+    """
+
+    __slots__ = ("metrics", "endpoint", "database", "started", "phases", "finished")
+
+    def __init__(self, metrics, endpoint):
+        self.metrics = metrics
+        self.endpoint = endpoint
+        self.database = ""
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.finished = False
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def finish(self, size):
+        """
+        Records the request's duration, phases and response size.
+
+        :param size: The `size` parameter is the number of bytes of the response body.
+        """
+        if self.finished:
+            return
+        self.finished = True
+        labels = (self.endpoint, self.database)
+        self.metrics.request_seconds.observe(labels, time.perf_counter() - self.started)
+        self.metrics.response_bytes.observe(labels, size)
+        for phase, seconds in self.phases.items():
+            self.metrics.phase_seconds.observe((*labels, phase), seconds)
+
+    def wrap(self, body):
+        """
+        Wraps a streamed response body so that the rows fetched and encoded while it is sent are
+        recorded on this request, which is finished when the body is exhausted or closed.
+
+        :param body: The `body` parameter is an iterable of byte chunks.
+        :return: Returns a generator over the same chunks.
+        """
+        size = 0
+        iterator = iter(body)
+        try:
+            while True:
+                token = _current.set(self)
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    _current.reset(token)
+                size += len(chunk)
+                yield chunk
+        finally:
+            close = getattr(body, "close", None)
+            if close is not None:
+                close()
+            self.finish(size)
+
+    async def wrap_async(self, body):
+        """
+        Wraps an async streamed response body like `wrap`.
+        """
+        size = 0
+        iterator = body.__aiter__()
+        try:
+            while True:
+                token = _current.set(self)
+                try:
+                    chunk = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    _current.reset(token)
+                size += len(chunk)
+                yield chunk
+        finally:
+            close = getattr(body, "aclose", None)
+            if close is not None:
+                await close()
+            self.finish(size)
+
+
+class Phase:
+    """
+    Times a block as one phase of the current request. Outside of a request, or with metrics
+    disabled, the block runs untimed.
+    """
+
+    __slots__ = ("name", "timer", "started")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.timer = _current.get()
+        if self.timer is not None:
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.timer is not None:
+            self.timer.add(self.name, time.perf_counter() - self.started)
+
+
+def phase(name):
+    """
+    This is a helper function that times a block as one phase of the current request, e.g.
+    `with metrics.phase("serialize"): ...`.
+
+    :param name: The `name` parameter is one of `PHASES`.
+    :return: Returns a context manager.
+    """
+    return Phase(name)
+
+
+def set_database(oydaBase):
+    """
+    This is a helper function that labels the current request with the database it works on. The
+    pool calls it once a connection was checked out, so only databases that accepted the
+    request's credentials become label values.
+
+    :param oydaBase: The `oydaBase` parameter is the name of the database.
+    """
+    timer = _current.get()
+    if timer is not None and oydaBase and not timer.database:
+        timer.database = timer.metrics.database_label(oydaBase)
+
+
+def executed(cursor, query, params, seconds):
+    """
+    This is a helper function that records an executed statement on the current request and in
+    the slow-query log when it took longer than the threshold.
+
+    :param cursor: The `cursor` parameter is the cursor that ran the statement.
+    :param query: The `query` parameter is the statement's SQL text.
+    :param params: The `params` parameter holds the statement's parameters, if any.
+    :param seconds: The `seconds` parameter is how long the statement took.
+    """
+    timer = _current.get()
+    if timer is not None:
+        timer.add("execute", seconds)
+    if slow_query_log.is_slow(seconds):
+        slow_query_log.record(
+            cursor.connection,
+            query,
+            params,
+            seconds,
+            cursor.rowcount,
+            timer.endpoint if timer is not None else None,
+        )
+
+
+def _timed(phase_name, method):
+    def timed(self, *args, **kwargs):
+        timer = _current.get()
+        if timer is None:
+            return method(self, *args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            timer.add(phase_name, time.perf_counter() - started)
+
+    timed.__name__ = method.__name__
+    return timed
+
+
+class TimedCursor(extensions.cursor):
+    """
+    A psycopg2 cursor that records the time spent executing statements and fetching rows on the
+    current request, and logs slow statements. Pooled connections create all their cursors, named
+    ones included, with it.
+    """
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            executed(self, query, vars, time.perf_counter() - started)
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            executed(self, sql, None, time.perf_counter() - started)
+
+    executemany = _timed("execute", extensions.cursor.executemany)
+    fetchone = _timed("fetch", extensions.cursor.fetchone)
+    fetchmany = _timed("fetch", extensions.cursor.fetchmany)
+    fetchall = _timed("fetch", extensions.cursor.fetchall)
+
+
+def init_app(app):
+    """
+    This is a helper function that times every request of a Flask app.
+
+    :param app: The `app` parameter is the Flask app.
+    """
+    from flask import g, request
+
+    @app.before_request
+    def start_timer():
+        if request.endpoint is not None:
+            g.oyda_timer, g.oyda_timer_token = metrics.start(request.endpoint.rsplit(".", 1)[-1])
+
+    @app.after_request
+    def record_response(response):
+        timer = g.pop("oyda_timer", None)
+        if timer is None:
+            return response
+        if response.is_streamed:
+            response.response = timer.wrap(response.response)
+        else:
+            timer.finish(response.calculate_content_length() or 0)
+        return response
+
+    @app.teardown_request
+    def stop_timer(exc):
+        metrics.stop(g.pop("oyda_timer_token", None))
+
+
+metrics = Metrics()
@@ -0,0 +1,245 @@
+import base64
+import json
+
+import app.config as config
+import app.utilities as utils
+
+KEY_PREFIX = "_oyda_key_"
+
+
+class PaginationError(ValueError):
+    """
+    Raised when the pagination parameters of a request are invalid.
+    """
+
+
+def parse_order_by(order_by):
+    """
+    This is a helper function that normalizes the `order_by` request parameter.
+
+    :param order_by: The `order_by` parameter is a column name or a list of column names.
+    :return: Returns a list of column names, or an empty list if none were given.
+    """
+    if not order_by:
+        return []
+    if isinstance(order_by, str):
+        return [order_by]
+    return list(order_by)
+
+
+def parse_limit(limit):
+    """
+    This is a helper function that validates the `limit` request parameter.
+
+    :param limit: The `limit` parameter is the requested page size.
+    :return: Returns the page size as an integer.
+    :raises PaginationError: When the limit is not an integer between 1 and `PAGE_MAX_LIMIT`.
+    """
+    if isinstance(limit, bool) or not isinstance(limit, int):
+        raise PaginationError("limit must be an integer")
+    if not 0 < limit <= config.PAGE_MAX_LIMIT:
+        raise PaginationError(f"limit must be between 1 and {config.PAGE_MAX_LIMIT}")
+    return limit
+
+
+def default_order(primary_key, table_name):
+    """
+    This is a helper function that picks the page order of a request without `order_by`.
+
+    :param primary_key: The `primary_key` parameter is the list of the table's primary key columns.
+    :param table_name: The `table_name` parameter is a string that represents the name of the table.
+    :return: Returns the primary key columns.
+    :raises PaginationError: When the table has no primary key.
+    """
+    if not primary_key:
+        raise PaginationError(
+            f"Table {table_name} has no primary key; order_by is required for pagination"
+        )
+    return primary_key
+
+
+def page_order(order_by, primary_key, table_name):
+    """
+    This is a helper function that picks the key columns of a paginated request. The primary key
+    columns missing from `order_by` are appended, so rows with the same `order_by` values have a
+    definite order and none of them is skipped or repeated at a page boundary.
+
+    :param order_by: The `order_by` parameter is the list of requested sort columns, possibly empty.
+    :param primary_key: The `primary_key` parameter is the list of the table's primary key columns.
+    :param table_name: The `table_name` parameter is a string that represents the name of the table.
+    :return: Returns the key columns.
+    :raises PaginationError: When there is no `order_by` and the table has no primary key.
+    """
+    if not order_by:
+        return default_order(primary_key, table_name)
+    return order_by + [column for column in primary_key if column not in order_by]
+
+
+def _json_value(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    # Postgres parses the text form of dates, decimals, UUIDs etc. back into the column type.
+    return str(value)
+
+
+def encode_token(order_by, descending, values):
+    """
+    This is a helper function that encodes the last key of a page into an opaque `after` token.
+
+    :param order_by: The `order_by` parameter is the list of key columns.
+    :param descending: The `descending` parameter tells whether the page was sorted descending.
+    :param values: The `values` parameter holds the key column values of the last row.
+    :return: Returns a URL-safe token string.
+    """
+    payload = {"o": order_by, "d": descending, "k": [_json_value(v) for v in values]}
+    raw = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_token(token, order_by, descending):
+    """
+    This is a helper function that decodes an `after` token and checks it against the current sort.
+
+    :param token: The `token` parameter is a token returned by a previous page.
+    :param order_by: The `order_by` parameter is the list of key columns of the current request.
+    :param descending: The `descending` parameter tells whether the current request sorts descending.
+    :return: Returns the key values encoded in the token.
+    :raises PaginationError: When the token is malformed or was issued for a different sort.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        payload = json.loads(raw)
+        values = payload["k"]
+    except (ValueError, TypeError, KeyError):
+        raise PaginationError("Invalid after token")
+    if payload.get("o") != order_by or payload.get("d") != descending:
+        raise PaginationError("The after token was issued for a different order_by")
+    if not isinstance(values, list) or len(values) != len(order_by):
+        raise PaginationError("Invalid after token")
+    return values
+
+
+def _after_nullable(keys, values, descending):
+    """
+    Builds the condition for the rows after `values` when key columns may be NULL. A row-value
+    comparison is never true for NULLs, so the comparison is spelled out column by column, with
+    NULLs sorting last ascending and first descending, like ORDER BY.
+
+    :return: Returns a (condition, params) tuple.
+    """
+    clauses = []
+    params = []
+    for i, value in enumerate(values):
+        if value is None:
+            if not descending:
+                continue
+            later = f"{keys[i]} IS NOT NULL"
+        elif descending:
+            later = f"{keys[i]} < %s"
+        else:
+            later = f"({keys[i]} > %s OR {keys[i]} IS NULL)"
+        equal = []
+        for key, earlier in zip(keys[:i], values[:i]):
+            if earlier is None:
+                equal.append(f"{key} IS NULL")
+            else:
+                equal.append(f"{key} = %s")
+                params.append(earlier)
+        if value is not None:
+            params.append(value)
+        clauses.append("(" + " AND ".join(equal + [later]) + ")")
+    return "(" + " OR ".join(clauses or ["false"]) + ")", params
+
+
+def keyset_query(
+    select_list,
+    table_name,
+    conditions,
+    order_by,
+    descending,
+    limit,
+    after,
+    condition_params=None,
+    not_null=(),
+):
+    """
+    This is a helper function that builds a keyset-paginated SELECT. When the key columns are all
+    NOT NULL, rows after the `after` key are located with a row-value comparison on them, which an
+    index on those columns can answer with a seek instead of scanning past all earlier pages like
+    OFFSET would. Nullable key columns are compared one by one, so rows with NULL keys are not lost.
+
+    :param select_list: The `select_list` parameter is the SQL select list, e.g. "*".
+    :param table_name: The `table_name` parameter is a string that represents the name of the table.
+    :param conditions: The `conditions` parameter is an optional SQL condition string.
+    :param order_by: The `order_by` parameter is the list of key columns.
+    :param descending: The `descending` parameter sorts the pages in descending key order.
+    :param limit: The `limit` parameter is the page size.
+    :param after: The `after` parameter is the token of the previous page, or None for the first page.
+    :param condition_params: The `condition_params` parameter holds the parameters of `conditions` when
+    it is a compiled, parameterized condition.
+    :param not_null: The `not_null` parameter lists the table's columns that can't be NULL.
+    :return: Returns a (query, params) tuple, where params is None for the first page of a raw
+    condition. The key columns are appended to every row under
+    `KEY_PREFIX` aliases so `build_page` can find them even if the select list omits them.
+    """
+    keys = [utils.quote_ident(column) for column in order_by]
+    key_list = ", ".join(keys)
+    aliases = ", ".join(
+        f"{key} AS {utils.quote_ident(KEY_PREFIX + str(i))}" for i, key in enumerate(keys)
+    )
+
+    where = []
+    key_values = decode_token(after, order_by, descending) if after else None
+    params = list(condition_params) if condition_params is not None else None
+    if key_values:
+        if all(column in not_null for column in order_by):
+            placeholders = ", ".join(["%s"] * len(key_values))
+            after_key = f"({key_list}) {'<' if descending else '>'} ({placeholders})"
+            key_params = list(key_values)
+        else:
+            after_key, key_params = _after_nullable(keys, key_values, descending)
+        params = (params or []) + key_params
+    if conditions:
+        # With parameters the query goes through %-formatting, so literal percent signs in raw
+        # conditions must be escaped. Compiled conditions are escaped already.
+        if params is not None and condition_params is None:
+            conditions = conditions.replace("%", "%%")
+        where.append(f"({conditions})")
+    if key_values:
+        where.append(after_key)
+
+    direction = "DESC" if descending else "ASC"
+    query = f"SELECT {select_list}, {aliases} FROM {table_name}"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += " ORDER BY " + ", ".join(f"{key} {direction}" for key in keys)
+    # One extra row tells whether another page follows without a separate count query.
+    query += f" LIMIT {limit + 1}"
+    return query, params
+
+
+def build_page(columns, rows, order_by, descending, limit):
+    """
+    This is a helper function that turns the result of a `keyset_query` into a page of rows.
+
+    :param columns: The `columns` parameter is the list of result column names, key aliases included.
+    :param rows: The `rows` parameter is the list of fetched row tuples.
+    :param order_by: The `order_by` parameter is the list of key columns.
+    :param descending: The `descending` parameter tells whether the page was sorted descending.
+    :param limit: The `limit` parameter is the page size.
+    :return: Returns a dictionary with the page's `columns`, its `rows` as tuples and the `next`
+    token, which is None on the last page.
+    """
+    key_count = len(order_by)
+    columns = columns[:-key_count]
+
+    next_token = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_token = encode_token(order_by, descending, rows[-1][-key_count:])
+
+    return {
+        "columns": columns,
+        "rows": [row[:-key_count] for row in rows],
+        "next": next_token,
+    }
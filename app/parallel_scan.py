@@ -0,0 +1,316 @@
+import queue
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import app.config as config
+import app.params as params
+import app.streaming as streaming
+import app.utilities as utils
+from app.pool import pool
+from app.serializers import serializer
+
+# Postgres 14 added TID range scans, which read only the blocks of a ctid range; older servers
+# would scan the whole table once per part
+TID_RANGE_SCANS = 140000
+
+# The fewest blocks (8 KiB each by default) worth a part, and so a connection, of their own
+MIN_BLOCKS_PER_PART = 16
+
+# The table's kind, its size in blocks and the server's version
+PLAN_QUERY = """
+    SELECT c.relkind, pg_relation_size(c.oid) / current_setting('block_size')::bigint,
+           current_setting('server_version_num')::int
+    FROM pg_class c
+    WHERE c.oid = to_regclass(%s)
+"""
+
+# Marks the end of a part on the scan's queue
+_PART_DONE = object()
+
+
+def parse_parallel(value):
+    """
+    This is a helper function that validates the `parallel` request parameter.
+
+    :param value: The `value` parameter is true for the default parallelism, or a number of parts.
+    :return: Returns the number of parts to scan concurrently, or None for a serial scan.
+    :raises params.ParameterError: When the value is not true or a positive integer.
+    """
+    if value is None or value is False:
+        return None
+    if value is True:
+        value = config.PARALLEL_SCAN_WORKERS
+    elif not isinstance(value, int) or value <= 0:
+        raise params.ParameterError("parallel must be true or a positive integer")
+    # One connection of the key is left to the caller's other requests.
+    parts = min(value, config.PARALLEL_SCAN_MAX, pool.max_size - 1)
+    return parts if parts > 1 else None
+
+
+def block_ranges(blocks, parts):
+    """
+    This is a helper function that splits a table's blocks into ranges of about the same size.
+
+    :param blocks: The `blocks` parameter is the size of the table in blocks.
+    :param parts: The `parts` parameter is the largest number of ranges wanted.
+    :return: Returns the conditions that select the rows of each range by their `ctid`. The first
+    and the last range are open-ended, so rows in blocks added since the size was read are not
+    missed.
+    """
+    parts = max(1, min(parts, blocks // MIN_BLOCKS_PER_PART))
+    bounds = [None, *(blocks * part // parts for part in range(1, parts)), None]
+    conditions = []
+    for lower, upper in zip(bounds, bounds[1:]):
+        condition = []
+        if lower is not None:
+            condition.append(f"ctid >= '({lower},0)'::tid")
+        if upper is not None:
+            condition.append(f"ctid < '({upper},0)'::tid")
+        conditions.append(" AND ".join(condition) or "true")
+    return conditions
+
+
+class ParallelScan:
+    """
+    Reads a table over several pooled connections at once, each scanning its own range of the
+    table's blocks, in a thread pool. All parts see the same snapshot: the first connection exports
+    its snapshot and keeps its transaction open until the other connections have imported it, so
+    together they return exactly the rows of a single SELECT, in no particular order.
+
+    Each part runs a task that hands encoded chunks to `emit`. The chunks of all parts wait on
+    one queue of at most `PARALLEL_SCAN_QUEUE_SIZE` chunks, so the parts pause while the client is
+    slower than they are. Closing the scan cancels the parts that are still running.
+    """
+
+    def __init__(self, credentials, table_name, parts, queue_size=config.PARALLEL_SCAN_QUEUE_SIZE):
+        self.credentials = credentials
+        self.table_name = table_name
+        self.parts = parts
+        self.ranges = []
+        self.snapshot = None
+        self.coordinator = None
+        self.reserved = []
+        self.items = queue.Queue(maxsize=queue_size)
+        self.cancelled = threading.Event()
+        self._lock = threading.Condition()
+        self._active = set()
+        self._pending_imports = 0
+
+    def plan(self):
+        """
+        Checks out the first connection, splits the table into ranges, reserves a connection for
+        every other range without waiting for one, and exports the first connection's snapshot.
+        When the pool has fewer connections to spare, the table is split into fewer ranges.
+
+        :return: Returns the number of ranges, or 0 when the table can't be split (it is too small,
+        is not a plain table, the server has no TID range scans, or no second connection is free),
+        in which case nothing is held and the caller scans it serially.
+        """
+        conn = pool.getconn(*self.credentials)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            cursor.execute(PLAN_QUERY, (self.table_name,))
+            row = cursor.fetchone()
+            if row is not None and row[0] in ("r", "m") and row[2] >= TID_RANGE_SCANS:
+                self.ranges = block_ranges(row[1], self.parts)
+            while len(self.reserved) < len(self.ranges) - 1:
+                reserved = pool.getconn(*self.credentials, wait=False)
+                if reserved is None:
+                    self.ranges = block_ranges(row[1], len(self.reserved) + 1)
+                    break
+                self.reserved.append(reserved)
+            if len(self.ranges) < 2:
+                cursor.close()
+                pool.putconn(conn)
+                self._return_reserved()
+                return 0
+            cursor.execute("SELECT pg_export_snapshot()")
+            self.snapshot = cursor.fetchone()[0]
+            cursor.close()
+        except BaseException:
+            pool.putconn(conn, discard=bool(conn.closed))
+            self._return_reserved()
+            raise
+        self.coordinator = conn
+        return len(self.ranges)
+
+    def _return_reserved(self):
+        for conn in self.reserved:
+            pool.putconn(conn)
+        self.reserved = []
+
+    def start(self, task):
+        """
+        Starts a thread per range that runs `task(conn, condition, emit)`.
+
+        :param task: The `task` parameter scans the rows matching `condition` on `conn` and passes
+        its output to `emit`.
+        """
+        self._pending_imports = len(self.ranges) - 1
+        executor = ThreadPoolExecutor(max_workers=len(self.ranges), thread_name_prefix="oyda-scan")
+        executor.submit(self._part, task, self.ranges[0], self.coordinator)
+        for condition, conn in zip(self.ranges[1:], self.reserved):
+            executor.submit(self._part, task, condition, conn)
+        self.reserved = []
+        executor.shutdown(wait=False)
+
+    def emit(self, item):
+        streaming.put(self.items, item, self.cancelled)
+
+    def _join_snapshot(self, conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            cursor.execute("SET TRANSACTION SNAPSHOT %s", (self.snapshot,))
+            cursor.close()
+        finally:
+            with self._lock:
+                self._pending_imports -= 1
+                self._lock.notify_all()
+
+    def _part(self, task, condition, conn):
+        try:
+            if conn is not self.coordinator:
+                self._join_snapshot(conn)
+            with self._lock:
+                if self.cancelled.is_set():
+                    raise streaming.Cancelled()
+                self._active.add(conn)
+            task(conn, condition, self.emit)
+            if conn is self.coordinator:
+                # The exported snapshot lives as long as the coordinator's transaction.
+                with self._lock:
+                    while self._pending_imports and not self.cancelled.is_set():
+                        self._lock.wait(0.5)
+        except streaming.Cancelled:
+            self._release(conn)
+            return
+        except BaseException as e:
+            self._release(conn)
+            outcome = e
+        else:
+            self._release(conn)
+            outcome = _PART_DONE
+        try:
+            self.emit(outcome)
+        except streaming.Cancelled:
+            pass
+
+    def _release(self, conn):
+        if conn is None:
+            return
+        with self._lock:
+            self._active.discard(conn)
+            # A cancel request may still be on its way to the backend.
+            discard = self.cancelled.is_set()
+        pool.putconn(conn, discard=discard or bool(conn.closed))
+
+    def __iter__(self):
+        """
+        Yields the chunks of all parts as they arrive and raises the first error of a part.
+        """
+        remaining = len(self.ranges)
+        try:
+            while remaining:
+                item = self.items.get()
+                if item is _PART_DONE:
+                    remaining -= 1
+                elif isinstance(item, BaseException):
+                    raise item
+                else:
+                    yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Cancels the parts that are still running. Their connections are discarded.
+        """
+        with self._lock:
+            if self.cancelled.is_set():
+                return
+            self.cancelled.set()
+            self._lock.notify_all()
+            for conn in self._active:
+                try:
+                    conn.cancel()
+                except Exception:
+                    pass
+
+
+class ScanBody:
+    """
+    An iterable response body over the chunks of a parallel scan. The first chunk is awaited up
+    front, so that errors in the statement surface before the response starts.
+    """
+
+    def __init__(self, scan, head=b"", tail=b"", separator=b""):
+        self.scan = scan
+        self.head = head
+        self.tail = tail
+        self.separator = separator
+        self.chunks = iter(scan)
+        try:
+            self.first = next(self.chunks, None)
+        except BaseException:
+            scan.close()
+            raise
+
+    def __iter__(self):
+        try:
+            if self.head:
+                yield self.head
+            if self.first is not None:
+                yield self.first
+                for chunk in self.chunks:
+                    if self.separator:
+                        yield self.separator
+                    yield chunk
+            if self.tail:
+                yield self.tail
+        finally:
+            self.close()
+
+    def close(self):
+        self.scan.close()
+
+
+def scan_select(select):
+    """
+    This is a helper function that streams a select's rows from a parallel scan. Every part reads
+    its range on a named (server-side) cursor `fetch_size` rows at a time and encodes the batches
+    itself.
+
+    :param select: The `select` parameter is a validated `Select` with `stream` and `parallel` set.
+    :return: Returns the response body, or None when the table can't be split.
+    """
+    fetch_size = streaming.parse_fetch_size(select.fetch_size)
+    if select.where is not None:
+        with pool.connection(*select.credentials) as conn:
+            cursor = conn.cursor()
+            select.compile(utils.get_column_types(cursor, select.table_name))
+            cursor.close()
+
+    def task(conn, condition, emit):
+        cursor = conn.cursor(name=f"oyda_scan_{uuid.uuid4().hex}")
+        cursor.itersize = fetch_size
+        cursor.execute(*select.statement(condition))
+        columns = None
+        while True:
+            batch = cursor.fetchmany(fetch_size)
+            if not batch:
+                break
+            if columns is None:
+                columns = [desc[0] for desc in cursor.description]
+            emit(streaming.encode_batch(serializer, select.stream, columns, batch, True))
+        cursor.close()
+
+    scan = ParallelScan(select.credentials, select.table_name, select.parallel)
+    if not scan.plan():
+        return None
+    scan.start(task)
+    if select.stream == "json":
+        return ScanBody(scan, head=b"[", tail=b"]", separator=b",")
+    return ScanBody(scan)
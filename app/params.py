@@ -0,0 +1,55 @@
+import app.sessions as sessions
+
+CONNECTION_PARAMETERS = ("host", "oydaBase", "user", "password")
+DEFAULT_PORT = 5432
+
+
+class ParameterError(ValueError):
+    """
+    Raised when a request is missing a required parameter or combines parameters that can't be used
+    together.
+    """
+
+
+def missing(data, *names):
+    """
+    This is a helper function that checks a request body for required parameters, in order. A
+    request with a `session` token needs no connection parameters, but the session must be active.
+
+    :param data: The `data` parameter is the parsed request body.
+    :param names: The `names` parameter lists the required parameters.
+    :return: Returns the error message for the first missing parameter, or None if all are present.
+    """
+    token = data.get("session")
+    if isinstance(token, str):
+        if not sessions.session_store.is_active(token):
+            return "Invalid or expired session"
+        names = [name for name in names if name not in CONNECTION_PARAMETERS]
+    for name in names:
+        if not data.get(name):
+            return f"Missing required parameter: {name}"
+    return None
+
+
+def credentials(data):
+    """
+    This is a helper function that reads the connection parameters of a request body, or of the
+    session named by its `session` token.
+
+    :param data: The `data` parameter is the parsed request body.
+    :return: Returns a (host, port, oydaBase, user, password) tuple. For an unknown or expired
+    session, the tuple holds the parameters of the body, which `missing` then reports.
+    """
+    token = data.get("session")
+    resolved = sessions.session_store.resolve(token) if isinstance(token, str) else None
+    sessions.set_current(token if resolved is not None else None)
+    if resolved is not None:
+        return resolved
+
+    return (
+        data.get("host"),
+        data.get("port", DEFAULT_PORT),
+        data.get("oydaBase"),
+        data.get("user"),
+        data.get("password"),
+    )
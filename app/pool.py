@@ -0,0 +1,503 @@
+import contextvars
+import hashlib
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import psycopg2  # type: ignore
+from psycopg2 import extensions  # type: ignore
+
+import app.config as config
+import app.metrics as metrics
+import app.sessions as sessions
+
+
+class PoolExhausted(Exception):
+    """
+    Raised when no connection could be checked out before the checkout timeout expired.
+    """
+
+
+_pinned = contextvars.ContextVar("oyda_pinned_connection", default=None)
+
+# Returned by `_try_reserve` when the caller has to wait for capacity
+WAIT = object()
+
+
+class PinnedConnection:
+    """
+    A proxy for a connection shared by several operations, e.g. the operations of a batch.
+
+    When `transactional` is set, `commit` is deferred to the owner of the pin so that all
+    operations succeed or fail together.
+    """
+
+    def __init__(self, conn, transactional):
+        self._conn = conn
+        self._transactional = transactional
+
+    def commit(self):
+        if not self._transactional:
+            self._conn.commit()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class PooledConnection(extensions.connection):
+    """
+    A psycopg2 connection that carries the bookkeeping the pool needs to reuse it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = metrics.TimedCursor
+        self.pool_key = None
+        self.password_digest = None
+        self.session = None
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        # Server-side prepared statements of this session, SQL text to statement name, in LRU order
+        self.prepared = OrderedDict()
+
+
+class _KeyState:
+    """
+    The idle connections, counters and statistics kept for one (host, port, oydaBase, user) key.
+    """
+
+    def __init__(self):
+        self.idle = deque()
+        self.in_use = 0
+        self.pending = 0
+        self.password_digest = None
+        self.stats = {"hits": 0, "misses": 0, "waits": 0, "wait_time": 0.0}
+
+    @property
+    def size(self):
+        return self.in_use + self.pending + len(self.idle)
+
+
+def _digest(password):
+    return hashlib.sha256(password.encode("utf-8")).hexdigest()
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+class ConnectionPool:
+    """
+    A thread-safe pool of psycopg2 connections keyed by (host, port, oydaBase, user).
+
+    Each key holds between `min_size` and `max_size` connections and the pool never opens more
+    than `max_total` connections overall. Connections idle for longer than `idle_timeout` seconds
+    are closed (down to `min_size` per key) and connections idle for longer than
+    `health_check_after` seconds are pinged before being handed out again.
+    """
+
+    def __init__(
+        self,
+        min_size=config.POOL_MIN_SIZE,
+        max_size=config.POOL_MAX_SIZE,
+        max_total=config.POOL_MAX_TOTAL,
+        idle_timeout=config.POOL_IDLE_TIMEOUT,
+        health_check_after=config.POOL_HEALTH_CHECK_AFTER,
+        checkout_timeout=config.POOL_CHECKOUT_TIMEOUT,
+    ):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_total = max_total
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        self.checkout_timeout = checkout_timeout
+
+        self._cond = threading.Condition()
+        self._keys = {}
+        self._total = 0
+        self._last_sweep = time.monotonic()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "waits": 0,
+            "wait_time": 0.0,
+            "timeouts": 0,
+            "evictions": 0,
+            "health_check_failures": 0,
+            "discarded": 0,
+            "session_hits": 0,
+        }
+
+    @contextmanager
+    def connection(self, host, port, oydaBase, user, password):
+        """
+        Borrows a connection for the duration of a `with` block and returns it to the pool
+        afterwards. Any transaction left open by the block is rolled back, and connections that
+        broke while in use are discarded.
+
+        :param host: The `host` parameter is the hostname of the PostgreSQL server.
+        :param port: The `port` parameter is the port of the PostgreSQL server.
+        :param oydaBase: The `oydaBase` parameter is the name of the database.
+        :param user: The `user` parameter is the database user.
+        :param password: The `password` parameter is the password of the database user.
+        :return: Yields a psycopg2 connection, or the pinned connection inside a `pinned` block.
+        """
+        pinned = _pinned.get()
+        if pinned is not None:
+            yield pinned
+            return
+
+        conn = self.getconn(host, port, oydaBase, user, password)
+        try:
+            yield conn
+        except BaseException:
+            self.putconn(conn, discard=bool(conn.closed))
+            raise
+        else:
+            self.putconn(conn)
+
+    @contextmanager
+    def pinned(self, conn, transactional=False):
+        """
+        Makes every `connection` block inside this block use `conn` instead of borrowing from the
+        pool. The caller remains responsible for committing and returning `conn`.
+
+        :param conn: The `conn` parameter is a connection obtained from `getconn`.
+        :param transactional: The `transactional` parameter defers commits to the caller.
+        """
+        token = _pinned.set(PinnedConnection(conn, transactional))
+        try:
+            yield
+        finally:
+            _pinned.reset(token)
+
+    def is_pinned(self):
+        """
+        :return: Returns True inside a `pinned` block, e.g. while a batch is running.
+        """
+        return _pinned.get() is not None
+
+    def getconn(self, host, port, oydaBase, user, password, wait=True):
+        """
+        Checks out a connection for the given key, reusing an idle one when possible. Blocks while
+        the key or the whole pool is at capacity and raises `PoolExhausted` on timeout.
+
+        :param wait: The `wait` parameter, when False, returns None instead of waiting for capacity.
+        :return: Returns a psycopg2 connection that must be handed back with `putconn`.
+        """
+        key = (host, int(port), oydaBase, user)
+        digest = _digest(password)
+        deadline = time.monotonic() + self.checkout_timeout if wait else None
+
+        with metrics.phase("checkout"):
+            while True:
+                conn, to_close = self._reserve(key, digest, deadline)
+                for stale in to_close:
+                    _close_quietly(stale)
+
+                if conn is WAIT:
+                    return None
+                if conn is None:
+                    conn = self._open(key, digest, host, port, oydaBase, user, password)
+                    break
+                if self._healthy(conn):
+                    break
+                self.putconn(conn, discard=True)
+                with self._cond:
+                    self._stats["health_check_failures"] += 1
+        metrics.set_database(oydaBase)
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """
+        Returns a connection to the pool, rolling back any open transaction first.
+
+        :param conn: The `conn` parameter is a connection obtained from `getconn`.
+        :param discard: The `discard` parameter closes the connection instead of keeping it idle.
+        """
+        if not discard and not conn.closed:
+            try:
+                if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except psycopg2.Error:
+                discard = True
+        if self._release(conn, discard or bool(conn.closed)):
+            _close_quietly(conn)
+
+    def _release(self, conn, discard):
+        """
+        Hands a checked-in connection back to its key.
+
+        :return: Returns True if the caller must close the connection.
+        """
+        with self._cond:
+            state = self._keys[conn.pool_key]
+            state.in_use -= 1
+            self._cond.notify_all()
+            if discard or conn.password_digest != state.password_digest:
+                self._total -= 1
+                self._stats["discarded"] += 1
+                return True
+            conn.last_used = time.monotonic()
+            state.idle.append(conn)
+            return False
+
+    def authenticated(self, host, port, oydaBase, user, password):
+        """
+        Tells whether these credentials were accepted by the server for the current connections of
+        this key, so that answers served without a connection (e.g. from a cache) are not handed to
+        callers with a wrong password.
+
+        :return: Returns True if the password matches the one the key's connections were opened with.
+        """
+        key = (host, int(port), oydaBase, user)
+        with self._cond:
+            state = self._keys.get(key)
+            return state is not None and state.password_digest == _digest(password)
+
+    def stats(self, details=True):
+        """
+        Reports the pool's hit, miss and wait counters, both overall and per key.
+
+        :param details: The `details` parameter adds the per-key statistics, which name the users
+        and databases of the pool's clients.
+        :return: Returns a dictionary of pool statistics.
+        """
+        with self._cond:
+            stats = {
+                "total": self._total,
+                "idle": sum(len(state.idle) for state in self._keys.values()),
+                "in_use": sum(state.in_use for state in self._keys.values()),
+                "max_total": self.max_total,
+                **self._stats,
+            }
+            if details:
+                stats["keys"] = [
+                    {
+                        "key": f"{user}@{host}:{port}/{oydaBase}",
+                        "idle": len(state.idle),
+                        "in_use": state.in_use,
+                        **state.stats,
+                    }
+                    for (host, port, oydaBase, user), state in self._keys.items()
+                ]
+            return stats
+
+    def close_all(self):
+        """
+        Closes every idle connection. Connections that are checked out are closed when returned.
+        """
+        with self._cond:
+            to_close = []
+            for state in self._keys.values():
+                to_close.extend(state.idle)
+                state.idle.clear()
+            self._total -= len(to_close)
+            self._cond.notify_all()
+        for conn in to_close:
+            _close_quietly(conn)
+
+    def _reserve(self, key, digest, deadline):
+        """
+        Picks an idle connection or reserves a slot for a new one, waiting for capacity if needed.
+
+        :param deadline: The `deadline` parameter is when to stop waiting, or None not to wait.
+        :return: Returns `(conn, to_close)` where `conn` is an idle connection, None when the
+        caller must open a new one, or `WAIT` when there is no capacity and `deadline` is None,
+        and `to_close` are connections evicted along the way.
+        """
+        to_close = []
+        waited_since = None
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                conn = self._try_reserve(key, digest, now, waited_since, to_close)
+                if conn is not WAIT or deadline is None:
+                    return conn, to_close
+
+                if waited_since is None:
+                    waited_since = now
+                self._cond.wait(self._remaining(deadline, now))
+
+    def _try_reserve(self, key, digest, now, waited_since, to_close):
+        """
+        The non-blocking part of `_reserve`, shared with the async pool. Must be called while
+        holding `_cond`.
+
+        :return: Returns an idle connection, None when the caller must open a new one, or `WAIT`
+        when the key or the pool is at capacity. Evicted connections are added to `to_close`.
+        """
+        state = self._keys.get(key)
+        if state is None:
+            state = self._keys[key] = _KeyState()
+        to_close.extend(self._sweep(now))
+
+        # Idle connections are only handed to callers presenting the password they were
+        # authenticated with; anyone else has to authenticate against the server afresh.
+        reusable = state.password_digest == digest
+        if state.idle and reusable:
+            conn = self._pop_idle(state)
+            state.in_use += 1
+            self._record(state, "hits", waited_since, now)
+            return conn
+
+        if state.size >= self.max_size and state.idle and not reusable:
+            to_close.append(state.idle.popleft())
+            self._total -= 1
+            self._stats["evictions"] += 1
+
+        if state.size < self.max_size:
+            if self._total >= self.max_total:
+                victim = self._evict_lru(exclude=state)
+                if victim is not None:
+                    to_close.append(victim)
+            if self._total < self.max_total:
+                state.pending += 1
+                self._total += 1
+                self._record(state, "misses", waited_since, now)
+                return None
+        return WAIT
+
+    def _pop_idle(self, state):
+        """
+        Takes an idle connection of a key: the one the current request's session used last if it
+        is idle, so that the session keeps its prepared statements, otherwise the most recently
+        used one. Must be called while holding `_cond`.
+        """
+        session = sessions.current()
+        if session is not None:
+            for index in range(len(state.idle) - 1, -1, -1):
+                if state.idle[index].session == session:
+                    conn = state.idle[index]
+                    del state.idle[index]
+                    self._stats["session_hits"] += 1
+                    return conn
+        conn = state.idle.pop()
+        conn.session = session
+        return conn
+
+    def _remaining(self, deadline, now):
+        """
+        :return: Returns the seconds left until `deadline`.
+        :raises PoolExhausted: When the deadline has passed. Must be called while holding `_cond`.
+        """
+        remaining = deadline - now
+        if remaining <= 0:
+            self._stats["timeouts"] += 1
+            raise PoolExhausted(f"Timed out after {self.checkout_timeout}s waiting for a connection")
+        return remaining
+
+    def _open(self, key, digest, host, port, oydaBase, user, password):
+        try:
+            conn = psycopg2.connect(
+                dbname=oydaBase,
+                user=user,
+                password=password,
+                host=host,
+                port=port,
+                connection_factory=PooledConnection,
+            )
+        except BaseException:
+            self._open_failed(key)
+            raise
+
+        for stale in self._opened(key, digest, conn):
+            _close_quietly(stale)
+        return conn
+
+    def _open_failed(self, key):
+        with self._cond:
+            self._keys[key].pending -= 1
+            self._total -= 1
+            self._cond.notify_all()
+
+    def _opened(self, key, digest, conn):
+        """
+        Records a newly opened connection as checked out.
+
+        :return: Returns the idle connections the caller must close because they were opened with
+        other credentials.
+        """
+        conn.pool_key = key
+        conn.password_digest = digest
+        conn.session = sessions.current()
+        to_close = []
+        with self._cond:
+            state = self._keys[key]
+            state.pending -= 1
+            state.in_use += 1
+            if state.password_digest != digest:
+                # The credentials were accepted by the server, so they replace any previous ones.
+                state.password_digest = digest
+                to_close.extend(state.idle)
+                self._total -= len(state.idle)
+                state.idle.clear()
+        return to_close
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.monotonic() - conn.last_used < self.health_check_after:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _record(self, state, outcome, waited_since, now):
+        state.stats[outcome] += 1
+        self._stats[outcome] += 1
+        if waited_since is not None:
+            state.stats["waits"] += 1
+            state.stats["wait_time"] += now - waited_since
+            self._stats["waits"] += 1
+            self._stats["wait_time"] += now - waited_since
+
+    def _sweep(self, now):
+        """
+        Removes connections that have been idle for longer than `idle_timeout`, keeping at least
+        `min_size` per key. Runs at most once per second.
+        """
+        if now - self._last_sweep < 1.0:
+            return []
+        self._last_sweep = now
+        evicted = []
+        for state in self._keys.values():
+            while (
+                len(state.idle) > self.min_size
+                and now - state.idle[0].last_used > self.idle_timeout
+            ):
+                evicted.append(state.idle.popleft())
+        self._total -= len(evicted)
+        self._stats["evictions"] += len(evicted)
+        return evicted
+
+    def _evict_lru(self, exclude):
+        """
+        Frees a slot under the global cap by removing the least recently used idle connection
+        belonging to another key.
+        """
+        victim_state = None
+        for state in self._keys.values():
+            if state is exclude or not state.idle:
+                continue
+            if victim_state is None or state.idle[0].last_used < victim_state.idle[0].last_used:
+                victim_state = state
+        if victim_state is None:
+            return None
+        self._total -= 1
+        self._stats["evictions"] += 1
+        return victim_state.idle.popleft()
+
+
+pool = ConnectionPool()
@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import app.config as config
+
+
+class PackageResolver:
+    """
+    Resolves the latest version of pub.dev packages.
+
+    Requests share one keep-alive session and time out after `timeout` seconds. Resolved versions
+    are kept in an LRU cache of `cache_size` entries for `ttl` seconds; failed lookups are not cached.
+    """
+
+    def __init__(
+        self,
+        base_url=config.PUBDEV_URL,
+        timeout=config.PUBDEV_TIMEOUT,
+        ttl=config.PUBDEV_CACHE_TTL,
+        cache_size=config.PUBDEV_CACHE_SIZE,
+        workers=config.PUBDEV_WORKERS,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.workers = workers
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    def latest_version(self, package_name):
+        """
+        Looks up the latest version of a package, from the cache if possible.
+
+        :param package_name: The `package_name` parameter is the name of the pub.dev package.
+        :return: Returns the latest version, or None if pub.dev did not return the package.
+        :raises requests.RequestException: When pub.dev could not be reached in time.
+        """
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(package_name)
+            if cached is not None and cached[1] > now:
+                self._cache.move_to_end(package_name)
+                return cached[0]
+
+        response = self.session.get(
+            f"{self.base_url}/{quote(package_name, safe='')}", timeout=self.timeout
+        )
+        if response.status_code != 200:
+            return None
+        version = response.json()["latest"]["version"]
+
+        with self._lock:
+            self._cache[package_name] = (version, time.monotonic() + self.ttl)
+            self._cache.move_to_end(package_name)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return version
+
+    def latest_versions(self, package_names):
+        """
+        Looks up the latest versions of several packages concurrently.
+
+        :param package_names: The `package_names` parameter is a list of pub.dev package names.
+        :return: Returns a (versions, errors) tuple of dictionaries keyed by package name.
+        """
+        versions = {}
+        errors = {}
+        if not package_names:
+            return versions, errors
+
+        def resolve(package_name):
+            try:
+                return package_name, self.latest_version(package_name), None
+            except (requests.RequestException, ValueError, KeyError) as e:
+                return package_name, None, e
+
+        workers = min(self.workers, len(package_names))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for package_name, version, error in executor.map(resolve, package_names):
+                if error is not None:
+                    errors[package_name] = f"Failed to fetch package {package_name} from pub.dev: {error}"
+                elif version is None:
+                    errors[package_name] = f"Failed to fetch package {package_name} from pub.dev"
+                else:
+                    versions[package_name] = version
+        return versions, errors
+
+
+resolver = PackageResolver()
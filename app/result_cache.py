@@ -0,0 +1,208 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response
+
+import app.config as config
+from app.pool import pool
+
+
+def normalize_query(query):
+    """
+    This is a helper function that normalizes whitespace and trailing semicolons in a query so that
+    equivalent requests share a cache entry.
+
+    :param query: The `query` parameter is the SQL text.
+    :return: Returns the normalized SQL text.
+    """
+    return " ".join(query.split()).rstrip(";").strip()
+
+
+def normalize_table(table_name):
+    """
+    This is a helper function that maps the spellings of a table name to one invalidation key.
+
+    :param table_name: The `table_name` parameter is a string that represents the name of the table.
+    :return: Returns the lower-cased table name without a `public.` prefix.
+    """
+    name = table_name.strip().lower()
+    return name[len("public."):] if name.startswith("public.") else name
+
+
+class ResultCache:
+    """
+    A read-through cache of serialized select results, keyed by (database, normalized query, params).
+
+    Entries are evicted least recently used once their bodies exceed `max_bytes` in total and
+    expire after the TTL configured for their table. Writes through the API invalidate every entry
+    of the written table. Each table also has a generation counter, so a result that was read
+    before a concurrent write committed is not stored after that write's invalidation.
+    """
+
+    def __init__(
+        self,
+        max_bytes=config.RESULT_CACHE_MAX_BYTES,
+        default_ttl=config.RESULT_CACHE_TTL,
+        table_ttls=config.RESULT_CACHE_TABLE_TTLS,
+    ):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.table_ttls = {normalize_table(table): ttl for table, ttl in table_ttls.items()}
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._by_table = {}
+        self._generations = {}
+        self._bytes = 0
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "invalidations": 0}
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _applies(self, table_name):
+        # Pinned connections belong to batches, whose reads may see uncommitted writes.
+        return self.enabled and self.ttl(table_name) > 0 and not pool.is_pinned()
+
+    def ttl(self, table_name):
+        return self.table_ttls.get(normalize_table(table_name), self.default_ttl)
+
+    def _key(self, credentials, query, params):
+        host, port, oydaBase, user, _ = credentials
+        return (
+            (host, int(port), oydaBase, user),
+            normalize_query(query),
+            json.dumps(params, sort_keys=True, default=str),
+        )
+
+    def _table_key(self, credentials, table_name):
+        host, port, oydaBase = credentials[:3]
+        return (host, int(port), oydaBase, normalize_table(table_name))
+
+    def get(self, credentials, table_name, query, params=None):
+        """
+        Looks up a cached result. Results are only served to callers whose credentials the pool
+        has already verified against the server.
+
+        :param credentials: The `credentials` parameter is a (host, port, oydaBase, user, password) tuple.
+        :param table_name: The `table_name` parameter is a string that represents the name of the table.
+        :param query: The `query` parameter is the SQL text of the select.
+        :param params: The `params` parameter holds anything else that shapes the result.
+        :return: Returns a response with the cached body, or None on a miss.
+        """
+        entry = self.lookup(credentials, table_name, query, params)
+        return Response(entry[0], mimetype=entry[1]) if entry is not None else None
+
+    def lookup(self, credentials, table_name, query, params=None, connections=pool):
+        """
+        Looks up a cached result like `get`, without building a response.
+
+        :param connections: The `connections` parameter is the pool that verifies the credentials.
+        :return: Returns a (body, mimetype) tuple, or None on a miss.
+        """
+        if not self._applies(table_name):
+            return None
+        if not connections.authenticated(*credentials):
+            return None
+
+        key = self._key(credentials, query, params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+        return entry[0], entry[3]
+
+    def generation(self, credentials, table_name):
+        """
+        :return: Returns the table's current generation, to be passed to `put` after the query.
+        """
+        with self._lock:
+            return self._generations.get(self._table_key(credentials, table_name), 0)
+
+    def put(self, credentials, table_name, query, params, generation, response):
+        """
+        Stores the body of a response unless the table was written since `generation`.
+
+        :param credentials: The `credentials` parameter is a (host, port, oydaBase, user, password) tuple.
+        :param table_name: The `table_name` parameter is a string that represents the name of the table.
+        :param query: The `query` parameter is the SQL text of the select.
+        :param params: The `params` parameter holds anything else that shapes the result.
+        :param generation: The `generation` parameter is the value `generation` returned before the query.
+        :param response: The `response` parameter is the response to cache.
+        """
+        if response.status_code == 200:
+            self.store(
+                credentials, table_name, query, params, generation, response.get_data(), response.mimetype
+            )
+
+    def store(self, credentials, table_name, query, params, generation, body, mimetype):
+        """
+        Stores an encoded result like `put`.
+
+        :param body: The `body` parameter is the encoded result.
+        :param mimetype: The `mimetype` parameter is the media type of the body.
+        """
+        if not self._applies(table_name) or len(body) > self.max_bytes:
+            return
+
+        key = self._key(credentials, query, params)
+        table_key = self._table_key(credentials, table_name)
+        with self._lock:
+            if self._generations.get(table_key, 0) != generation:
+                return
+            self._remove(key)
+            self._entries[key] = (body, time.monotonic() + self.ttl(table_name), table_key, mimetype)
+            self._by_table.setdefault(table_key, set()).add(key)
+            self._bytes += len(body)
+            self._stats["stores"] += 1
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def invalidate(self, credentials, table_name):
+        """
+        Drops every cached result of a table, for all users of the database.
+
+        :param credentials: The `credentials` parameter is a (host, port, oydaBase, ...) tuple.
+        :param table_name: The `table_name` parameter is a string that represents the name of the table.
+        """
+        table_key = self._table_key(credentials, table_name)
+        with self._lock:
+            self._generations[table_key] = self._generations.get(table_key, 0) + 1
+            for key in list(self._by_table.pop(table_key, ())):
+                self._remove(key)
+            self._stats["invalidations"] += 1
+
+    def stats(self):
+        """
+        Reports the cache's hit ratio, size and counters.
+
+        :return: Returns a dictionary of cache statistics.
+        """
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hit_ratio": self._stats["hits"] / lookups if lookups else None,
+                **self._stats,
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= len(entry[0])
+        keys = self._by_table.get(entry[2])
+        if keys is not None:
+            keys.discard(key)
+
+
+result_cache = ResultCache()
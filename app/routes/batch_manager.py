@@ -0,0 +1,136 @@
+from flask import Blueprint, request, jsonify, current_app
+import psycopg2  # type: ignore
+import json
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder
+
+import app.utilities as utils
+import app.params as params
+import app.serializers as serializers
+from app.pool import pool
+from app.schema_cache import schema_cache
+from app.result_cache import result_cache
+
+batch_bp = Blueprint("batch_manager", __name__)
+
+CONNECTION_PARAMETERS = ("host", "port", "oydaBase", "user", "password")
+
+# Tables written by operations that don't take a `table_name`
+OPERATION_TABLES = {
+    "set_oydabase": "devs",
+    "add_dependency": "dependencies",
+    "add_dependencies": "dependencies",
+}
+
+# Operations whose responses are not JSON, or hold resources until their body is consumed
+UNBATCHED_OPERATIONS = {"export_table", "import_table", "subscribe"}
+
+
+def run_operation(name, payload):
+    """
+    This is a helper function that runs one batch operation through the existing `/api/<name>`
+    handler, as if the payload had been posted to it.
+
+    :param name: The `name` parameter is the endpoint name, e.g. "insert_row".
+    :param payload: The `payload` parameter is the request body for that endpoint.
+    :return: Returns a (status code, JSON body) tuple. Responses that are not JSON are reported as
+    a failed operation.
+    """
+    path = f"/api/{name}"
+    try:
+        endpoint, _ = current_app.url_map.bind("").match(path, method="POST")
+    except HTTPException:
+        return 400, {"error": f"Unknown operation: {name}"}
+    if endpoint == request.endpoint:
+        return 400, {"error": "Batches cannot be nested"}
+
+    builder = EnvironBuilder(path=path, method="POST", json=payload)
+    try:
+        with current_app.request_context(builder.get_environ()):
+            response = current_app.make_response(current_app.view_functions[endpoint]())
+    finally:
+        builder.close()
+    try:
+        if not response.is_json:
+            return 400, {"error": f"Operation {name} must return JSON"}
+        return response.status_code, response.get_json(silent=True)
+    finally:
+        # Releases whatever a streamed body holds, e.g. a connection or a thread.
+        response.close()
+
+
+@batch_bp.route("/api/batch", methods=["POST"])
+def batch():
+    """
+    The function `batch` runs an ordered list of operations on a single pooled connection. Each
+    operation names an endpoint (`"op": "insert_row"`) and carries that endpoint's usual payload;
+    the connection parameters are given once for the whole batch. With `transaction` set, the
+    operations run in one transaction that is committed only if every operation succeeds.
+    :return: Returns a JSON response with the status and body of each operation. If a transactional
+    batch fails, nothing is committed and the status of the failing operation is returned.
+    """
+    if not request.data:
+        return jsonify({"error": "No data provided"}), 400
+    try:
+        data = json.loads(request.data)
+
+        host, port, oydaBase, user, password = params.credentials(data)
+        operations = data.get("operations")
+        transaction = bool(data.get("transaction", False))
+
+        error = params.missing(data, *params.CONNECTION_PARAMETERS)
+        if error:
+            return jsonify({"error": error}), 400
+        if not isinstance(operations, list) or not operations:
+            return jsonify({"error": "Missing required parameter: operations"}), 400
+        for index, operation in enumerate(operations):
+            if not isinstance(operation, dict) or not operation.get("op"):
+                return jsonify({"error": f"Operation {index} is missing op"}), 400
+            if operation["op"] in UNBATCHED_OPERATIONS:
+                return jsonify({"error": f"Operation {index} cannot be batched"}), 400
+            if operation.get("stream"):
+                return jsonify({"error": f"Operation {index} cannot stream"}), 400
+            if operation.get("format", "rows") not in serializers.JSON_FORMATS:
+                return jsonify({"error": f"Operation {index} must return JSON"}), 400
+
+        # Operations get the batch's resolved connection parameters, also when it used a session.
+        credentials = dict(zip(CONNECTION_PARAMETERS, (host, port, oydaBase, user, password)))
+
+        results = []
+        conn = pool.getconn(host, port, oydaBase, user, password)
+        try:
+            with pool.pinned(conn, transactional=transaction):
+                for index, operation in enumerate(operations):
+                    payload = {k: v for k, v in operation.items() if k != "op"}
+                    payload.update(credentials)
+                    status, body = run_operation(operation["op"], payload)
+                    results.append({"op": operation["op"], "status": status, "body": body})
+
+                    if status < 400:
+                        continue
+                    conn.rollback()
+                    if transaction:
+                        # Tables created inside the rolled back transaction may have been cached.
+                        schema_cache.invalidate(conn.cursor())
+                        utils.bootstrapped_oydabases.discard((host, int(port), oydaBase))
+                        message = f"Operation {index} ({operation['op']}) failed; batch rolled back"
+                        return (
+                            jsonify({"error": message, "results": results, "committed": False}),
+                            status,
+                        )
+
+            conn.commit()
+            # Reads outside the batch may have cached rows that were replaced by this commit.
+            for operation in operations:
+                table_name = operation.get("table_name") or OPERATION_TABLES.get(operation["op"])
+                if table_name:
+                    result_cache.invalidate((host, port, oydaBase), table_name)
+        finally:
+            pool.putconn(conn, discard=bool(conn.closed))
+
+        return jsonify({"results": results, "committed": True}), 200
+
+    except psycopg2.DatabaseError as e:
+        return jsonify({"error": f"Database error: {e}"}), 500
+    except Exception as e:
+        return jsonify({"error": f"Error: {e}"}), 500
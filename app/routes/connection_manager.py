@@ -1,9 +1,20 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify
 import psycopg2  # type: ignore
-import json, random
-import requests
+import hmac, json, random
+from psycopg2.extras import execute_values  # type: ignore
 
+import app.config as config
 import app.utilities as utils
+import app.params as params
+import app.pubdev as pubdev
+from app.change_feed import change_feed
+from app.metrics import metrics
+from app.pool import pool
+from app.result_cache import result_cache
+from app.sessions import session_store
+from app.slow_queries import slow_query_log
+from app.table_versions import table_versions
+import app.table_versions as versions
 
 connections_bp = Blueprint("connection_manager", __name__)
 
@@ -12,73 +23,90 @@ connections_bp = Blueprint("connection_manager", __name__)
 def set_oydabase():
     """
     The function `set_oydabase` establishes a connection to a oydabase, creates dependency
-    and dev tables if they don't exist, and manages developer keys for a given username.
+    and dev tables if they don't exist, and manages developer keys for a given username. The
+    tables are only set up on the first call per oydabase in this process. With `"session": true`,
+    it also starts a session whose token other endpoints accept in place of the credentials.
 
     :return: Returns a JSON response with a message indicating the successful connection to the
     oydabase and the creation of the dependencies table. The response also includes the
-    developer key for the given username.
+    developer key for the given username, and the session token and its idle timeout if one was
+    requested.
     """
     if not request.data:
         return jsonify({"error": "No data provided"}), 400
     try:
         data = json.loads(request.data)
 
-        host = data.get("host")
-        port = data.get("port", 5432)
-        oydaBase = data.get("oydaBase")
-        user = data.get("user")
-        password = data.get("password")
-
-        if not host:
-            return jsonify({"error": "Missing required parameter: host"}), 400
-        if not oydaBase:
-            return jsonify({"error": "Missing required parameter: oydaBase"}), 400
-        if not user:
-            return jsonify({"error": "Missing required parameter: user"}), 400
-        if not password:
-            return jsonify({"error": "Missing required parameter: password"}), 400
-
-        conn = psycopg2.connect(
-            dbname=oydaBase, user=user, password=password, host=host, port=port
-        )
-        cursor = conn.cursor()
+        host, port, oydaBase, user, password = params.credentials(data)
 
-        # Check for dependencies table
-        if not utils.check_table_exists(cursor, "dependencies"):
-            utils.create_dependencies_table(cursor)
-            conn.commit()
-            cursor.execute("GRANT ALL PRIVILEGES ON TABLE dependencies TO PUBLIC;")
-            conn.commit()
-            message = f"Connected to Oydabase @ {host}:{port}/{oydaBase}. Dependencies table created"
-        else:
-            message = (
-                f"Connected to Oydabase @ {host}:{port}/{oydaBase}: Dependencies exist"
-            )
+        error = params.missing(data, *params.CONNECTION_PARAMETERS)
+        if error:
+            return jsonify({"error": error}), 400
 
-        # Check for devs table
-        if not utils.check_table_exists(cursor, "devs"):
-            utils.create_devs_table(cursor)
-            conn.commit()
-            cursor.execute("GRANT ALL PRIVILEGES ON TABLE devs TO PUBLIC;")
-            conn.commit()
+        with pool.connection(host, port, oydaBase, user, password) as conn:
+            cursor = conn.cursor()
 
-        # Handle developer keys
-        dev_key = utils.get_or_create_dev_key(cursor, user)
-        conn.commit()
+            # Create the dependencies and devs tables once per oydabase
+            oydabase_key = (host, int(port), oydaBase)
+            if oydabase_key in utils.bootstrapped_oydabases:
+                created = False
+            else:
+                created = not utils.check_table_exists(cursor, "dependencies")
+                utils.bootstrap_oydabase(cursor)
+                conn.commit()
+                utils.bootstrapped_oydabases.add(oydabase_key)
 
-        cursor.close()
-        conn.close()
+            if created:
+                message = f"Connected to Oydabase @ {host}:{port}/{oydaBase}. Dependencies table created"
+            else:
+                message = (
+                    f"Connected to Oydabase @ {host}:{port}/{oydaBase}: Dependencies exist"
+                )
 
-        return jsonify({"message": message, "dev_key": dev_key}), 200
+            # Handle developer keys; the allocation is a single statement, so let it commit itself
+            conn.autocommit = True
+            dev_key = utils.get_or_create_dev_key(cursor, user)
+            conn.commit()
+            result_cache.invalidate((host, port, oydaBase), "devs")
+
+            cursor.close()
+
+        result = {"message": message, "dev_key": dev_key}
+        if data.get("session") is True:
+            # The connection above succeeded, so the server has accepted these credentials.
+            result["session"] = session_store.create((host, port, oydaBase, user, password))
+            result["session_ttl"] = session_store.ttl
+        return jsonify(result), 200
 
     except (Exception, psycopg2.DatabaseError) as e:
         return jsonify({"error": f"{e}"}), 500
 
 
+@connections_bp.route("/api/end_session", methods=["POST"])
+def end_session():
+    """
+    The function `end_session` ends a session started by `set_oydabase`, so that its token is no
+    longer accepted.
+
+    :return: Returns a JSON response with a message indicating whether the session was ended.
+    """
+    if not request.data:
+        return jsonify({"error": "No data provided"}), 400
+    data = json.loads(request.data)
+    token = data.get("session")
+    if not isinstance(token, str) or not token:
+        return jsonify({"error": "Missing required parameter: session"}), 400
+    if not session_store.end(token):
+        return jsonify({"error": "Invalid or expired session"}), 400
+    return jsonify({"message": "Session ended"}), 200
+
+
 @connections_bp.route("/api/get_dependencies", methods=["POST"])
 def get_dependencies():
     """
     The function `get_dependencies` retrieves the dependencies from the dependencies table in the oydabase.
+    Responses carry an ETag derived from the table's version; a request whose `If-None-Match` names
+    it is answered with 304 Not Modified without reading the table.
 
     :return: Returns a JSON response with the dependencies from the oydabase if they exist.
     """
@@ -87,38 +115,37 @@ def get_dependencies():
     try:
         data = json.loads(request.data)
 
-        host = data.get("host")
-        port = data.get("port", 5432)
-        oydaBase = data.get("oydaBase")
-        user = data.get("user")
-        password = data.get("password")
-
-        if not host:
-            return jsonify({"error": "Missing required parameter: host"}), 400
-        if not oydaBase:
-            return jsonify({"error": "Missing required parameter: oydaBase"}), 400
-        if not user:
-            return jsonify({"error": "Missing required parameter: user"}), 400
-        if not password:
-            return jsonify({"error": "Missing required parameter: password"}), 400
-
-        conn = psycopg2.connect(
-            dbname=oydaBase, user=user, password=password, host=host, port=port
-        )
-        cursor = conn.cursor()
+        host, port, oydaBase, user, password = params.credentials(data)
 
-        cursor.execute("SELECT name, version FROM dependencies")
-        dependencies = cursor.fetchall()
+        error = params.missing(data, *params.CONNECTION_PARAMETERS)
+        if error:
+            return jsonify({"error": error}), 400
 
-        if not dependencies:
-            return jsonify({"dependencies": "No dependencies found"}), 200
+        generation = result_cache.generation((host, port, oydaBase), "dependencies")
+        with pool.connection(host, port, oydaBase, user, password) as conn:
+            cursor = conn.cursor()
 
-        cursor.close()
-        conn.close()
+            etag = None
+            version = table_versions.version(cursor, "dependencies")
+            if version is not None:
+                etag = versions.etag("get_dependencies", (host, port, oydaBase, user), version, generation)
+            if versions.matches(request.headers.get("If-None-Match"), etag):
+                response = Response(status=304)
+            else:
+                cursor.execute("SELECT name, version FROM dependencies")
+                dependencies = cursor.fetchall()
+
+                if not dependencies:
+                    response = jsonify({"dependencies": "No dependencies found"})
+                else:
+                    dependencies_list = [f"{name}: {version}" for name, version in dependencies]
+                    response = jsonify({"dependencies": dependencies_list})
 
-        dependencies_list = [f"{name}: {version}" for name, version in dependencies]
+            cursor.close()
 
-        return jsonify({"dependencies": dependencies_list}), 200
+            if etag is not None:
+                response.set_etag(etag, weak=True)
+            return response
 
     except (Exception, psycopg2.DatabaseError) as e:
         return jsonify({"error": f"{e}"}), 500
@@ -127,7 +154,8 @@ def get_dependencies():
 @connections_bp.route("/api/add_dependency", methods=["POST"])
 def add_dependency():
     """
-    The function `add_dependency` adds a package to the dependencies table in the oydabase.
+    The function `add_dependency` adds a package to the dependencies table in the oydabase. The
+    latest version is resolved on pub.dev through the shared, cached package resolver.
 
     :return: Returns a JSON response with a message indicating the successful addition of the package or its version if it already exists.
     """
@@ -136,32 +164,21 @@ def add_dependency():
     try:
         data = json.loads(request.data)
 
-        host = data.get("host")
-        port = data.get("port", 5432)
-        oydaBase = data.get("oydaBase")
-        user = data.get("user")
-        password = data.get("password")
+        host, port, oydaBase, user, password = params.credentials(data)
         package_name = data.get("package_name")
 
-        if not host:
-            return jsonify({"error": "Missing required parameter: host"}), 400
-        if not oydaBase:
-            return jsonify({"error": "Missing required parameter: oydaBase"}), 400
-        if not user:
-            return jsonify({"error": "Missing required parameter: user"}), 400
-        if not password:
-            return jsonify({"error": "Missing required parameter: password"}), 400
-
-        conn = psycopg2.connect(
-            dbname=oydaBase, user=user, password=password, host=host, port=port
-        )
+        error = params.missing(data, *params.CONNECTION_PARAMETERS)
+        if error:
+            return jsonify({"error": error}), 400
 
-        cursor = conn.cursor()
+        with pool.connection(host, port, oydaBase, user, password) as conn:
+            cursor = conn.cursor()
 
-        cursor.execute(
-            "SELECT version FROM dependencies WHERE name = %s", (package_name,)
-        )
-        result = cursor.fetchone()
+            cursor.execute(
+                "SELECT version FROM dependencies WHERE name = %s", (package_name,)
+            )
+            result = cursor.fetchone()
+            cursor.close()
 
         if result:
             package_version = result[0]
@@ -173,35 +190,172 @@ def add_dependency():
                 ),
                 200,
             )
-        else:
-            response = requests.get(f"https://pub.dev/api/packages/{package_name}")
-            if response.status_code == 200:
-                package_info = response.json()
-                package_version = package_info["latest"]["version"]
-
-                cursor.execute(
-                    "INSERT INTO dependencies (name, version) VALUES (%s, %s)",
-                    (package_name, package_version),
+
+        # Resolve the version without holding a connection while pub.dev responds
+        package_version = pubdev.resolver.latest_version(package_name)
+        if package_version is None:
+            return (
+                jsonify(
+                    {
+                        "error": f"Failed to fetch package {package_name} from pub.dev"
+                    }
+                ),
+                400,
+            )
+
+        with pool.connection(host, port, oydaBase, user, password) as conn:
+            cursor = conn.cursor()
+
+            cursor.execute(
+                "INSERT INTO dependencies (name, version) VALUES (%s, %s)",
+                (package_name, package_version),
+            )
+            conn.commit()
+            result_cache.invalidate((host, port, oydaBase), "dependencies")
+            cursor.close()
+
+        return (
+            jsonify(
+                {
+                    "message": f"Package {package_name} added with version {package_version}"
+                }
+            ),
+            201,
+        )
+
+    except (Exception, psycopg2.DatabaseError) as e:
+        return jsonify({"error": f"{e}"}), 500
+
+
+@connections_bp.route("/api/add_dependencies", methods=["POST"])
+def add_dependencies():
+    """
+    The function `add_dependencies` adds several packages to the dependencies table in the oydabase.
+    Packages that are not in the table yet are resolved on pub.dev concurrently and inserted with a
+    single statement.
+
+    :return: Returns a JSON response listing the packages that were added, those that already
+    existed with their versions, and those that could not be resolved on pub.dev.
+    """
+    if not request.data:
+        return jsonify({"error": "No data provided"}), 400
+    try:
+        data = json.loads(request.data)
+
+        host, port, oydaBase, user, password = params.credentials(data)
+        package_names = data.get("package_names")
+
+        error = params.missing(data, *params.CONNECTION_PARAMETERS)
+        if error:
+            return jsonify({"error": error}), 400
+        if not isinstance(package_names, list) or not package_names:
+            return jsonify({"error": "Missing required parameter: package_names"}), 400
+
+        package_names = list(dict.fromkeys(package_names))
+
+        with pool.connection(host, port, oydaBase, user, password) as conn:
+            cursor = conn.cursor()
+
+            cursor.execute(
+                "SELECT name, version FROM dependencies WHERE name = ANY(%s)",
+                (package_names,),
+            )
+            existing = dict(cursor.fetchall())
+            cursor.close()
+
+        # Resolve the missing packages without holding a connection while pub.dev responds
+        missing = [name for name in package_names if name not in existing]
+        added, failed = pubdev.resolver.latest_versions(missing)
+
+        if added:
+            with pool.connection(host, port, oydaBase, user, password) as conn:
+                cursor = conn.cursor()
+
+                execute_values(
+                    cursor,
+                    "INSERT INTO dependencies (name, version) VALUES %s",
+                    list(added.items()),
+                    page_size=len(added),
                 )
                 conn.commit()
+                result_cache.invalidate((host, port, oydaBase), "dependencies")
+                cursor.close()
 
-                return (
-                    jsonify(
-                        {
-                            "message": f"Package {package_name} added with version {package_version}"
-                        }
-                    ),
-                    201,
-                )
-            else:
-                return (
-                    jsonify(
-                        {
-                            "error": f"Failed to fetch package {package_name} from pub.dev"
-                        }
-                    ),
-                    400,
-                )
+        return (
+            jsonify({"added": added, "existing": existing, "failed": failed}),
+            201 if added else 200,
+        )
 
     except (Exception, psycopg2.DatabaseError) as e:
         return jsonify({"error": f"{e}"}), 500
+
+
+def stats_details():
+    """
+    This is a helper function that decides whether a statistics request may see details that name
+    the databases and users of other clients.
+
+    :return: Returns True if `OYDA_STATS_TOKEN` is set and the request carries it as a bearer token.
+    """
+    if not config.STATS_TOKEN:
+        return False
+    expected = f"Bearer {config.STATS_TOKEN}".encode("utf-8")
+    return hmac.compare_digest(request.headers.get("Authorization", "").encode("utf-8"), expected)
+
+
+@connections_bp.route("/api/pool_stats", methods=["GET"])
+def pool_stats():
+    """
+    The function `pool_stats` reports the connection pool's hit, miss and wait statistics.
+
+    :return: Returns a JSON response with the overall pool statistics, and those of the sessions
+    and change subscriptions. The per-key statistics are only included for requests with the
+    statistics token.
+    """
+    return (
+        jsonify(
+            {
+                **pool.stats(details=stats_details()),
+                "sessions": session_store.stats(),
+                "subscriptions": change_feed.stats(),
+            }
+        ),
+        200,
+    )
+
+
+@connections_bp.route("/api/cache_stats", methods=["GET"])
+def cache_stats():
+    """
+    The function `cache_stats` reports the query result cache's hit ratio, size and counters.
+
+    :return: Returns a JSON response with the result cache statistics.
+    """
+    return jsonify(result_cache.stats()), 200
+
+
+@connections_bp.route("/api/metrics", methods=["GET"])
+def request_metrics():
+    """
+    The function `request_metrics` reports per-endpoint request metrics in the Prometheus text
+    format: the duration of requests, the time they spent checking out a connection, executing
+    statements, fetching rows and serializing them, and the size of their responses, labeled by
+    endpoint and database. The database label is only kept for requests with the statistics token;
+    otherwise the series of all databases are added up.
+    :return: Returns the metrics as text.
+    """
+    return Response(metrics.render(details=stats_details()), content_type=metrics.content_type)
+
+
+@connections_bp.route("/api/slow_queries", methods=["GET"])
+def slow_queries():
+    """
+    The function `slow_queries` reports the statements that took longer than the slow-query
+    threshold, most recent first, with their normalized SQL, duration, row count, calling endpoint
+    and database, and their `EXPLAIN (FORMAT JSON)` plan when plan capture is enabled. The database
+    and the plan are only included for requests with the statistics token.
+
+    :return: Returns a JSON response with the slow-query log and its settings.
+    """
+    queries = slow_query_log.entries(details=stats_details())
+    return jsonify({**slow_query_log.stats(), "queries": queries}), 200
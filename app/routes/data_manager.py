@@ -1,6 +1,15 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify
 import psycopg2  # type: ignore
 import json
+import time
+
+import app.params as params
+from app.pool import pool
+from app.result_cache import result_cache
+import app.bulk as bulk
+import app.change_feed as change_feed
+import app.filters as filters
+import app.selects as selects
 
 data_bp = Blueprint("data_manager", __name__)
 
@@ -12,56 +21,23 @@ def select_rows():
     connection parameters and conditions.
     :return: Returns a JSON response containing the result of the SQL query
     executed on a oydabase table based on the provided parameters. The result includes the
-    rows fetched from the table with column names as keys in a list of dictionaries.
+    rows fetched from the table with column names as keys in a list of dictionaries. When `stream`
+    is set the rows are streamed from a server-side cursor as a JSON array or NDJSON. When `limit`
+    is set a single keyset-paginated page is returned as `{"rows": [...], "next": token}`. Rows can
+    be filtered with a raw SQL `conditions` string or a structured `where` filter. Results
+    that are not streamed are served from the result cache when it is enabled, unless `cache` is false.
+    Columnar JSON, MessagePack or Arrow output is selected with `format` or the `Accept` header.
     """
     if not request.data:
         return jsonify({"error": "No data provided"}), 400
 
     try:
         data = json.loads(request.data)
+        select = selects.Select("select_rows", data, request.accept_mimetypes)
+        return selects.respond(select), 200
 
-        host = data.get("host")
-        port = data.get("port", 5432)
-        oydaBase = data.get("oydaBase")
-        user = data.get("user")
-        password = data.get("password")
-        table_name = data.get("table_name")
-        conditions = data.get("conditions")
-
-        if not host:
-            return jsonify({"error": "Missing required parameter: host"}), 400
-        if not oydaBase:
-            return jsonify({"error": "Missing required parameter: oydaBase"}), 400
-        if not user:
-            return jsonify({"error": "Missing required parameter: user"}), 400
-        if not password:
-            return jsonify({"error": "Missing required parameter: password"}), 400
-        if not table_name:
-            return jsonify({"error": "Missing required parameter: table_name"}), 400
-
-        conn = psycopg2.connect(
-            dbname=oydaBase, user=user, password=password, host=host, port=port
-        )
-        cursor = conn.cursor()
-
-        query = f"SELECT * FROM {table_name}"
-        if conditions:
-            query += f" WHERE {conditions}"
-
-        cursor.execute(query)
-
-        columns = [desc[0] for desc in cursor.description]
-        rows = cursor.fetchall()
-
-        result = []
-        for row in rows:
-            result.append(dict(zip(columns, row)))
-
-        cursor.close()
-        conn.close()
-
-        return jsonify(result), 200
-
+    except selects.REQUEST_ERRORS as e:
+        return jsonify({"error": f"{e}"}), 400
     except psycopg2.DatabaseError as e:
         return jsonify({"error": f"{e}"}), 500
     except Exception as e:
@@ -75,60 +51,22 @@ def select_columns():
     parameters and conditions.
     :return: Returns a JSON response containing the result of selecting
     specific columns from a database table based on the provided parameters. The response includes the
-    data fetched from the database table in a structured format.
+    data fetched from the database table in a structured format. When `limit` is set a single
+    keyset-paginated page is returned as `{"rows": [...], "next": token}`. Rows are filtered with a
+    raw SQL `conditions` string or a structured `where` filter. Results are served from the result
+    cache when it is enabled, unless `cache` is false. Columnar JSON, MessagePack or Arrow output is
+    selected with `format` or the `Accept` header.
     """
     if not request.data:
         return jsonify({"error": "No data provided"}), 400
 
     try:
         data = json.loads(request.data)
+        select = selects.Select("select_columns", data, request.accept_mimetypes)
+        return selects.respond(select), 200
 
-        host = data.get("host")
-        port = data.get("port", 5432)
-        oydaBase = data.get("oydaBase")
-        user = data.get("user")
-        password = data.get("password")
-        table_name = data.get("table_name")
-        columns = data.get("columns")
-        conditions = data.get("conditions")
-
-        if not host:
-            return jsonify({"error": "Missing required parameter: host"}), 400
-        if not oydaBase:
-            return jsonify({"error": "Missing required parameter: oydaBase"}), 400
-        if not user:
-            return jsonify({"error": "Missing required parameter: user"}), 400
-        if not password:
-            return jsonify({"error": "Missing required parameter: password"}), 400
-        if not table_name:
-            return jsonify({"error": "Missing required parameter: table_name"}), 400
-        if not columns:
-            return jsonify({"error": "Missing required parameter: columns"}), 400
-        if not conditions:
-            return jsonify({"error": "Missing required parameter: conditions"}), 400
-
-        conn = psycopg2.connect(
-            dbname=oydaBase, user=user, password=password, host=host, port=port
-        )
-        cursor = conn.cursor()
-
-        query = f"SELECT {', '.join(columns)} FROM {table_name}"
-        if conditions:
-            query += f" WHERE {conditions}"
-
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        column_names = [desc[0] for desc in cursor.description]
-
-        result = []
-        for row in rows:
-            result.append(dict(zip(column_names, row)))
-
-        cursor.close()
-        conn.close()
-
-        return jsonify(result), 200
-
+    except selects.REQUEST_ERRORS as e:
+        return jsonify({"error": f"{e}"}), 400
     except psycopg2.DatabaseError as e:
         return jsonify({"error": f"{e}"}), 500
     except Exception as e:
@@ -147,40 +85,93 @@ def insert_row():
         return jsonify({"error": "No data provided"})
     data = json.loads(request.data)
 
-    host = data.get("host")
-    port = data.get("port", 5432)
-    oydaBase = data.get("oydaBase")
-    user = data.get("user")
-    password = data.get("password")
+    host, port, oydaBase, user, password = params.credentials(data)
     table_name = data.get("table_name")
     row = data.get("row")
 
-    if not host:
-        return jsonify({"error": "Missing required parameter: host"}), 400
-    if not oydaBase:
-        return jsonify({"error": "Missing required parameter: oydaBase"}), 400
-    if not user:
-        return jsonify({"error": "Missing required parameter: user"}), 400
-    if not password:
-        return jsonify({"error": "Missing required parameter: password"}), 400
-    if not table_name:
-        return jsonify({"error": "Missing required parameter: table_name"}), 400
+    error = params.missing(data, *params.CONNECTION_PARAMETERS, "table_name")
+    if error:
+        return jsonify({"error": error}), 400
 
     try:
-        conn = psycopg2.connect(
-            dbname=oydaBase, user=user, password=password, host=host, port=port
-        )
-        cur = conn.cursor()
+        with pool.connection(host, port, oydaBase, user, password) as conn:
+            cur = conn.cursor()
+
+            columns = ", ".join(row.keys())
+            values = ", ".join([f"'{v}'" for v in row.values()])
+            query = f"INSERT INTO {table_name} ({columns}) VALUES ({values})"
+            cur.execute(query)
+            conn.commit()
+            result_cache.invalidate((host, port, oydaBase), table_name)
 
-        columns = ", ".join(row.keys())
-        values = ", ".join([f"'{v}'" for v in row.values()])
-        query = f"INSERT INTO {table_name} ({columns}) VALUES ({values})"
-        cur.execute(query)
-        conn.commit()
-        conn.close()
+            return jsonify({"message": "Row inserted successfully"}), 200
 
-        return jsonify({"message": "Row inserted successfully"}), 200
+    except (Exception, psycopg2.DatabaseError) as e:
+        return jsonify({"error": f"Database connection failed: {e}"}), 500
+
+
+@data_bp.route("/api/insert_rows", methods=["POST"])
+def insert_rows():
+    """
+    The `insert_rows` function inserts many rows into a table in a single transaction. The rows are
+    either given as a `rows` list in the JSON body, or the body is NDJSON (one row object per line)
+    or CSV (with a header line), in which case the remaining parameters are passed as a JSON object
+    in the `X-Oyda-Params` header. JSON and NDJSON rows are inserted with multi-row INSERT statements
+    of `batch_size` rows; CSV bodies are streamed into `COPY ... FROM STDIN`.
+    :return: Returns a JSON response with the number of rows inserted and the insert rate, or an
+    error message if the rows could not be inserted.
+    """
+    body_format = bulk.body_format(request.mimetype)
+    if body_format == "json":
+        if not request.data:
+            return jsonify({"error": "No data provided"}), 400
+        data = json.loads(request.data)
+    else:
+        if not request.headers.get(bulk.PARAMS_HEADER):
+            return jsonify({"error": f"Missing {bulk.PARAMS_HEADER} header"}), 400
+        data = json.loads(request.headers[bulk.PARAMS_HEADER])
+
+    host, port, oydaBase, user, password = params.credentials(data)
+    table_name = data.get("table_name")
+    rows = data.get("rows")
+    batch_size = data.get("batch_size")
 
+    error = params.missing(data, *params.CONNECTION_PARAMETERS, "table_name")
+    if error:
+        return jsonify({"error": error}), 400
+    if body_format == "json" and not isinstance(rows, list):
+        return jsonify({"error": "Missing required parameter: rows"}), 400
+
+    try:
+        with pool.connection(host, port, oydaBase, user, password) as conn:
+            cur = conn.cursor()
+
+            start = time.perf_counter()
+            if body_format == "csv":
+                count = bulk.copy_csv(cur, table_name, request.stream)
+            else:
+                if body_format == "ndjson":
+                    rows = bulk.iter_ndjson(request.stream)
+                count = bulk.insert_values(cur, table_name, rows, batch_size=batch_size)
+            conn.commit()
+            elapsed = time.perf_counter() - start
+            result_cache.invalidate((host, port, oydaBase), table_name)
+            cur.close()
+
+        return (
+            jsonify(
+                {
+                    "message": f"{count} rows inserted successfully",
+                    "rows": count,
+                    "seconds": round(elapsed, 6),
+                    "rows_per_sec": round(count / elapsed, 1) if elapsed else None,
+                }
+            ),
+            200,
+        )
+
+    except bulk.BulkError as e:
+        return jsonify({"error": f"{e}"}), 400
     except (Exception, psycopg2.DatabaseError) as e:
         return jsonify({"error": f"Database connection failed: {e}"}), 500
 
@@ -189,7 +180,8 @@ def insert_row():
 def update_row():
     """
     The function `update_row` updates a row in a PostgreSQL database table based on provided data and
-    conditions.
+    conditions. The rows to update are selected by a raw SQL `condition` or a structured `where`
+    filter; with `where`, the new values are passed as parameters too.
     :return: Returns a JSON response with a success message if the row update
     operation is successful. If there is an error or exception during the database connection or update
     process, it returns a JSON response with an error message.
@@ -198,44 +190,94 @@ def update_row():
         return jsonify({"error": "No data provided"}), 400
     data = json.loads(request.data)
 
-    host = data.get("host")
-    port = data.get("port", 5432)
-    oydaBase = data.get("oydaBase")
-    user = data.get("user")
-    password = data.get("password")
+    host, port, oydaBase, user, password = params.credentials(data)
     table_name = data.get("table_name")
     row = data.get("row")
     condition = data.get("condition")
+    where = data.get("where")
 
-    if not host:
-        return jsonify({"error": "Missing required parameter: host"}), 400
-    if not oydaBase:
-        return jsonify({"error": "Missing required parameter: oydaBase"}), 400
-    if not user:
-        return jsonify({"error": "Missing required parameter: user"}), 400
-    if not password:
-        return jsonify({"error": "Missing required parameter: password"}), 400
-    if not table_name:
-        return jsonify({"error": "Missing required parameter: table_name"}), 400
-    if not condition:
+    error = params.missing(data, *params.CONNECTION_PARAMETERS, "table_name")
+    if error:
+        return jsonify({"error": error}), 400
+    if not condition and where is None:
         return jsonify({"error": "Missing required parameter: condition"}), 400
+    if condition and where is not None:
+        return jsonify({"error": "condition cannot be combined with where"}), 400
     if not row:
         return jsonify({"error": "Missing required parameter: row"}), 400
     try:
-        conn = psycopg2.connect(
-            dbname=oydaBase, user=user, password=password, host=host, port=port
-        )
-        cur = conn.cursor()
+        with pool.connection(host, port, oydaBase, user, password) as conn:
+            cur = conn.cursor()
+
+            if where is not None:
+                columns, values = filters.assignments(cur, table_name, row)
+                condition, where_params = filters.compile_filter(cur, table_name, where)
+                query = f"UPDATE {table_name} SET {columns} WHERE {condition}"
+                filters.statements.execute(cur, query, values + where_params)
+            else:
+                columns = ", ".join([f"{k} = '{v}'" for k, v in row.items()])
+                # condition = " AND ".join([f"{k} = '{v}'" for k, v in condition.items()])
+                query = f"UPDATE {table_name} SET {columns} WHERE {condition}"
+                cur.execute(query)
+            conn.commit()
+            result_cache.invalidate((host, port, oydaBase), table_name)
+
+            return jsonify({"message": "Row updated successfully"}), 200
+
+    except filters.FilterError as e:
+        return jsonify({"error": f"{e}"}), 400
+    except (Exception, psycopg2.DatabaseError) as e:
+        return jsonify({"error": f"Database connection failed: {e}"}), 500
 
-        columns = ", ".join([f"{k} = '{v}'" for k, v in row.items()])
-        # condition = " AND ".join([f"{k} = '{v}'" for k, v in condition.items()])
-        query = f"UPDATE {table_name} SET {columns} WHERE {condition}"
-        cur.execute(query)
-        conn.commit()
-        conn.close()
 
-        return jsonify({"message": "Row updated successfully"}), 200
+@data_bp.route("/api/update_rows", methods=["POST"])
+def update_rows():
+    """
+    The function `update_rows` applies many single-row updates to a table in one transaction. Each
+    update is a [key value, {column: new value}] pair matched against the `key` column, and the
+    updates are executed as batched `UPDATE ... FROM (VALUES ...)` statements.
+    :return: Returns a JSON response with the number of rows updated, or an error message if the
+    updates could not be applied.
+    """
+    if not request.data:
+        return jsonify({"error": "No data provided"}), 400
+    data = json.loads(request.data)
+
+    host, port, oydaBase, user, password = params.credentials(data)
+    table_name = data.get("table_name")
+    key = data.get("key")
+    updates = data.get("updates")
+    batch_size = data.get("batch_size")
+
+    error = params.missing(data, *params.CONNECTION_PARAMETERS, "table_name", "key")
+    if error:
+        return jsonify({"error": error}), 400
+    if not isinstance(updates, list):
+        return jsonify({"error": "Missing required parameter: updates"}), 400
+    try:
+        with pool.connection(host, port, oydaBase, user, password) as conn:
+            cur = conn.cursor()
+
+            count, statements = bulk.update_by_key(
+                cur, table_name, key, updates, batch_size=batch_size
+            )
+            conn.commit()
+            result_cache.invalidate((host, port, oydaBase), table_name)
+            cur.close()
+
+        return (
+            jsonify(
+                {
+                    "message": f"{count} rows updated successfully",
+                    "rows": count,
+                    "statements": statements,
+                }
+            ),
+            200,
+        )
 
+    except bulk.BulkError as e:
+        return jsonify({"error": f"{e}"}), 400
     except (Exception, psycopg2.DatabaseError) as e:
         return jsonify({"error": f"Database connection failed: {e}"}), 500
 
@@ -244,7 +286,7 @@ def update_row():
 def delete_row():
     """
     The function `delete_row` deletes a row from a PostgreSQL database table based on provided data and
-    conditions.
+    conditions. The rows to delete are selected by a raw SQL `condition` or a structured `where` filter.
     :return: Returns a JSON response with a success message if the row deletion
     operation is successful. If there is an error or exception during the database connection or deletion
     process, it returns a JSON response with an error message.
@@ -253,39 +295,127 @@ def delete_row():
         return jsonify({"error": "No data provided"}), 400
     data = json.loads(request.data)
 
-    host = data.get("host")
-    port = data.get("port", 5432)
-    oydaBase = data.get("oydaBase")
-    user = data.get("user")
-    password = data.get("password")
+    host, port, oydaBase, user, password = params.credentials(data)
     table_name = data.get("table_name")
     condition = data.get("condition")
+    where = data.get("where")
 
-    if not host:
-        return jsonify({"error": "Missing required parameter: host"}), 400
-    if not oydaBase:
-        return jsonify({"error": "Missing required parameter: oydaBase"}), 400
-    if not user:
-        return jsonify({"error": "Missing required parameter: user"}), 400
-    if not password:
-        return jsonify({"error": "Missing required parameter: password"}), 400
-    if not table_name:
-        return jsonify({"error": "Missing required parameter: table_name"}), 400
-    if not condition:
+    error = params.missing(data, *params.CONNECTION_PARAMETERS, "table_name")
+    if error:
+        return jsonify({"error": error}), 400
+    if not condition and where is None:
         return jsonify({"error": "Missing required parameter: condition"}), 400
+    if condition and where is not None:
+        return jsonify({"error": "condition cannot be combined with where"}), 400
     try:
-        conn = psycopg2.connect(
-            dbname=oydaBase, user=user, password=password, host=host, port=port
-        )
-        cur = conn.cursor()
+        with pool.connection(host, port, oydaBase, user, password) as conn:
+            cur = conn.cursor()
+
+            if where is not None:
+                condition, where_params = filters.compile_filter(cur, table_name, where)
+                query = f"DELETE FROM {table_name} WHERE {condition}"
+                filters.statements.execute(cur, query, where_params)
+            else:
+                # condition = " AND ".join([f"{k} = '{v}'" for k, v in condition.items()])
+                query = f"DELETE FROM {table_name} WHERE {condition}"
+                cur.execute(query)
+            conn.commit()
+            result_cache.invalidate((host, port, oydaBase), table_name)
+
+            return jsonify({"message": "Row deleted successfully"}), 200
+
+    except filters.FilterError as e:
+        return jsonify({"error": f"{e}"}), 400
+    except (Exception, psycopg2.DatabaseError) as e:
+        return jsonify({"error": f"Database connection failed: {e}"}), 500
 
-        # condition = " AND ".join([f"{k} = '{v}'" for k, v in condition.items()])
-        query = f"DELETE FROM {table_name} WHERE {condition}"
-        cur.execute(query)
-        conn.commit()
-        conn.close()
 
-        return jsonify({"message": "Row deleted successfully"}), 200
+@data_bp.route("/api/delete_rows", methods=["POST"])
+def delete_rows():
+    """
+    The function `delete_rows` deletes many rows from a table in one transaction. The rows are
+    identified by a list of `keys` matched against the `key` column and deleted with batched
+    `DELETE ... WHERE key = ANY(...)` statements.
+    :return: Returns a JSON response with the number of rows deleted, or an error message if the
+    rows could not be deleted.
+    """
+    if not request.data:
+        return jsonify({"error": "No data provided"}), 400
+    data = json.loads(request.data)
+
+    host, port, oydaBase, user, password = params.credentials(data)
+    table_name = data.get("table_name")
+    key = data.get("key")
+    keys = data.get("keys")
+    batch_size = data.get("batch_size")
+
+    error = params.missing(data, *params.CONNECTION_PARAMETERS, "table_name", "key")
+    if error:
+        return jsonify({"error": error}), 400
+    if not isinstance(keys, list):
+        return jsonify({"error": "Missing required parameter: keys"}), 400
+    try:
+        with pool.connection(host, port, oydaBase, user, password) as conn:
+            cur = conn.cursor()
+
+            count, statements = bulk.delete_by_key(
+                cur, table_name, key, keys, batch_size=batch_size
+            )
+            conn.commit()
+            result_cache.invalidate((host, port, oydaBase), table_name)
+            cur.close()
+
+        return (
+            jsonify(
+                {
+                    "message": f"{count} rows deleted successfully",
+                    "rows": count,
+                    "statements": statements,
+                }
+            ),
+            200,
+        )
 
+    except bulk.BulkError as e:
+        return jsonify({"error": f"{e}"}), 400
     except (Exception, psycopg2.DatabaseError) as e:
         return jsonify({"error": f"Database connection failed: {e}"}), 500
+
+
+# Headers of event streams; proxies must neither cache nor buffer them
+EVENT_STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+@data_bp.route("/api/subscribe", methods=["POST"])
+def subscribe():
+    """
+    The `subscribe` function streams the row changes of a table as Server-Sent Events. The first
+    subscription to a table installs a trigger on it that publishes the primary key of every
+    inserted, updated and deleted row with `pg_notify`, and the last one to leave drops it; one
+    listening connection per database fans the changes out to all of its subscribers, which read
+    the changed rows with their own credentials. `events` limits the stream to some of "insert",
+    "update" and "delete".
+    :return: Returns a `text/event-stream` response. Each change is an event named after its
+    operation whose data is `{"table": ..., "op": ..., "key": {...}, "row": {...}}`; `row` is null
+    for deletes and for rows the subscriber can't see. A subscriber that falls more than
+    `OYDA_SUBSCRIBE_QUEUE_SIZE` events behind gets an `overflow` event and the stream ends.
+    """
+    if not request.data:
+        return jsonify({"error": "No data provided"}), 400
+
+    try:
+        data = json.loads(request.data)
+        credentials, table_name, operations = change_feed.parse(data)
+        table = change_feed.prepare(credentials, table_name)
+        subscription = change_feed.Subscription(credentials, table, operations)
+        change_feed.change_feed.subscribe(credentials, subscription)
+        return Response(
+            subscription.events(), mimetype="text/event-stream", headers=EVENT_STREAM_HEADERS
+        )
+
+    except (params.ParameterError, change_feed.ChangeFeedError) as e:
+        return jsonify({"error": f"{e}"}), 400
+    except psycopg2.DatabaseError as e:
+        return jsonify({"error": f"{e}"}), 500
+    except Exception as e:
+        return jsonify({"error": f"{e}"}), 500
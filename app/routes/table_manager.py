@@ -2,6 +2,17 @@ from flask import Blueprint, request, jsonify
 import psycopg2  # type: ignore
 import json
 
+import app.utilities as utils
+import app.bulk as bulk
+import app.parallel_scan as parallel_scan
+import app.params as params
+from app.pool import pool
+from app.schema_cache import schema_cache
+from app.result_cache import result_cache
+import app.selects as selects
+import app.table_copy as table_copy
+import app.table_stats as table_stats
+
 table_manager_bp = Blueprint("table_manager", __name__)
 
 
@@ -13,49 +24,28 @@ def select_table():
     :return: Returns a JSON response containing the result of a SELECT query
     on a specified table in a PostgreSQL database. The result includes the rows of the table in a list
     of dictionaries where each dictionary represents a row with column names as keys and row values as
-    values.
+    values. When `stream` is set the rows are streamed from a server-side cursor as a JSON array or NDJSON.
+    When `limit` is set a single keyset-paginated page is returned as `{"rows": [...], "next": token}`;
+    passing the token back as `after` fetches the following page. Results that are not streamed are
+    served from the result cache when it is enabled, unless `cache` is false. Columnar JSON, MessagePack
+    or Arrow output is selected with `format` or the `Accept` header. A stream with `parallel` (true or
+    a number of parts) reads ranges of the table concurrently over several connections that share one
+    snapshot, and sends the rows in no particular order. Responses carry an ETag derived
+    from the table's version; a request whose `If-None-Match` names it is answered with 304 Not
+    Modified without reading the table.
     """
     if not request.data:
         return jsonify({"error": "No data provided"}), 400
+
     try:
         data = json.loads(request.data)
-        host = data.get("host")
-        port = data.get("port", 5432)
-        oydaBase = data.get("oydaBase")
-        user = data.get("user")
-        password = data.get("password")
-        table_name = data.get("table_name")
-
-        if not host:
-            return jsonify({"error": "Missing required parameter: host"}), 400
-        if not oydaBase:
-            return jsonify({"error": "Missing required parameter: oydaBase"}), 400
-        if not user:
-            return jsonify({"error": "Missing required parameter: user"}), 400
-        if not password:
-            return jsonify({"error": "Missing required parameter: password"}), 400
-        if not table_name:
-            return jsonify({"error": "Missing required parameter: table_name"}), 400
-
-        conn = psycopg2.connect(
-            dbname=oydaBase, user=user, password=password, host=host, port=port
+        select = selects.Select(
+            "select_table", data, request.accept_mimetypes, request.headers.get("If-None-Match")
         )
-        cursor = conn.cursor()
-
-        query = f"SELECT * FROM {table_name};"
-        cursor.execute(query)
-        columns = [desc[0] for desc in cursor.description]
-        rows = cursor.fetchall()
-
-        result = []
-        for row in rows:
-            result.append(dict(zip(columns, row)))
-
-        cursor.close()
-        conn.close()
-
-        return jsonify(result), 200
+        return selects.respond(select)
 
+    except selects.REQUEST_ERRORS as e:
+        return jsonify({"error": f"{e}"}), 400
     except psycopg2.DatabaseError as e:
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
@@ -66,7 +56,8 @@ def select_table():
 def table_exists():
     """
     The function `table_exists` checks if a specified table exists in a PostgreSQL database using the
-    provided connection parameters.
+    provided connection parameters. The answer comes from the cached schema catalog, so empty tables
+    are reported as existing and no table data is read.
     :return: Returns a JSON response indicating whether a specified table
     exists in a PostgreSQL database.
     """
@@ -74,40 +65,24 @@ def table_exists():
         return jsonify({"error": "No data provided"}), 400
     try:
         data = json.loads(request.data)
-        host = data.get("host")
-        port = data.get("port", 5432)
-        oydaBase = data.get("oydaBase")
-        user = data.get("user")
-        password = data.get("password")
+        host, port, oydaBase, user, password = params.credentials(data)
         table_name = data.get("table_name")
 
-        if not host:
-            return jsonify({"error": "Missing required parameter: host"}), 400
-        if not oydaBase:
-            return jsonify({"error": "Missing required parameter: oydaBase"}), 400
-        if not user:
-            return jsonify({"error": "Missing required parameter: user"}), 400
-        if not password:
-            return jsonify({"error": "Missing required parameter: password"}), 400
-        if not table_name:
-            return jsonify({"error": "Missing required parameter: table_name"}), 400
-
-        conn = psycopg2.connect(
-            dbname=oydaBase, user=user, password=password, host=host, port=port
-        )
-        cursor = conn.cursor()
+        error = params.missing(data, *params.CONNECTION_PARAMETERS, "table_name")
+        if error:
+            return jsonify({"error": error}), 400
+
+        with pool.connection(host, port, oydaBase, user, password) as conn:
+            cursor = conn.cursor()
 
-        query = f"SELECT 1 FROM {table_name} LIMIT 1"
-        cursor.execute(query)
-        result = cursor.fetchone()
+            result = utils.check_table_exists(cursor, table_name)
 
-        cursor.close()
-        conn.close()
+            cursor.close()
 
-        if result:
-            return jsonify({"exists": True}), 200
-        else:
-            return jsonify({"exists": False}), 200
+            if result:
+                return jsonify({"exists": True}), 200
+            else:
+                return jsonify({"exists": False}), 200
 
     except psycopg2.DatabaseError as e:
         return jsonify({"error": f"Database error: {e}"}), 500
@@ -115,6 +90,38 @@ def table_exists():
         return jsonify({"error": f"Error: {e}"}), 500
 
 
+@table_manager_bp.route("/api/table_stats", methods=["POST"])
+def get_table_stats():
+    """
+    The function `get_table_stats` reports the size and maintenance statistics of one table
+    (`table_name`) or several (`tables`) from the catalogs: the row count estimated by the last
+    VACUUM or ANALYZE, the live and dead rows counted by the statistics collector, the total, table,
+    heap and index sizes in bytes and the times of the last manual and automatic vacuum and analyze.
+    With `exact` the rows are also counted with `count(*)`; each count is cancelled after
+    `count_timeout` seconds and then reported as null, like a count that fails.
+    :return: Returns a JSON response with a `tables` list in the requested order. Tables that do
+    not exist are reported with `"exists": false`.
+    """
+    if not request.data:
+        return jsonify({"error": "No data provided"}), 400
+
+    try:
+        data = json.loads(request.data)
+        credentials, tables, exact, count_timeout = table_stats.parse(data)
+        with pool.connection(*credentials) as conn:
+            cursor = conn.cursor()
+            stats = table_stats.table_stats(cursor, tables, exact, count_timeout)
+            cursor.close()
+        return jsonify({"tables": stats}), 200
+
+    except params.ParameterError as e:
+        return jsonify({"error": f"{e}"}), 400
+    except psycopg2.DatabaseError as e:
+        return jsonify({"error": f"Database error: {e}"}), 500
+    except Exception as e:
+        return jsonify({"error": f"Error: {e}"}), 500
+
+
 @table_manager_bp.route("/api/drop_table", methods=["POST"])
 def drop_table():
     """
@@ -127,36 +134,25 @@ def drop_table():
         return jsonify({"error": "No data provided"}), 400
     try:
         data = json.loads(request.data)
-        host = data.get("host")
-        port = data.get("port", 5432)
-        oydaBase = data.get("oydaBase")
-        user = data.get("user")
-        password = data.get("password")
+        host, port, oydaBase, user, password = params.credentials(data)
         table_name = data.get("table_name")
 
-        if not host:
-            return jsonify({"error": "Missing required parameter: host"}), 400
-        if not oydaBase:
-            return jsonify({"error": "Missing required parameter: oydaBase"}), 400
-        if not user:
-            return jsonify({"error": "Missing required parameter: user"}), 400
-        if not password:
-            return jsonify({"error": "Missing required parameter: password"}), 400
-        if not table_name:
-            return jsonify({"error": "Missing required parameter: table_name"}), 400
-
-        conn = psycopg2.connect(
-            dbname=oydaBase, user=user, password=password, host=host, port=port
-        )
-        cursor = conn.cursor()
+        error = params.missing(data, *params.CONNECTION_PARAMETERS, "table_name")
+        if error:
+            return jsonify({"error": error}), 400
+
+        with pool.connection(host, port, oydaBase, user, password) as conn:
+            cursor = conn.cursor()
 
-        query = f"DROP TABLE {table_name};"
-        cursor.execute(query)
-        conn.commit()
-        cursor.close()
-        conn.close()
+            query = f"DROP TABLE {table_name};"
+            cursor.execute(query)
+            conn.commit()
+            schema_cache.invalidate(cursor, table_name)
+            result_cache.invalidate((host, port, oydaBase), table_name)
+            utils.bootstrapped_oydabases.discard((host, int(port), oydaBase))
+            cursor.close()
 
-        return jsonify({"message": f"Table {table_name} dropped successfully"}), 200
+            return jsonify({"message": f"Table {table_name} dropped successfully"}), 200
 
     except psycopg2.DatabaseError as e:
         return jsonify({"error": f"Database error: {e}"}), 500
@@ -175,47 +171,92 @@ def create_table():
         return jsonify({"error": "No data provided"}), 400
     data = json.loads(request.data)
 
-    host = data.get("host")
-    port = data.get("port", 5432)
-    oydaBase = data.get("oydaBase")
-    user = data.get("user")
-    password = data.get("password")
+    host, port, oydaBase, user, password = params.credentials(data)
     table_name = data.get("table_name")
     columns = data.get("columns")
 
-    if not host:
-        return jsonify({"error": "Missing required parameter: host"}), 400
-    if not oydaBase:
-        return jsonify({"error": "Missing required parameter: oydaBase"}), 400
-    if not user:
-        return jsonify({"error": "Missing required parameter: user"}), 400
-    if not password:
-        return jsonify({"error": "Missing required parameter: password"}), 400
-    if not table_name:
-        return jsonify({"error": "Missing required parameter: table_name"}), 400
-    if not columns:
-        return jsonify({"error": "Missing required parameter: columns"}), 400
+    error = params.missing(data, *params.CONNECTION_PARAMETERS, "table_name", "columns")
+    if error:
+        return jsonify({"error": error}), 400
 
     try:
-        conn = psycopg2.connect(
-            dbname=oydaBase, user=user, password=password, host=host, port=port
-        )
-        cur = conn.cursor()
+        with pool.connection(host, port, oydaBase, user, password) as conn:
+            cur = conn.cursor()
+
+            column_definitions = ", ".join(
+                [
+                    f"{column_name} {column_type}"
+                    for column_name, column_type in columns.items()
+                ]
+            )
+            query = f"CREATE TABLE IF NOT EXISTS {table_name} ({column_definitions})"
+            cur.execute(query)
+            conn.commit()
+            schema_cache.invalidate(cur, table_name)
+            result_cache.invalidate((host, port, oydaBase), table_name)
+            cur.close()
+
+            return jsonify({"message": "Table created successfully"}), 200
+
+    except psycopg2.DatabaseError as e:
+        return jsonify({"error": f"Database error: {e}"}), 500
+    except Exception as e:
+        return jsonify({"error": f"Error: {e}"}), 500
+
 
-        column_definitions = ", ".join(
-            [
-                f"{column_name} {column_type}"
-                for column_name, column_type in columns.items()
-            ]
+@table_manager_bp.route("/api/export_table", methods=["POST"])
+def export_table():
+    """
+    The function `export_table` streams a table out of the database with `COPY ... TO STDOUT`, in
+    CSV (the default, with a header line unless `header` is false) or Postgres' binary COPY format.
+    `columns` limits the export to some of the table's columns. With `parallel` (true or a number
+    of parts) ranges of the table are exported concurrently over several connections that share
+    one snapshot, and the output is sent in no particular row order.
+    :return: Returns the table as a `text/csv` or `application/octet-stream` attachment. The data
+    is passed on in chunks as Postgres sends it, without building rows in Python.
+    """
+    if not request.data:
+        return jsonify({"error": "No data provided"}), 400
+
+    try:
+        data = json.loads(request.data)
+        credentials, table_name, copy_format, columns, header = table_copy.parse(data)
+        parallel = parallel_scan.parse_parallel(data.get("parallel"))
+        return table_copy.export_table(
+            credentials, table_name, copy_format, columns, header, parallel
         )
-        query = f"CREATE TABLE IF NOT EXISTS {table_name} ({column_definitions})"
-        cur.execute(query)
-        conn.commit()
-        cur.close()
-        conn.close()
 
-        return jsonify({"message": "Table created successfully"}), 200
+    except (params.ParameterError, table_copy.CopyError) as e:
+        return jsonify({"error": f"{e}"}), 400
+    except psycopg2.DatabaseError as e:
+        return jsonify({"error": f"Database error: {e}"}), 500
+    except Exception as e:
+        return jsonify({"error": f"Error: {e}"}), 500
+
+
+@table_manager_bp.route("/api/import_table", methods=["POST"])
+def import_table():
+    """
+    The function `import_table` streams the request body into a table with `COPY ... FROM STDIN`,
+    in one transaction. Since the body is the data, the parameters are passed as a JSON object in
+    the `X-Oyda-Params` header: the connection parameters or a `session` token, `table_name`,
+    `format` ("csv" or "binary"), `header` and `columns`, as for `export_table`.
+    :return: Returns a JSON response with the number of rows imported.
+    """
+    if not request.headers.get(bulk.PARAMS_HEADER):
+        return jsonify({"error": f"Missing {bulk.PARAMS_HEADER} header"}), 400
+
+    try:
+        data = json.loads(request.headers[bulk.PARAMS_HEADER])
+        credentials, table_name, copy_format, columns, header = table_copy.parse(data)
+        rows = table_copy.import_table(
+            credentials, table_name, request.stream, copy_format, columns, header
+        )
+        result_cache.invalidate(credentials[:3], table_name)
+        return jsonify({"message": f"{rows} rows imported successfully", "rows": rows}), 200
 
+    except (params.ParameterError, table_copy.CopyError) as e:
+        return jsonify({"error": f"{e}"}), 400
     except psycopg2.DatabaseError as e:
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
@@ -0,0 +1,215 @@
+import threading
+import time
+
+import app.config as config
+
+# Column types are read without their modifiers, e.g. "character varying" for varchar(255), because
+# they are used to cast parameters: a cast to the full type would truncate or round the value
+# instead of letting the assignment to the column reject it.
+CATALOG_QUERY = """
+    SELECT n.nspname, c.relname, a.attname, format_type(a.atttypid, NULL),
+           array_position(i.indkey::int2[], a.attnum), a.attnotnull
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+    LEFT JOIN pg_index i ON i.indrelid = c.oid AND i.indisprimary
+    WHERE c.relkind IN ('r', 'p', 'v', 'm', 'f')
+      AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+      AND n.nspname !~ '^pg_toast'
+      {filter}
+    ORDER BY n.nspname, c.relname, a.attnum
+"""
+
+
+def qualified_name(table_name):
+    """
+    This is a helper function that maps a table name as given by a client to the catalog key.
+    Unqualified names refer to the `public` schema.
+
+    :param table_name: The `table_name` parameter is a string that represents the name of the table.
+    :return: Returns the name in "schema.table" form.
+    """
+    return table_name if "." in table_name else f"public.{table_name}"
+
+
+def _database_key(cursor):
+    info = cursor.connection.info
+    return (info.host, info.port, info.dbname)
+
+
+def _catalog_query(table_name=None):
+    """
+    Builds the query that reads tables, columns, column types, NOT NULL constraints and primary
+    keys from pg_catalog, either for the whole database or for one table.
+
+    :return: Returns a (query, params) tuple.
+    """
+    if table_name is None:
+        return CATALOG_QUERY.format(filter=""), None
+    return CATALOG_QUERY.format(filter="AND c.oid = to_regclass(%s)"), (table_name,)
+
+
+def _parse(rows):
+    tables = {}
+    for schema, table, column, column_type, key_position, not_null in rows:
+        info = tables.setdefault(
+            f"{schema}.{table}", {"columns": {}, "primary_key": [], "not_null": []}
+        )
+        if column is None:
+            continue
+        info["columns"][column] = column_type
+        if not_null:
+            info["not_null"].append(column)
+        if key_position is not None:
+            info["primary_key"].append((key_position, column))
+
+    for info in tables.values():
+        info["primary_key"] = [column for _, column in sorted(info["primary_key"])]
+    return tables
+
+
+def _load(cursor, table_name=None):
+    cursor.execute(*_catalog_query(table_name))
+    return _parse(cursor.fetchall())
+
+
+async def _load_async(cursor, table_name=None):
+    await cursor.execute(*_catalog_query(table_name))
+    return _parse(await cursor.fetchall())
+
+
+class SchemaCache:
+    """
+    A per-database, in-memory copy of the table and column catalog.
+
+    Each database's catalog is loaded in one query and reloaded after `ttl` seconds. Tables that
+    are invalidated explicitly (after CREATE or DROP) are reloaded individually on their next
+    lookup. Lookups of unknown tables trigger a reload at most every `miss_refresh` seconds, so
+    tables created by other clients are found without waiting for the TTL.
+
+    The lookup logic is written as a generator that asks its driver for catalog loads, so that the
+    same cache serves psycopg2 cursors (`table`) and async psycopg cursors (`table_async`).
+    """
+
+    def __init__(
+        self, ttl=config.SCHEMA_CACHE_TTL, miss_refresh=config.SCHEMA_CACHE_MISS_REFRESH
+    ):
+        self.ttl = ttl
+        self.miss_refresh = miss_refresh
+        self._lock = threading.Lock()
+        self._catalogs = {}
+
+    def refresh(self, cursor):
+        """
+        Reloads the whole catalog of the cursor's database.
+
+        :param cursor: The `cursor` parameter is a database object to interact with a database.
+        :return: Returns the reloaded catalog.
+        """
+        return self._store(_database_key(cursor), _load(cursor))
+
+    def _store(self, key, tables):
+        catalog = {"tables": tables, "loaded_at": time.monotonic(), "stale": set()}
+        with self._lock:
+            self._catalogs[key] = catalog
+        return catalog
+
+    def invalidate(self, cursor, table_name=None):
+        """
+        Forgets a table, or the whole catalog when no table is given, so that the next lookup
+        reads it from the database again.
+
+        :param cursor: The `cursor` parameter is a database object to interact with a database.
+        :param table_name: The `table_name` parameter is a string that represents the name of the table.
+        """
+        key = _database_key(cursor)
+        with self._lock:
+            if table_name is None:
+                self._catalogs.pop(key, None)
+            elif key in self._catalogs:
+                name = qualified_name(table_name)
+                self._catalogs[key]["tables"].pop(name, None)
+                self._catalogs[key]["stale"].add(name)
+
+    def _lookup(self, key, table_name):
+        # Yields the table to load, or None for the whole database, and receives the loaded tables.
+        now = time.monotonic()
+        with self._lock:
+            catalog = self._catalogs.get(key)
+        if catalog is None or now - catalog["loaded_at"] > self.ttl:
+            catalog = self._store(key, (yield None))
+
+        for name in (qualified_name(table_name), qualified_name(table_name.lower())):
+            if name in catalog["stale"]:
+                tables = yield name
+                with self._lock:
+                    catalog["stale"].discard(name)
+                    catalog["tables"].update(tables)
+            if name in catalog["tables"]:
+                return catalog["tables"][name]
+
+        if now - catalog["loaded_at"] > self.miss_refresh:
+            catalog = self._store(key, (yield None))
+            for name in (qualified_name(table_name), qualified_name(table_name.lower())):
+                if name in catalog["tables"]:
+                    return catalog["tables"][name]
+        return None
+
+    def table(self, cursor, table_name):
+        """
+        Looks up a table in the catalog, loading or reloading the catalog if necessary.
+
+        :param cursor: The `cursor` parameter is a database object to interact with a database.
+        :param table_name: The `table_name` parameter is a string that represents the name of the table.
+        :return: Returns a dictionary with the table's `columns` (name to type), `primary_key` and
+        `not_null` columns, or None if the table does not exist.
+        """
+        lookup = self._lookup(_database_key(cursor), table_name)
+        try:
+            request = next(lookup)
+            while True:
+                request = lookup.send(_load(cursor, request))
+        except StopIteration as done:
+            return done.value
+
+    async def table_async(self, cursor, table_name):
+        """
+        Looks up a table like `table`, for an async psycopg cursor.
+        """
+        lookup = self._lookup(_database_key(cursor), table_name)
+        try:
+            request = next(lookup)
+            while True:
+                request = lookup.send(await _load_async(cursor, request))
+        except StopIteration as done:
+            return done.value
+
+    def table_exists(self, cursor, table_name):
+        """
+        Checks whether a table exists, answered from the cached catalog.
+
+        :return: Returns a boolean value indicating whether the table exists in the oydabase.
+        """
+        return self.table(cursor, table_name) is not None
+
+    def columns(self, cursor, table_name):
+        """
+        Looks up the columns of a table and their SQL types in the cached catalog.
+
+        :return: Returns a dictionary mapping each column name to its type, empty if the table does
+        not exist.
+        """
+        table = self.table(cursor, table_name)
+        return dict(table["columns"]) if table else {}
+
+    def primary_key(self, cursor, table_name):
+        """
+        Looks up the primary key of a table in the cached catalog.
+
+        :return: Returns the primary key column names in key order, empty if there is none.
+        """
+        table = self.table(cursor, table_name)
+        return list(table["primary_key"]) if table else []
+
+
+schema_cache = SchemaCache()
@@ -0,0 +1,323 @@
+from flask import Response
+
+import app.filters as filters
+import app.metrics as metrics
+import app.pagination as pagination
+import app.parallel_scan as parallel_scan
+import app.params as params
+import app.serializers as serializers
+import app.streaming as streaming
+import app.utilities as utils
+from app.pool import pool
+from app.result_cache import result_cache
+from app.schema_cache import schema_cache
+from app.table_versions import table_versions
+import app.table_versions as versions
+
+# The select endpoints, the optional parts of the request each of them takes, and whether their
+# responses carry an ETag derived from the table's version
+ENDPOINTS = {
+    "select_table": {
+        "conditions": False,
+        "columns": False,
+        "stream": True,
+        "parallel": True,
+        "conditional": True,
+    },
+    "select_rows": {
+        "conditions": True,
+        "columns": False,
+        "stream": True,
+        "parallel": False,
+        "conditional": False,
+    },
+    "select_columns": {
+        "conditions": True,
+        "columns": True,
+        "stream": False,
+        "parallel": False,
+        "conditional": False,
+    },
+}
+
+# Errors in a select request that are answered with 400
+REQUEST_ERRORS = (
+    params.ParameterError,
+    pagination.PaginationError,
+    serializers.FormatError,
+    filters.FilterError,
+)
+
+
+class Select:
+    """
+    A validated request to one of the select endpoints and the SQL it runs. The Flask blueprints
+    and the ASGI app both build their selects here, so the two serving modes accept the same
+    parameters and run the same statements; they only differ in how they talk to Postgres.
+
+    Running a select needs up to two schema lookups before the statement: the table's column types
+    when a `where` filter must be compiled (passed to `compile`) and, for a page, its primary key
+    and NOT NULL columns (passed to `page_query`). Conditional selects also look up the table's
+    version first (passed to `set_version`).
+    """
+
+    def __init__(self, endpoint, data, accept=None, if_none_match=None):
+        """
+        Reads and validates the request body.
+
+        :param endpoint: The `endpoint` parameter is one of the names in `ENDPOINTS`.
+        :param data: The `data` parameter is the parsed request body.
+        :param accept: The `accept` parameter is the request's `Accept` header, parsed or raw.
+        :param if_none_match: The `if_none_match` parameter is the request's `If-None-Match` header.
+        :raises ParameterError: When parameters are missing or can't be combined.
+        """
+        options = ENDPOINTS[endpoint]
+        self.endpoint = endpoint
+        self.conditional = options["conditional"]
+        self.if_none_match = if_none_match
+        self.etag = None
+        self.credentials = params.credentials(data)
+        self.table_name = data.get("table_name")
+        self.columns = data.get("columns") if options["columns"] else None
+        self.conditions = data.get("conditions") if options["conditions"] else None
+        self.where = data.get("where") if options["conditions"] else None
+        stream = data.get("stream") if options["stream"] else None
+        parallel = data.get("parallel") if options["parallel"] else None
+        self.fetch_size = data.get("fetch_size")
+        self.order_by = data.get("order_by")
+        self.descending = data.get("descending", False)
+        self.limit = data.get("limit")
+        self.after = data.get("after")
+        self.use_cache = data.get("cache", True)
+        requested_format = data.get("format")
+
+        required = [*params.CONNECTION_PARAMETERS, "table_name"]
+        if options["columns"]:
+            required.append("columns")
+        error = params.missing(data, *required)
+        if error:
+            raise params.ParameterError(error)
+        if stream not in streaming.STREAM_OPTIONS:
+            raise params.ParameterError("Invalid value for parameter: stream")
+        self.stream = streaming.stream_format(stream)
+        if self.stream and self.limit is not None:
+            raise params.ParameterError("stream cannot be combined with limit")
+        if self.stream and requested_format not in (None, "rows"):
+            raise params.ParameterError("stream cannot be combined with format")
+        self.parallel = parallel_scan.parse_parallel(parallel)
+        if parallel and not self.stream:
+            raise params.ParameterError("parallel requires stream")
+        if options["columns"] and not self.conditions and self.where is None:
+            raise params.ParameterError("Missing required parameter: conditions")
+        if self.conditions and self.where is not None:
+            raise params.ParameterError("conditions cannot be combined with where")
+
+        self.output = None
+        if not self.stream:
+            self.output = serializers.response_format(requested_format, accept)
+        self.cache_params = {"format": self.output, "where": self.where}
+        if self.limit is not None:
+            self.cache_params.update(
+                order_by=self.order_by, descending=self.descending, limit=self.limit, after=self.after
+            )
+            self.limit = pagination.parse_limit(self.limit)
+            self.order_by = pagination.parse_order_by(self.order_by)
+            self.descending = bool(self.descending)
+
+        self.condition = self.conditions
+        self.condition_params = None
+
+    @property
+    def select_list(self):
+        return ", ".join(self.columns) if self.columns else "*"
+
+    @property
+    def query(self):
+        """
+        The SELECT with the raw `conditions`, if any. It also keys the result cache.
+        """
+        query = f"SELECT {self.select_list} FROM {self.table_name}"
+        if self.conditions:
+            query += f" WHERE {self.conditions}"
+        return query
+
+    @property
+    def mimetype(self):
+        return serializers.FORMATS[self.output]
+
+    @property
+    def not_modified(self):
+        """
+        Whether the client's `If-None-Match` names the current version of the response.
+        """
+        return versions.matches(self.if_none_match, self.etag)
+
+    def set_version(self, version, generation):
+        """
+        Bases the response on a version of the table. The version becomes part of the result cache
+        key, so results cached for an older version are not served, and of the response's ETag.
+
+        :param version: The `version` parameter is the table's version, None if it is not tracked.
+        :param generation: The `generation` parameter is the table's result cache generation.
+        """
+        if version is None:
+            return
+        self.cache_params["version"] = version
+        self.etag = versions.etag(
+            self.endpoint,
+            self.credentials[:4],
+            version,
+            generation,
+            self.query,
+            self.cache_params,
+            self.stream,
+            self.fetch_size,
+        )
+
+    def compile(self, column_types):
+        """
+        Compiles the `where` filter, if any, into the condition of the statement.
+
+        :param column_types: The `column_types` parameter maps the table's column names to their types.
+        :raises FilterError: When the filter is invalid.
+        """
+        if self.where is not None:
+            self.condition, self.condition_params = filters.compile_where(
+                self.where, column_types, self.table_name
+            )
+
+    def statement(self, scan_range=None):
+        """
+        :param scan_range: The `scan_range` parameter is the condition of the part of the table a
+        parallel scan reads, if any.
+        :return: Returns the (query, params) of an unpaginated select. params is None for raw
+        conditions, otherwise the query is a compiled statement that must be run with them.
+        """
+        if self.condition_params is None and scan_range is None:
+            return self.query, None
+        condition = self.condition
+        if scan_range is not None:
+            condition = f"({condition}) AND {scan_range}" if condition else scan_range
+        query = f"SELECT {self.select_list} FROM {self.table_name} WHERE {condition}"
+        return query, self.condition_params
+
+    def page_query(self, table=None):
+        """
+        :param table: The `table` parameter is the table's cached catalog entry. Its primary key
+        orders the pages when the request has no `order_by` and breaks ties otherwise.
+        :return: Returns the (query, params) of a keyset-paginated page.
+        :raises PaginationError: When the page has no order or the `after` token is invalid.
+        """
+        table = table or {}
+        self.order_by = pagination.page_order(
+            self.order_by, table.get("primary_key", []), self.table_name
+        )
+        return pagination.keyset_query(
+            self.select_list,
+            self.table_name,
+            self.condition,
+            self.order_by,
+            self.descending,
+            self.limit,
+            self.after,
+            self.condition_params,
+            # Primary key columns are always NOT NULL.
+            [*table.get("not_null", []), *table.get("primary_key", [])],
+        )
+
+    def encode(self, columns, rows):
+        """
+        Encodes the fetched rows, as a page with its `next` token when `limit` was given.
+
+        :param columns: The `columns` parameter is the list of result column names.
+        :param rows: The `rows` parameter is the list of fetched row tuples.
+        :return: Returns the response body as bytes.
+        """
+        with metrics.phase("serialize"):
+            if self.limit is None:
+                return serializers.encode(self.output, columns, rows)
+            page = pagination.build_page(columns, rows, self.order_by, self.descending, self.limit)
+            return serializers.encode(self.output, page["columns"], page["rows"], next=page["next"])
+
+
+def respond(select):
+    """
+    This is a helper function that runs a select on the connection pool. Streams are read from a
+    server-side cursor; other results are served from and stored in the result cache unless the
+    request disabled it. Conditional selects look up the table's version first and answer with
+    304 Not Modified, without running the select, when the client's copy is current.
+
+    :param select: The `select` parameter is a validated `Select`.
+    :return: Returns a Flask response.
+    """
+    if select.conditional:
+        generation = result_cache.generation(select.credentials, select.table_name)
+        with pool.connection(*select.credentials) as conn:
+            cursor = conn.cursor()
+            select.set_version(table_versions.version(cursor, select.table_name), generation)
+            cursor.close()
+
+    if select.not_modified:
+        response = Response(status=304)
+    else:
+        response = run(select)
+    if select.etag is not None:
+        response.set_etag(select.etag, weak=True)
+    return response
+
+
+def run(select):
+    """
+    This is a helper function that runs a select for `respond`.
+    """
+    if select.stream:
+        if select.parallel:
+            body = parallel_scan.scan_select(select)
+            if body is not None:
+                return Response(body, mimetype=streaming.STREAM_FORMATS[select.stream])
+        if select.where is not None:
+            with pool.connection(*select.credentials) as conn:
+                cursor = conn.cursor()
+                select.compile(utils.get_column_types(cursor, select.table_name))
+                cursor.close()
+        query, query_params = select.statement()
+        return streaming.stream_query(
+            select.credentials,
+            query,
+            query_params,
+            output=select.stream,
+            fetch_size=select.fetch_size,
+        )
+
+    if select.use_cache:
+        cached = result_cache.get(
+            select.credentials, select.table_name, select.query, select.cache_params
+        )
+        if cached is not None:
+            return cached
+    generation = result_cache.generation(select.credentials, select.table_name)
+
+    with pool.connection(*select.credentials) as conn:
+        cursor = conn.cursor()
+        if select.where is not None:
+            select.compile(utils.get_column_types(cursor, select.table_name))
+
+        if select.limit is not None:
+            cursor.execute(*select.page_query(schema_cache.table(cursor, select.table_name)))
+        else:
+            query, query_params = select.statement()
+            if query_params is None:
+                cursor.execute(query)
+            else:
+                filters.statements.execute(cursor, query, query_params)
+
+        columns = [desc[0] for desc in cursor.description]
+        rows = cursor.fetchall()
+        cursor.close()
+
+    response = Response(select.encode(columns, rows), mimetype=select.mimetype)
+    if select.use_cache:
+        result_cache.put(
+            select.credentials, select.table_name, select.query, select.cache_params, generation, response
+        )
+    return response
@@ -0,0 +1,252 @@
+import base64
+import datetime
+import decimal
+import json
+import uuid
+
+from psycopg2.extras import Range  # type: ignore
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+import app.config as config
+
+try:
+    from psycopg.types.range import Range as Psycopg3Range
+except ImportError:  # pragma: no cover - psycopg 3 is only needed by the ASGI app
+    Psycopg3Range = Range
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - msgpack is optional
+    msgpack = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:  # pragma: no cover - pyarrow is optional
+    pyarrow = None
+
+# Response formats of the select endpoints and their media types, in order of preference
+FORMATS = {
+    "rows": "application/json",
+    "columnar": "application/vnd.oyda.columnar+json",
+    "msgpack": "application/x-msgpack",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+JSON_FORMATS = ("rows", "columnar")
+FORMAT_PACKAGES = {"msgpack": msgpack, "arrow": pyarrow}
+FORMAT_ALIASES = {"application/msgpack": "msgpack", "application/vnd.msgpack": "msgpack"}
+
+
+class FormatError(ValueError):
+    """
+    Raised when a request asks for an unknown or unavailable response format.
+    """
+
+
+def default(value):
+    """
+    This is a helper function that converts the Postgres values the JSON encoders don't handle
+    natively. Decimals are kept as strings so that no precision is lost, `bytea` values are base64
+    encoded, intervals become seconds and ranges become objects.
+
+    :param value: The `value` parameter is the value the encoder could not serialize.
+    :return: Returns a JSON-compatible representation of the value.
+    :raises TypeError: When the value has no JSON representation.
+    """
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(value).decode("ascii")
+    if isinstance(value, (Range, Psycopg3Range)):
+        if value.isempty:
+            return "empty"
+        return {
+            "lower": value.lower,
+            "upper": value.upper,
+            "bounds": ("[" if value.lower_inc else "(") + ("]" if value.upper_inc else ")"),
+        }
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class JSONSerializer:
+    """
+    Encodes rows with the standard library `json` module. Rows are passed as the tuples returned
+    by the cursor together with the column names, and objects keep the column order. Each row is
+    zipped into a dict so that a whole result is encoded in one call, which is faster than one
+    call per value.
+    """
+
+    name = "json"
+
+    def dumps(self, value):
+        return json.dumps(
+            value, default=default, separators=(",", ":"), ensure_ascii=False
+        ).encode("utf-8")
+
+    def dumps_rows(self, columns, rows):
+        """
+        Encodes rows as a JSON array of objects.
+
+        :param columns: The `columns` parameter is the list of column names.
+        :param rows: The `rows` parameter is a list of row tuples in column order.
+        :return: Returns the encoded array as bytes.
+        """
+        return self.dumps([dict(zip(columns, row)) for row in rows])
+
+    def dumps_ndjson(self, columns, rows):
+        """
+        Encodes rows as newline-delimited JSON objects, one line per row.
+
+        :return: Returns the encoded lines as bytes, each terminated by a newline.
+        """
+        return b"".join(self.dumps(dict(zip(columns, row))) + b"\n" for row in rows)
+
+
+class OrjsonSerializer(JSONSerializer):
+    """
+    Encodes rows with orjson, which handles dates, times and UUIDs natively and is several times
+    faster than the standard library.
+    """
+
+    name = "orjson"
+
+    def dumps(self, value):
+        return orjson.dumps(value, default=default, option=orjson.OPT_NON_STR_KEYS)
+
+
+SERIALIZERS = {"json": JSONSerializer}
+if orjson is not None:
+    SERIALIZERS["orjson"] = OrjsonSerializer
+
+
+def get_serializer(name=None):
+    """
+    This is a helper function that returns the serializer configured by `OYDA_SERIALIZER`, or the
+    one given by name. orjson is used by default when it is installed.
+
+    :param name: The `name` parameter is the name of a serializer in `SERIALIZERS`.
+    :return: Returns a serializer instance.
+    :raises ValueError: When no serializer of that name is available.
+    """
+    name = name or config.SERIALIZER or ("orjson" if orjson is not None else "json")
+    if name not in SERIALIZERS:
+        raise ValueError(f"Unknown serializer: {name}")
+    return SERIALIZERS[name]()
+
+
+serializer = get_serializer()
+
+
+def available_formats():
+    """
+    :return: Returns the names of the response formats whose packages are installed.
+    """
+    return [name for name in FORMATS if FORMAT_PACKAGES.get(name, True) is not None]
+
+
+def response_format(requested, accept):
+    """
+    This is a helper function that picks the response format of a select request, from the
+    `format` parameter if given and otherwise from the `Accept` header. Accepted media types that
+    are not available fall back to row objects.
+
+    :param requested: The `requested` parameter is the `format` request parameter, or None.
+    :param accept: The `accept` parameter is the request's `accept_mimetypes`, or the raw `Accept`
+    header.
+    :return: Returns one of the names in `FORMATS`.
+    :raises FormatError: When the requested format is unknown or its package is not installed.
+    """
+    if requested:
+        if requested not in FORMATS:
+            raise FormatError(f"Unknown format: {requested}")
+        if requested not in available_formats():
+            raise FormatError(f"The {requested} format is not available on this server")
+        return requested
+
+    if isinstance(accept, str):
+        accept = parse_accept_header(accept, MIMEAccept)
+    available = available_formats()
+    mimetypes = {FORMATS[name]: name for name in available}
+    mimetypes.update({alias: name for alias, name in FORMAT_ALIASES.items() if name in available})
+    best = accept.best_match(list(mimetypes)) if accept else None
+    return mimetypes.get(best, "rows")
+
+
+def _msgpack_default(value):
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    return default(value)
+
+
+def _arrow_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    try:
+        value = default(value)
+    except TypeError:
+        pass
+    return value if isinstance(value, str) else serializer.dumps(value).decode("utf-8")
+
+
+def _arrow_column(values):
+    values = [value.tobytes() if isinstance(value, memoryview) else value for value in values]
+    try:
+        return pyarrow.array(values)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, pyarrow.ArrowNotImplementedError):
+        # Types Arrow can't infer, e.g. UUIDs or mixed values, are sent as text.
+        return pyarrow.array([_arrow_text(value) for value in values], type=pyarrow.string())
+
+
+def encode(output, columns, rows, **extra):
+    """
+    This is a helper function that encodes a result in one of the response formats. `rows`
+    returns a JSON array of objects, or `{"rows": [...], ...extra}` when extra members are given.
+    The other formats send the column names once and the values column by column, as
+    `{"columns": [...], "data": [[...], ...], ...extra}` in JSON or MessagePack, or as an Arrow IPC
+    stream with the extra members in the schema metadata.
+
+    :param output: The `output` parameter is one of the names in `FORMATS`.
+    :param columns: The `columns` parameter is the list of column names.
+    :param rows: The `rows` parameter is a list of row tuples in column order.
+    :return: Returns the encoded body as bytes.
+    """
+    if output == "rows":
+        body = serializer.dumps_rows(columns, rows)
+        if not extra:
+            return body
+        return b'{"rows":' + body + b"," + serializer.dumps(extra)[1:]
+
+    data = list(zip(*rows)) if rows else [() for _ in columns]
+    if output == "columnar":
+        return serializer.dumps({"columns": columns, "data": data, **extra})
+    if output == "msgpack":
+        return msgpack.packb(
+            {"columns": columns, "data": data, **extra},
+            default=_msgpack_default,
+            use_bin_type=True,
+        )
+
+    table = pyarrow.Table.from_arrays([_arrow_column(values) for values in data], names=columns)
+    if extra:
+        table = table.replace_schema_metadata(
+            {name: "" if value is None else str(value) for name, value in extra.items()}
+        )
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
@@ -0,0 +1,108 @@
+import contextvars
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+import app.config as config
+
+# The session of the request being served, which the pools use to pick its connection
+_current = contextvars.ContextVar("oyda_session", default=None)
+
+
+class SessionStore:
+    """
+    Maps session tokens handed out by `set_oydabase` to the connection parameters they were
+    created with, so that later requests can send the token instead of the credentials.
+
+    A session expires `ttl` seconds after it was last used. At most `max_sessions` are kept; beyond
+    that the least recently used one is dropped. Tokens only live in this process's memory.
+    """
+
+    def __init__(self, ttl=config.SESSION_TTL, max_sessions=config.SESSION_MAX):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._stats = {"created": 0, "expired": 0, "evicted": 0, "ended": 0}
+
+    def create(self, credentials):
+        """
+        Starts a session for credentials the server has just accepted.
+
+        :param credentials: The `credentials` parameter is a (host, port, oydaBase, user, password) tuple.
+        :return: Returns the session token.
+        """
+        token = secrets.token_urlsafe(32)
+        with self._lock:
+            self._sessions[token] = (tuple(credentials), time.monotonic() + self.ttl)
+            self._stats["created"] += 1
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self._stats["evicted"] += 1
+        return token
+
+    def resolve(self, token):
+        """
+        Looks up a session and extends it.
+
+        :param token: The `token` parameter is the session token sent by the client.
+        :return: Returns the session's (host, port, oydaBase, user, password) tuple, or None if the
+        session is unknown or has expired.
+        """
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None:
+                return None
+            credentials, expires = session
+            if expires <= now:
+                del self._sessions[token]
+                self._stats["expired"] += 1
+                return None
+            self._sessions[token] = (credentials, now + self.ttl)
+            self._sessions.move_to_end(token)
+            return credentials
+
+    def is_active(self, token):
+        """
+        :return: Returns whether the session exists and has not expired, without extending it.
+        """
+        with self._lock:
+            session = self._sessions.get(token)
+            return session is not None and session[1] > time.monotonic()
+
+    def end(self, token):
+        """
+        Ends a session.
+
+        :return: Returns True if the session existed.
+        """
+        with self._lock:
+            if self._sessions.pop(token, None) is None:
+                return False
+            self._stats["ended"] += 1
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "ttl": self.ttl,
+                **self._stats,
+            }
+
+
+def current():
+    """
+    :return: Returns the token of the session the current request was made with, or None.
+    """
+    return _current.get()
+
+
+def set_current(token):
+    _current.set(token)
+
+
+session_store = SessionStore()
@@ -0,0 +1,190 @@
+import datetime
+import queue
+import re
+import threading
+from collections import deque
+
+import psycopg2  # type: ignore
+
+import app.config as config
+
+# Statements EXPLAIN accepts
+EXPLAINABLE = ("SELECT", "WITH", "VALUES", "TABLE", "INSERT", "UPDATE", "DELETE")
+
+# Quoted identifiers, which are kept, then string literals, placeholders and numbers
+_TOKENS = re.compile(r"\"(?:[^\"]|\"\")*\"|'(?:[^']|'')*'|\$\d+|%s|\b\d+(?:\.\d+)?\b")
+
+
+def normalize_sql(query):
+    """
+    This is a helper function that reduces a statement to its pattern, replacing string and
+    number literals and parameter placeholders with `?` and collapsing whitespace, so that slow
+    queries can be grouped without exposing the values they were run with.
+
+    :param query: The `query` parameter is the SQL text.
+    :return: Returns the normalized SQL text.
+    """
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    query = _TOKENS.sub(lambda m: m.group() if m.group().startswith('"') else "?", str(query))
+    return " ".join(query.split())
+
+
+class SlowQueryLog:
+    """
+    A bounded, in-memory ring of the statements that ran for longer than `threshold` seconds.
+
+    Each entry records the normalized SQL, the duration, the row count and the calling endpoint
+    and database. With `explain` set, a background thread adds the statement's
+    `EXPLAIN (FORMAT JSON)` plan, captured on a separate connection so that the caller's
+    transaction is not touched and the caller does not wait for it. At most `EXPLAIN_QUEUE_SIZE`
+    plans are pending at a time; entries beyond that are logged without a plan.
+    """
+
+    EXPLAIN_QUEUE_SIZE = 32
+
+    def __init__(
+        self,
+        threshold=config.SLOW_QUERY_THRESHOLD,
+        size=config.SLOW_QUERY_LOG_SIZE,
+        explain=config.SLOW_QUERY_EXPLAIN,
+        explain_timeout=config.SLOW_QUERY_EXPLAIN_TIMEOUT,
+    ):
+        self.threshold = threshold
+        self.explain = explain
+        self.explain_timeout = explain_timeout
+        self._lock = threading.Lock()
+        self._entries = deque(maxlen=size)
+        self._pending = queue.Queue(maxsize=self.EXPLAIN_QUEUE_SIZE)
+        self._worker = None
+        self._stats = {"recorded": 0, "explained": 0, "explain_skipped": 0, "explain_failures": 0}
+
+    def is_slow(self, seconds):
+        return 0 < self.threshold <= seconds
+
+    def record(self, conn, query, params, seconds, rows, endpoint=None):
+        """
+        Adds a slow statement to the ring.
+
+        :param conn: The `conn` parameter is the connection the statement ran on.
+        :param query: The `query` parameter is the SQL text, with placeholders.
+        :param params: The `params` parameter holds the statement's parameters, if any.
+        :param seconds: The `seconds` parameter is how long the statement took.
+        :param rows: The `rows` parameter is the cursor's row count, -1 if unknown.
+        :param endpoint: The `endpoint` parameter is the endpoint that ran the statement.
+        """
+        info = conn.info
+        query = query.decode("utf-8", "replace") if isinstance(query, bytes) else str(query)
+        query, params = _prepared_source(conn, query, params)
+        # Statements run with parameters escape literal percent signs.
+        text = query.replace("%%", "%") if params is not None else query
+        entry = {
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "sql": normalize_sql(text),
+            "duration": round(seconds, 6),
+            "rows": rows if rows is not None and rows >= 0 else None,
+            "endpoint": endpoint,
+            "database": f"{info.user}@{info.host}:{info.port}/{info.dbname}",
+            "plan": None,
+        }
+        with self._lock:
+            self._entries.append(entry)
+            self._stats["recorded"] += 1
+
+        if not self.explain:
+            return
+        words = query.split(None, 1)
+        if not words or words[0].upper() not in EXPLAINABLE:
+            return
+        try:
+            credentials = (info.host, info.port, info.dbname, info.user, info.password)
+            self._pending.put_nowait((entry, credentials, query, params))
+        except queue.Full:
+            with self._lock:
+                self._stats["explain_skipped"] += 1
+            return
+        self._start_worker()
+
+    def entries(self, details=True):
+        """
+        :param details: The `details` parameter keeps each entry's database and plan. The plan can
+        contain the statement's literal values.
+        :return: Returns the logged statements, most recent first.
+        """
+        with self._lock:
+            entries = [dict(entry) for entry in reversed(self._entries)]
+        if not details:
+            for entry in entries:
+                del entry["database"], entry["plan"]
+        return entries
+
+    def stats(self):
+        with self._lock:
+            return {
+                "threshold": self.threshold,
+                "explain": self.explain,
+                "size": len(self._entries),
+                "max_size": self._entries.maxlen,
+                **self._stats,
+            }
+
+    def _start_worker(self):
+        with self._lock:
+            if self._worker is not None:
+                return
+            self._worker = threading.Thread(
+                target=self._explain_pending, name="oyda-slow-query-explain", daemon=True
+            )
+            self._worker.start()
+
+    def _explain_pending(self):
+        while True:
+            entry, credentials, query, params = self._pending.get()
+            try:
+                plan = self._explain(credentials, query, params)
+            except Exception:
+                with self._lock:
+                    self._stats["explain_failures"] += 1
+                continue
+            with self._lock:
+                entry["plan"] = plan
+                self._stats["explained"] += 1
+
+    def _explain(self, credentials, query, params):
+        host, port, oydaBase, user, password = credentials
+        conn = psycopg2.connect(
+            dbname=oydaBase,
+            user=user,
+            password=password,
+            host=host,
+            port=port,
+            connect_timeout=max(1, int(self.explain_timeout)),
+            options=f"-c statement_timeout={int(self.explain_timeout * 1000)}",
+        )
+        try:
+            cursor = conn.cursor()
+            # Without ANALYZE the statement is only planned, never run, so writes are safe too.
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+            plan = cursor.fetchone()[0]
+            cursor.close()
+            return plan
+        finally:
+            conn.rollback()
+            conn.close()
+
+
+def _prepared_source(conn, query, params):
+    """
+    Maps the EXECUTE of a prepared statement back to the statement's SQL text, which the side
+    connection can plan and which groups with the unprepared executions of the same shape.
+    """
+    if not query.startswith("EXECUTE "):
+        return query, params
+    name = query.split()[1]
+    for source, prepared_name in list(getattr(conn, "prepared", {}).items()):
+        if prepared_name == name:
+            return source, params
+    return query, params
+
+
+slow_query_log = SlowQueryLog()
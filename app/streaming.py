@@ -0,0 +1,168 @@
+import queue
+import uuid
+
+from flask import Response
+
+import app.config as config
+import app.metrics as metrics
+import app.params as params
+from app.pool import pool
+from app.serializers import serializer
+
+STREAM_FORMATS = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+}
+STREAM_OPTIONS = (None, False, True, *STREAM_FORMATS)
+
+
+def stream_format(value):
+    """
+    This is a helper function that maps the `stream` request parameter to an output format.
+
+    :param value: The `value` parameter is the `stream` parameter from the request body, one of `STREAM_OPTIONS`.
+    :return: Returns "json", "ndjson" or None when streaming was not requested.
+    """
+    if value is None or value is False:
+        return None
+    if value is True:
+        return "json"
+    return value
+
+
+class Cancelled(Exception):
+    """
+    Raised in a thread that produces a streamed body when the body has been closed, e.g. because
+    the client went away.
+    """
+
+
+def put(items, item, cancelled):
+    """
+    This is a helper function that hands an item to the consumer of a streamed body through a
+    bounded queue, waiting while the queue is full.
+
+    :param items: The `items` parameter is the bounded `queue.Queue`.
+    :param cancelled: The `cancelled` parameter is a `threading.Event` set when the body is closed.
+    :raises Cancelled: When the body is closed while waiting.
+    """
+    while True:
+        if cancelled.is_set():
+            raise Cancelled()
+        try:
+            items.put(item, timeout=0.5)
+            return
+        except queue.Full:
+            continue
+
+
+def parse_fetch_size(fetch_size):
+    """
+    This is a helper function that validates the `fetch_size` request parameter.
+
+    :param fetch_size: The `fetch_size` parameter is the requested number of rows per round trip.
+    :return: Returns the fetch size, `STREAM_FETCH_SIZE` when none was given.
+    :raises params.ParameterError: When the fetch size is not a positive integer.
+    """
+    if not fetch_size:
+        return config.STREAM_FETCH_SIZE
+    try:
+        value = int(fetch_size)
+    except (TypeError, ValueError):
+        value = 0
+    if isinstance(fetch_size, bool) or value <= 0:
+        raise params.ParameterError("fetch_size must be a positive integer")
+    return value
+
+
+def encode_batch(serializer, output, columns, batch, first):
+    """
+    This is a helper function that encodes one batch of streamed rows. A JSON array stream opens
+    with "[" before the first batch and closes with "]" after the last one.
+
+    :param first: The `first` parameter tells whether this is the first batch of the stream.
+    :return: Returns the encoded batch as bytes.
+    """
+    with metrics.phase("serialize"):
+        if output == "ndjson":
+            return serializer.dumps_ndjson(columns, batch)
+        encoded = serializer.dumps_rows(columns, batch)[1:-1]
+    return encoded if first else b"," + encoded
+
+
+class RowStream:
+    """
+    An iterable response body that pulls rows from a server-side cursor `fetch_size` at a time.
+
+    The connection stays checked out of the pool until the body has been consumed or the server
+    closes it, e.g. because the client disconnected.
+    """
+
+    def __init__(self, conn, cursor, first_batch, output, fetch_size, serializer):
+        self.conn = conn
+        self.cursor = cursor
+        self.columns = [desc[0] for desc in cursor.description]
+        self.first_batch = first_batch
+        self.output = output
+        self.fetch_size = fetch_size
+        self.serializer = serializer
+        self.released = False
+
+    def batches(self):
+        batch = self.first_batch
+        while batch:
+            yield batch
+            batch = self.cursor.fetchmany(self.fetch_size)
+
+    def __iter__(self):
+        try:
+            if self.output == "json":
+                yield b"["
+            first = True
+            for batch in self.batches():
+                yield encode_batch(self.serializer, self.output, self.columns, batch, first)
+                first = False
+            if self.output == "json":
+                yield b"]"
+        finally:
+            self.close()
+
+    def close(self):
+        if self.released:
+            return
+        self.released = True
+        try:
+            self.cursor.close()
+        except Exception:
+            pass
+        pool.putconn(self.conn, discard=bool(self.conn.closed))
+
+
+def stream_query(credentials, query, params=None, output="json", fetch_size=None):
+    """
+    This is a helper function that runs a query on a named (server-side) cursor and returns a
+    streaming response that encodes the rows batch by batch, so memory use does not grow with the
+    size of the result.
+
+    :param credentials: The `credentials` parameter is a (host, port, oydaBase, user, password) tuple.
+    :param query: The `query` parameter is the SELECT statement to run.
+    :param params: The `params` parameter holds the query parameters, if any.
+    :param output: The `output` parameter is "json" for a JSON array or "ndjson" for one object per line.
+    :param fetch_size: The `fetch_size` parameter is the number of rows fetched per round trip.
+    :return: Returns a Flask response whose body is generated while the rows are fetched.
+    """
+    fetch_size = parse_fetch_size(fetch_size)
+
+    conn = pool.getconn(*credentials)
+    try:
+        cursor = conn.cursor(name=f"oyda_stream_{uuid.uuid4().hex}")
+        cursor.itersize = fetch_size
+        cursor.execute(query, params)
+        # Fetching the first batch up front surfaces query errors before the response starts.
+        first_batch = cursor.fetchmany(fetch_size)
+    except BaseException:
+        pool.putconn(conn, discard=bool(conn.closed))
+        raise
+
+    body = RowStream(conn, cursor, first_batch, output, fetch_size, serializer)
+    return Response(body, mimetype=STREAM_FORMATS[output])
@@ -0,0 +1,340 @@
+import io
+import queue
+import threading
+
+from flask import Response
+
+import app.config as config
+import app.parallel_scan as parallel_scan
+import app.params as params
+import app.streaming as streaming
+import app.utilities as utils
+from app.pool import pool
+from app.schema_cache import schema_cache
+
+# COPY formats and the media types of their bodies
+FORMATS = {
+    "csv": "text/csv",
+    "binary": "application/octet-stream",
+}
+
+class CopyError(ValueError):
+    """
+    Raised when an export or import request names a format or columns that can't be copied.
+    """
+
+
+def parse(data):
+    """
+    This is a helper function that validates an export or import request.
+
+    :param data: The `data` parameter is the parsed request body, or the `X-Oyda-Params` header of
+    an import.
+    :return: Returns the (credentials, table_name, copy_format, columns, header) of the request.
+    :raises params.ParameterError: When a parameter is missing.
+    :raises CopyError: When the format or the columns are invalid.
+    """
+    credentials = params.credentials(data)
+    error = params.missing(data, *params.CONNECTION_PARAMETERS, "table_name")
+    if error:
+        raise params.ParameterError(error)
+
+    copy_format = data.get("format") or "csv"
+    if copy_format not in FORMATS:
+        raise CopyError(f"format must be one of {', '.join(FORMATS)}")
+    header = bool(data.get("header", copy_format == "csv"))
+    if header and copy_format != "csv":
+        raise CopyError("header is only supported with format csv")
+
+    columns = data.get("columns")
+    if columns is not None and (
+        not isinstance(columns, list)
+        or not columns
+        or not all(isinstance(column, str) for column in columns)
+    ):
+        raise CopyError("columns must be a non-empty list of column names")
+    return credentials, data["table_name"], copy_format, columns, header
+
+
+def statement(table_name, direction, copy_format, columns=None, header=False, query=None):
+    """
+    This is a helper function that builds a COPY statement.
+
+    :param direction: The `direction` parameter is "TO STDOUT" or "FROM STDIN".
+    :param query: The `query` parameter is a SELECT to export instead of the table, if any.
+    :return: Returns the statement.
+    """
+    if query is not None:
+        source = f"({query})"
+    elif columns:
+        source = f"{table_name} ({', '.join(utils.quote_ident(column) for column in columns)})"
+    else:
+        source = table_name
+    options = f"FORMAT {copy_format}"
+    if header:
+        options += ", HEADER true"
+    return f"COPY {source} {direction} WITH ({options})"
+
+
+def select_list(columns):
+    return ", ".join(utils.quote_ident(column) for column in columns) if columns else "*"
+
+
+def check_table(cursor, table_name, columns):
+    """
+    This is a helper function that checks that the table and the requested columns exist.
+
+    :raises CopyError: When they don't.
+    """
+    if not schema_cache.table_exists(cursor, table_name):
+        raise CopyError(f"Table {table_name} does not exist")
+    if columns:
+        known = schema_cache.columns(cursor, table_name)
+        unknown = [column for column in columns if column not in known]
+        if unknown:
+            raise CopyError(f"Unknown columns: {', '.join(unknown)}")
+
+
+class ChunkWriter:
+    """
+    The file object a COPY TO writes into. psycopg2 writes one row at a time; rows are gathered
+    into chunks of `chunk_size` bytes that are put on a queue holding at most `queue_size` chunks,
+    so the COPY waits while the client is slower than Postgres.
+    """
+
+    def __init__(self, chunk_size=config.COPY_CHUNK_SIZE, queue_size=config.COPY_QUEUE_SIZE):
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue(maxsize=queue_size)
+        self.buffer = bytearray()
+        self.cancelled = threading.Event()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_size:
+            self.put(bytes(self.buffer))
+            self.buffer.clear()
+
+    def flush(self):
+        if self.buffer:
+            self.put(bytes(self.buffer))
+            self.buffer.clear()
+
+    def put(self, item):
+        streaming.put(self.chunks, item, self.cancelled)
+
+
+# The header and trailer of the binary COPY format, without header extensions
+BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + bytes(8)
+BINARY_TRAILER = b"\xff\xff"
+
+# Marks the end of a COPY TO on the chunk queue
+_DONE = object()
+
+
+class CopyOutStream:
+    """
+    An iterable response body fed by a COPY TO STDOUT, which runs on its own thread with a
+    connection checked out of the pool. The connection is returned when the COPY ends; if the
+    body is closed first, e.g. because the client went away, the COPY is cancelled and the
+    connection discarded.
+    """
+
+    def __init__(self, conn, copy_statement, writer=None):
+        self.conn = conn
+        self.statement = copy_statement
+        self.writer = writer or ChunkWriter()
+        self.first = None
+        self._lock = threading.Lock()
+        self._done = False
+        self.thread = threading.Thread(target=self._copy, name="oyda-copy-out", daemon=True)
+
+    def start(self):
+        """
+        Starts the COPY and waits for its first chunk, so that errors in the statement surface
+        before the response starts.
+        """
+        self.thread.start()
+        try:
+            self.first = self._next()
+        except BaseException:
+            self.close()
+            raise
+
+    def _copy(self):
+        discard = False
+        try:
+            cursor = self.conn.cursor()
+            cursor.copy_expert(self.statement, self.writer, size=self.writer.chunk_size)
+            cursor.close()
+            self.writer.flush()
+            self.writer.put(_DONE)
+        except streaming.Cancelled:
+            pass
+        except BaseException as e:
+            discard = bool(self.conn.closed)
+            try:
+                self.writer.put(e)
+            except streaming.Cancelled:
+                pass
+        finally:
+            with self._lock:
+                self._done = True
+                # A cancel request may still be on its way to the backend.
+                discard = discard or self.writer.cancelled.is_set()
+            pool.putconn(self.conn, discard=discard)
+
+    def _next(self):
+        item = self.writer.chunks.get()
+        if item is _DONE or isinstance(item, BaseException):
+            # The COPY is over; let its thread hand the connection back.
+            self.thread.join()
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+    def __iter__(self):
+        try:
+            chunk = self.first
+            while chunk is not _DONE:
+                if chunk:
+                    yield chunk
+                chunk = self._next()
+        finally:
+            self.close()
+
+    def close(self):
+        with self._lock:
+            if self._done or self.writer.cancelled.is_set():
+                return
+            self.writer.cancelled.set()
+            try:
+                self.conn.cancel()
+            except Exception:
+                pass
+
+
+class PartWriter(ChunkWriter):
+    """
+    The file object the COPY TO of one part of a parallel export writes into. Its chunks go to the
+    scan's queue and always end at a row boundary, so the parts' chunks can be interleaved. Binary
+    parts drop the header and the trailer of their own COPY, which the export sends once for all
+    parts.
+    """
+
+    def __init__(self, emit, binary, chunk_size=config.COPY_CHUNK_SIZE):
+        super().__init__(chunk_size)
+        self.emit = emit
+        self.binary = binary
+        self.skip = len(BINARY_HEADER) if binary else 0
+
+    def write(self, data):
+        # psycopg2 writes each message of the COPY separately: a row, or the binary trailer.
+        if self.skip:
+            skipped = min(self.skip, len(data))
+            data, self.skip = data[skipped:], self.skip - skipped
+        if self.binary and data == BINARY_TRAILER:
+            return
+        super().write(data)
+
+    def put(self, item):
+        self.emit(item)
+
+
+def scan_export(credentials, table_name, copy_format, columns, head, parts):
+    """
+    This is a helper function that streams a table out of Postgres in `parts` ranges at once, each
+    with its own COPY TO STDOUT on a connection of a `parallel_scan.ParallelScan`.
+
+    :param head: The `head` parameter is the CSV header line to send first, if any.
+    :return: Returns the response body, or None when the table can't be split.
+    """
+    binary = copy_format == "binary"
+
+    def task(conn, condition, emit):
+        writer = PartWriter(emit, binary)
+        query = f"SELECT {select_list(columns)} FROM {table_name} WHERE {condition}"
+        cursor = conn.cursor()
+        cursor.copy_expert(
+            statement(table_name, "TO STDOUT", copy_format, query=query), writer, size=writer.chunk_size
+        )
+        cursor.close()
+        writer.flush()
+
+    scan = parallel_scan.ParallelScan(credentials, table_name, parts)
+    if not scan.plan():
+        return None
+    scan.start(task)
+    if binary:
+        return parallel_scan.ScanBody(scan, head=BINARY_HEADER, tail=BINARY_TRAILER)
+    return parallel_scan.ScanBody(scan, head=head)
+
+
+def export_table(credentials, table_name, copy_format="csv", columns=None, header=False, parallel=None):
+    """
+    This is a helper function that streams a table out of Postgres with COPY TO STDOUT. Memory use
+    is bounded by the chunk queue, whatever the size of the table.
+
+    :param credentials: The `credentials` parameter is a (host, port, oydaBase, user, password) tuple.
+    :param table_name: The `table_name` parameter is a string that represents the name of the table.
+    :param copy_format: The `copy_format` parameter is one of `FORMATS`.
+    :param columns: The `columns` parameter lists the columns to export, all of them if None.
+    :param header: The `header` parameter starts a CSV export with the column names.
+    :param parallel: The `parallel` parameter is the number of parts to export concurrently, or
+    None to export with a single COPY.
+    :return: Returns a Flask response whose body is generated while Postgres sends the data.
+    :raises CopyError: When the table or a column does not exist.
+    """
+    head = b""
+    with pool.connection(*credentials) as conn:
+        cursor = conn.cursor()
+        check_table(cursor, table_name, columns)
+        if parallel and header:
+            # The parts' rows are not preceded by a header of their own.
+            buffer = io.BytesIO()
+            empty = f"SELECT {select_list(columns)} FROM {table_name} LIMIT 0"
+            cursor.copy_expert(
+                statement(table_name, "TO STDOUT", "csv", header=True, query=empty), buffer
+            )
+            head = buffer.getvalue()
+        cursor.close()
+
+    body = None
+    if parallel:
+        body = scan_export(credentials, table_name, copy_format, columns, head, parallel)
+    if body is None:
+        conn = pool.getconn(*credentials)
+        body = CopyOutStream(conn, statement(table_name, "TO STDOUT", copy_format, columns, header))
+        body.start()
+
+    extension = "csv" if copy_format == "csv" else "bin"
+    filename = table_name.replace('"', "") + "." + extension
+    return Response(
+        body,
+        mimetype=FORMATS[copy_format],
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+        },
+    )
+
+
+def import_table(credentials, table_name, body, copy_format="csv", columns=None, header=False):
+    """
+    This is a helper function that streams a request body into a table with COPY FROM STDIN, in one
+    transaction. The body is read `COPY_CHUNK_SIZE` bytes at a time as Postgres consumes it.
+
+    :param body: The `body` parameter is a file-like object with the data, e.g. the request stream.
+    :return: Returns the number of rows imported.
+    :raises CopyError: When the table or a column does not exist.
+    """
+    with pool.connection(*credentials) as conn:
+        cursor = conn.cursor()
+        check_table(cursor, table_name, columns)
+        cursor.copy_expert(
+            statement(table_name, "FROM STDIN", copy_format, columns, header),
+            body,
+            size=config.COPY_CHUNK_SIZE,
+        )
+        rows = cursor.rowcount
+        conn.commit()
+        cursor.close()
+    return rows
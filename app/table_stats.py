@@ -0,0 +1,136 @@
+import psycopg2  # type: ignore
+from psycopg2 import errors  # type: ignore
+
+import app.config as config
+import app.params as params
+
+# Catalog statistics of the requested tables, in request order. `reltuples` is the row count
+# estimated by the last VACUUM or ANALYZE, -1 if there was none yet (0 before Postgres 14). The
+# heap is the table's main data file; the table size adds its TOAST table and visibility and free
+# space maps.
+STATS_QUERY = """
+    SELECT t.name, c.oid::regclass::text, c.relkind, c.reltuples,
+           pg_total_relation_size(c.oid), pg_relation_size(c.oid), pg_indexes_size(c.oid),
+           pg_table_size(c.oid),
+           s.n_live_tup, s.n_dead_tup,
+           s.last_vacuum, s.last_autovacuum, s.last_analyze, s.last_autoanalyze
+    FROM unnest(%s::text[]) WITH ORDINALITY AS t(name, position)
+    LEFT JOIN pg_class c ON c.oid = to_regclass(t.name)
+    LEFT JOIN pg_stat_all_tables s ON s.relid = c.oid
+    ORDER BY t.position
+"""
+
+KINDS = {
+    "r": "table",
+    "p": "partitioned table",
+    "v": "view",
+    "m": "materialized view",
+    "f": "foreign table",
+    "S": "sequence",
+}
+
+
+def parse(data):
+    """
+    This is a helper function that validates a table statistics request.
+
+    :param data: The `data` parameter is the parsed request body.
+    :return: Returns the (credentials, table_names, exact, count_timeout) of the request.
+    :raises params.ParameterError: When a parameter is missing or invalid.
+    """
+    credentials = params.credentials(data)
+    tables = data.get("tables")
+    if tables is None and data.get("table_name"):
+        tables = [data["table_name"]]
+    error = params.missing(data, *params.CONNECTION_PARAMETERS)
+    if error:
+        raise params.ParameterError(error)
+    if not tables:
+        raise params.ParameterError("Missing required parameter: tables")
+    if not isinstance(tables, list) or not all(isinstance(name, str) and name for name in tables):
+        raise params.ParameterError("tables must be a list of table names")
+
+    count_timeout = data.get("count_timeout", config.TABLE_STATS_COUNT_TIMEOUT)
+    if (
+        isinstance(count_timeout, bool)
+        or not isinstance(count_timeout, (int, float))
+        or count_timeout <= 0
+    ):
+        raise params.ParameterError("count_timeout must be a positive number of seconds")
+    return credentials, tables, bool(data.get("exact", False)), count_timeout
+
+
+def _timestamp(value):
+    return value.isoformat() if value is not None else None
+
+
+def table_stats(cursor, table_names, exact=False, count_timeout=config.TABLE_STATS_COUNT_TIMEOUT):
+    """
+    This is a helper function that looks up the size and maintenance statistics of tables from the
+    catalogs in a single query, and optionally counts their rows exactly.
+
+    :param cursor: The `cursor` parameter is a database object to interact with a database.
+    :param table_names: The `table_names` parameter lists the names of the tables.
+    :param exact: The `exact` parameter adds an exact `count(*)` of each table's rows.
+    :param count_timeout: The `count_timeout` parameter is the number of seconds each count may
+    take; a count that takes longer is cancelled and reported as null with `count_timed_out`, and
+    a count that fails, e.g. for lack of privileges, is reported as null with its `count_error`.
+    :return: Returns a list with a dictionary of statistics per table, in the requested order.
+    Tables that do not exist are reported with `"exists": false`.
+    """
+    cursor.execute(STATS_QUERY, (list(table_names),))
+    rows = cursor.fetchall()
+
+    stats = []
+    for row in rows:
+        name, qualified, kind, reltuples, total, heap, indexes, table, live, dead = row[:10]
+        last_vacuum, last_autovacuum, last_analyze, last_autoanalyze = row[10:]
+        if qualified is None:
+            stats.append({"table": name, "exists": False})
+            continue
+        stats.append(
+            {
+                "table": name,
+                "exists": True,
+                "name": qualified,
+                "kind": KINDS.get(kind, kind),
+                "estimated_rows": int(reltuples) if reltuples >= 0 else None,
+                "live_rows": live,
+                "dead_rows": dead,
+                "total_bytes": total,
+                "table_bytes": table,
+                "heap_bytes": heap,
+                "index_bytes": indexes,
+                "last_vacuum": _timestamp(last_vacuum),
+                "last_autovacuum": _timestamp(last_autovacuum),
+                "last_analyze": _timestamp(last_analyze),
+                "last_autoanalyze": _timestamp(last_autoanalyze),
+            }
+        )
+
+    if exact:
+        timeout = int(count_timeout * 1000)
+        for table in stats:
+            if table["exists"]:
+                _count(cursor, table, timeout)
+    return stats
+
+
+def _count(cursor, table, timeout):
+    # Each count runs in a savepoint that is always rolled back, which also ends its timeout, so a
+    # failed count leaves the other tables and the rest of the transaction usable.
+    cursor.execute("SAVEPOINT oyda_count")
+    try:
+        cursor.execute("SET LOCAL statement_timeout = %s", (timeout,))
+        cursor.execute(f"SELECT count(*) FROM {table['name']}")
+        table["exact_rows"] = cursor.fetchone()[0]
+    except errors.QueryCanceled:
+        table["exact_rows"] = None
+        table["count_timed_out"] = True
+    except psycopg2.Error as e:
+        if cursor.connection.closed:
+            raise
+        table["exact_rows"] = None
+        table["count_error"] = str(e).strip()
+    cursor.execute("ROLLBACK TO SAVEPOINT oyda_count")
+    cursor.execute("RELEASE SAVEPOINT oyda_count")
@@ -0,0 +1,185 @@
+import hashlib
+import json
+import threading
+import time
+
+from werkzeug.http import parse_etags
+
+import app.config as config
+
+# Name of the statement trigger that counts a table's writes in oyda_table_versions
+TRIGGER_NAME = "oyda_table_version"
+
+# Creates the version counters and their trigger function and tracks the dependencies table. Other
+# tables are tracked by adding the trigger to them. Users that can't create these objects, and
+# concurrent bootstraps that lost the race, leave version lookups to the statistics fallback.
+VERSION_TRACKING = f"""
+    DO $$
+    BEGIN
+        CREATE TABLE IF NOT EXISTS oyda_table_versions (
+            table_oid OID PRIMARY KEY,
+            version BIGINT NOT NULL
+        );
+        GRANT ALL PRIVILEGES ON TABLE oyda_table_versions TO PUBLIC;
+        IF to_regprocedure('oyda_bump_table_version()') IS NULL THEN
+            CREATE FUNCTION oyda_bump_table_version() RETURNS trigger LANGUAGE plpgsql AS $body$
+            BEGIN
+                INSERT INTO oyda_table_versions AS v (table_oid, version) VALUES (TG_RELID, 1)
+                ON CONFLICT (table_oid) DO UPDATE SET version = v.version + 1;
+                RETURN NULL;
+            END
+            $body$;
+        END IF;
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_trigger
+            WHERE tgrelid = 'dependencies'::regclass AND tgname = '{TRIGGER_NAME}'
+        ) THEN
+            CREATE TRIGGER {TRIGGER_NAME}
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON dependencies
+            FOR EACH STATEMENT EXECUTE PROCEDURE oyda_bump_table_version();
+        END IF;
+    EXCEPTION WHEN insufficient_privilege OR duplicate_object OR duplicate_function OR unique_violation THEN
+        RAISE NOTICE 'table version tracking not set up: %', SQLERRM;
+    END
+    $$;
+"""
+
+TRACKING_QUERY = "SELECT to_regclass('oyda_table_versions') IS NOT NULL"
+
+# The table's oid, kind, storage file and write statistics, and the time the statistics were last
+# reset, which restarts their counters
+VERSION_QUERY = """
+    SELECT c.oid, c.relkind, c.relfilenode,
+           coalesce(s.n_tup_ins + s.n_tup_upd + s.n_tup_del, 0),
+           (SELECT stats_reset FROM pg_stat_database WHERE datname = current_database()),
+           {counter}
+    FROM pg_class c
+    LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+    WHERE c.oid = to_regclass(%s)
+"""
+
+# The trigger-maintained counter, or NULL for tables without the trigger
+COUNTER = f"""
+    CASE WHEN EXISTS (
+        SELECT 1 FROM pg_trigger t
+        WHERE t.tgrelid = c.oid AND t.tgname = '{TRIGGER_NAME}' AND t.tgenabled <> 'D'
+    ) THEN coalesce((SELECT version FROM oyda_table_versions v WHERE v.table_oid = c.oid), 0) END
+"""
+
+
+def _database_key(cursor):
+    info = cursor.connection.info
+    return (info.host, info.port, info.dbname)
+
+
+def _version(rows):
+    if not rows:
+        return None
+    oid, kind, filenode, changes, stats_reset, counter = rows[0]
+    if counter is not None:
+        return f"v{oid}.{counter}"
+    if kind != "r":
+        # Views, partitioned and foreign tables have no write statistics of their own.
+        return None
+    reset = stats_reset.timestamp() if stats_reset is not None else 0
+    return f"s{oid}.{filenode}.{changes}.{reset}"
+
+
+class TableVersions:
+    """
+    Looks up a token that changes whenever a table's contents may have changed.
+
+    Tables with the `oyda_table_version` trigger have an exact, transactional counter in
+    `oyda_table_versions`. Other plain tables fall back to the write counters of
+    `pg_stat_user_tables`, which Postgres publishes up to about ten seconds after another
+    session's write commits, so a poll may be answered with a stale 304 for that long. Whether a database has the counters table is cached for `ttl` seconds.
+
+    Like the schema cache, the lookup is a generator that asks its driver to run queries, so that
+    psycopg2 cursors (`version`) and async psycopg cursors (`version_async`) share it.
+    """
+
+    def __init__(self, ttl=config.SCHEMA_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._tracking = {}
+
+    def invalidate(self, cursor):
+        """
+        Forgets whether the cursor's database tracks versions, e.g. after setting up tracking.
+        """
+        with self._lock:
+            self._tracking.pop(_database_key(cursor), None)
+
+    def _lookup(self, key, table_name):
+        # Yields (query, params) to run and receives the rows.
+        now = time.monotonic()
+        with self._lock:
+            tracking = self._tracking.get(key)
+        if tracking is None or now - tracking[1] > self.ttl:
+            rows = yield TRACKING_QUERY, None
+            tracking = (bool(rows[0][0]), now)
+            with self._lock:
+                self._tracking[key] = tracking
+
+        counter = COUNTER if tracking[0] else "NULL"
+        rows = yield VERSION_QUERY.format(counter=counter), (table_name,)
+        return _version(rows)
+
+    def version(self, cursor, table_name):
+        """
+        Looks up the version of a table.
+
+        :param cursor: The `cursor` parameter is a database object to interact with a database.
+        :param table_name: The `table_name` parameter is a string that represents the name of the table.
+        :return: Returns the version as a string, or None if the table does not exist or its
+        changes can't be tracked.
+        """
+        lookup = self._lookup(_database_key(cursor), table_name)
+        try:
+            query = next(lookup)
+            while True:
+                cursor.execute(*query)
+                query = lookup.send(cursor.fetchall())
+        except StopIteration as done:
+            return done.value
+
+    async def version_async(self, cursor, table_name):
+        """
+        Looks up the version of a table like `version`, for an async psycopg cursor.
+        """
+        lookup = self._lookup(_database_key(cursor), table_name)
+        try:
+            query = next(lookup)
+            while True:
+                await cursor.execute(*query)
+                query = lookup.send(await cursor.fetchall())
+        except StopIteration as done:
+            return done.value
+
+
+def etag(*parts):
+    """
+    This is a helper function that derives an entity tag from a table version and everything else
+    that shapes a response.
+
+    :param parts: The `parts` parameter holds JSON-serializable values; the version among them.
+    :return: Returns the tag, without quotes.
+    """
+    encoded = json.dumps(parts, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:32]
+
+
+def matches(if_none_match, tag):
+    """
+    This is a helper function that evaluates an `If-None-Match` header with the weak comparison.
+
+    :param if_none_match: The `if_none_match` parameter is the raw header, or None.
+    :param tag: The `tag` parameter is the current tag of the response, without quotes.
+    :return: Returns True if the client's copy is current and the response can be a 304.
+    """
+    if not if_none_match or tag is None:
+        return False
+    return parse_etags(if_none_match).contains_weak(tag)
+
+
+table_versions = TableVersions()
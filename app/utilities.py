@@ -1,24 +1,93 @@
-import random
+from app.schema_cache import schema_cache
+from app.table_versions import VERSION_TRACKING, table_versions
 
 
 def check_table_exists(cursor, table_name):
     """
-    This is a helper function that checks if a table exists in the oydabase.
+    This is a helper function that checks if a table exists in the oydabase, using the cached
+    schema catalog.
     
     :param cursor: The `cursor` parameter is a database object to interact with a database.
     :param table_name: The `table_name` parameter is a string that represents the name of the table.
     :return: Returns a boolean value indicating whether the table exists in the oydabase.
     """
-    cursor.execute(
-        f"""
-        SELECT EXISTS (
-            SELECT FROM information_schema.tables 
-            WHERE table_schema = 'public' 
-            AND table_name = '{table_name}'
-        );
-        """
+    return schema_cache.table_exists(cursor, table_name)
+
+DEPENDENCIES_TABLE = """
+    CREATE TABLE IF NOT EXISTS dependencies (
+        name VARCHAR(255) NOT NULL,
+        version VARCHAR(255) NOT NULL
+    );
+"""
+
+DEVS_TABLE = """
+    CREATE TABLE IF NOT EXISTS devs (
+        username VARCHAR(255) NOT NULL UNIQUE,
+        dev_key INTEGER NOT NULL UNIQUE
+    );
+"""
+
+# Adds the unique indexes to `devs` tables created before they were part of DEVS_TABLE. Tables
+# that already hold duplicate usernames or keys are left as they are, with a warning naming the
+# duplicates, since only their owners can tell which row is right; the index is created by the
+# first bootstrap after they are resolved. Users that don't own the table can't create indexes;
+# allocation still works for them, just without the uniqueness guarantee.
+DEVS_TABLE_MIGRATION = """
+    DO $$
+    DECLARE
+        duplicates TEXT;
+    BEGIN
+        IF to_regclass('public.devs_username_key') IS NULL THEN
+            SELECT string_agg(quote_literal(username), ', ') INTO duplicates
+            FROM (SELECT username FROM devs GROUP BY username HAVING count(*) > 1) d;
+            IF duplicates IS NULL THEN
+                CREATE UNIQUE INDEX devs_username_key ON devs (username);
+            ELSE
+                RAISE WARNING 'devs_username_key not created, duplicate usernames in devs: %',
+                    duplicates;
+            END IF;
+        END IF;
+        IF to_regclass('public.devs_dev_key_key') IS NULL THEN
+            SELECT string_agg(dev_key::text, ', ') INTO duplicates
+            FROM (SELECT dev_key FROM devs GROUP BY dev_key HAVING count(*) > 1) d;
+            IF duplicates IS NULL THEN
+                CREATE UNIQUE INDEX devs_dev_key_key ON devs (dev_key);
+            ELSE
+                RAISE WARNING 'devs_dev_key_key not created, duplicate dev keys in devs: %',
+                    duplicates;
+            END IF;
+        END IF;
+    EXCEPTION WHEN insufficient_privilege THEN
+        RAISE NOTICE 'devs unique indexes not created: %', SQLERRM;
+    END
+    $$;
+"""
+
+# Returns the user's existing key, or inserts a random unused one, in a single statement. Zero rows
+# come back only if a concurrent call claimed the username or the candidate keys first.
+ALLOCATE_DEV_KEY = """
+    WITH existing AS (
+        SELECT dev_key FROM devs WHERE username = %(username)s
+    ), inserted AS (
+        INSERT INTO devs (username, dev_key)
+        SELECT %(username)s, candidates.dev_key
+        FROM (
+            SELECT DISTINCT (100000 + floor(random() * 900000))::int AS dev_key
+            FROM generate_series(1, 8)
+        ) candidates
+        WHERE NOT EXISTS (SELECT 1 FROM existing)
+          AND NOT EXISTS (SELECT 1 FROM devs WHERE devs.dev_key = candidates.dev_key)
+        LIMIT 1
+        ON CONFLICT DO NOTHING
+        RETURNING dev_key
     )
-    return cursor.fetchone()[0]
+    SELECT dev_key FROM existing
+    UNION ALL
+    SELECT dev_key FROM inserted
+"""
+
+# Databases whose dependencies and devs tables are known to exist, keyed by (host, port, oydaBase).
+bootstrapped_oydabases = set()
 
 def create_dependencies_table(cursor):
     """
@@ -26,14 +95,8 @@ def create_dependencies_table(cursor):
     
     :param cursor: The `cursor` parameter is a database object to interact with a database.
     """
-    cursor.execute(
-        """
-        CREATE TABLE dependencies (
-            name VARCHAR(255) NOT NULL,
-            version VARCHAR(255) NOT NULL
-        );
-        """
-    )
+    cursor.execute(DEPENDENCIES_TABLE)
+    schema_cache.invalidate(cursor, "dependencies")
 
 def create_devs_table(cursor):
     """
@@ -41,46 +104,78 @@ def create_devs_table(cursor):
     
     :param cursor: The `cursor` parameter is a database object to interact with a database.
     """
-    cursor.execute(
-        """
-        CREATE TABLE devs (
-            username VARCHAR(255) NOT NULL,
-            dev_key INTEGER NOT NULL
-        );
-        """
-    )
+    cursor.execute(DEVS_TABLE)
+    schema_cache.invalidate(cursor, "devs")
 
-def generate_unique_dev_key(cursor):
+def bootstrap_oydabase(cursor):
     """
-    This is a helper function that generates a unique developer key by randomly selecting a number
-    and checking if it already exists in a database table.
+    This is a helper function that creates the `dependencies` and `devs` tables if they don't
+    exist, migrates older `devs` tables to have unique indexes, grants access to them and sets up
+    version tracking for `dependencies`, sending all statements in a single round trip. It is
+    idempotent, so the caller can commit it as one transaction without checking first.
 
-    :param cursor: The `cursor` parameter is a database object to interact with a database. I
-    :return: Returns a unique developer key that is not already present in the database table `devs`.
+    :param cursor: The `cursor` parameter is a database object to interact with a database.
     """
-    while True:
-        dev_key = random.randint(100000, 999999)
-        cursor.execute(
-            "SELECT EXISTS (SELECT 1 FROM devs WHERE dev_key = %s)", (dev_key,)
-        )
-        if not cursor.fetchone()[0]:
-            return dev_key
-        
+    cursor.execute(
+        DEPENDENCIES_TABLE
+        + DEVS_TABLE
+        + DEVS_TABLE_MIGRATION
+        + """
+        GRANT ALL PRIVILEGES ON TABLE dependencies TO PUBLIC;
+        GRANT ALL PRIVILEGES ON TABLE devs TO PUBLIC;
+        """
+        + VERSION_TRACKING
+    )
+    schema_cache.invalidate(cursor, "dependencies")
+    schema_cache.invalidate(cursor, "devs")
+    table_versions.invalidate(cursor)
+
 def get_or_create_dev_key(cursor, username):
     """
     This is a helper function that retrieves a developer key for a given username from the database
     table `devs`. If the username is not present in the table, a new developer key is generated and
-    inserted into the table.
+    inserted into the table. Both cases take a single statement backed by the unique indexes on
+    `username` and `dev_key`, so concurrent calls can't hand out the same key twice.
     
     :param cursor: The `cursor` parameter is a database object to interact with a database.
     :param username: The `username` parameter is a string that represents the username.
     :return: Returns a developer key for a given username.
     """
-    cursor.execute("SELECT dev_key FROM devs WHERE username = %s", (username,))
-    result = cursor.fetchone()
-    if result:
-        return result[0]
-    else:
-        dev_key = generate_unique_dev_key(cursor)
-        cursor.execute("INSERT INTO devs (username, dev_key) VALUES (%s, %s)", (username, dev_key))
-        return dev_key
\ No newline at end of file
+    for _ in range(5):
+        cursor.execute(ALLOCATE_DEV_KEY, {"username": username})
+        result = cursor.fetchone()
+        if result:
+            return result[0]
+    raise RuntimeError(f"Could not allocate a developer key for {username}")
+
+def quote_ident(name):
+    """
+    This is a helper function that quotes a column name so it can be embedded safely in a query.
+
+    :param name: The `name` parameter is a string that represents the identifier.
+    :return: Returns the identifier wrapped in double quotes with embedded quotes doubled.
+    """
+    return '"' + str(name).replace('"', '""') + '"'
+
+def get_primary_key(cursor, table_name):
+    """
+    This is a helper function that looks up the primary key columns of a table in the cached
+    schema catalog.
+
+    :param cursor: The `cursor` parameter is a database object to interact with a database.
+    :param table_name: The `table_name` parameter is a string that represents the name of the table.
+    :return: Returns the primary key column names in key order, or an empty list if there is none.
+    """
+    return schema_cache.primary_key(cursor, table_name)
+
+def get_column_types(cursor, table_name):
+    """
+    This is a helper function that looks up the columns of a table and their SQL types in the
+    cached schema catalog.
+
+    :param cursor: The `cursor` parameter is a database object to interact with a database.
+    :param table_name: The `table_name` parameter is a string that represents the name of the table.
+    :return: Returns a dictionary mapping each column name to its type without modifiers, e.g.
+    "character varying" for a varchar(255), or an empty dictionary if the table does not exist.
+    """
+    return schema_cache.columns(cursor, table_name)
@@ -0,0 +1,525 @@
+"""
+Load test of the API endpoints against a real Postgres.
+
+Creates a fresh benchmark database (or a throwaway Postgres cluster with `--throwaway`), seeds a
+table of `--rows` rows, starts the app in a subprocess with pub.dev replaced by a local stub, and
+drives `select_table`, `select_rows`, `insert_row`, `update_row`, `set_oydabase` and
+`add_dependency` one after another at `--concurrency` concurrent clients. Each endpoint reports its
+throughput, p50/p95/p99 latency, errors and the peak RSS of the server process. Results are
+written as JSON, tagged with the git commit, and can be compared with an earlier run. Run from the
+repository root:
+
+    python -m benchmarks.load --host localhost --user postgres --password secret \\
+        --rows 100000 --concurrency 16 --duration 10 --output load.json
+    python -m benchmarks.load ... --compare baseline.json
+
+The clients run in this process, so at high concurrency they can become the bottleneck; compare
+runs made with the same settings on the same machine.
+"""
+import argparse
+import datetime
+import http.server
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2  # type: ignore
+import requests
+
+ENDPOINTS = ["select_table", "select_rows", "insert_row", "update_row", "set_oydabase", "add_dependency"]
+TABLE = "bench_items"
+SEED_CHUNK = 1000000
+STUB_VERSION = "1.0.0"
+
+SERVERS = {
+    "flask": "{python} -m flask --app run:app run --host 127.0.0.1 --port {port} --with-threads",
+    "asgi": "{python} -m uvicorn asgi:app --host 127.0.0.1 --port {port} --log-level warning",
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+class ThrowawayPostgres:
+    """
+    A temporary Postgres cluster with trust authentication, created with `initdb` and removed on
+    exit.
+    """
+
+    def __init__(self, bin_dir=None, user="oyda"):
+        self.bin_dir = bin_dir
+        self.user = user
+        self.port = free_port()
+        self.directory = tempfile.mkdtemp(prefix="oyda-bench-")
+
+    def _command(self, name):
+        return os.path.join(self.bin_dir, name) if self.bin_dir else name
+
+    def __enter__(self):
+        data = os.path.join(self.directory, "data")
+        subprocess.run(
+            [self._command("initdb"), "-D", data, "-U", self.user, "-A", "trust", "-E", "UTF8"],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        options = f"-p {self.port} -k {self.directory} -c listen_addresses=127.0.0.1"
+        subprocess.run(
+            [self._command("pg_ctl"), "-D", data, "-o", options, "-w", "-l",
+             os.path.join(self.directory, "postgres.log"), "start"],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        return self
+
+    def __exit__(self, *exc):
+        subprocess.run(
+            [self._command("pg_ctl"), "-D", os.path.join(self.directory, "data"), "-m", "fast", "stop"],
+            stdout=subprocess.DEVNULL,
+        )
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def seed(args):
+    """
+    Recreates the benchmark database and fills its table with `args.rows` rows.
+    """
+    admin = psycopg2.connect(
+        dbname=args.maintenance_db, user=args.user, password=args.password, host=args.host, port=args.port
+    )
+    admin.autocommit = True
+    cursor = admin.cursor()
+    cursor.execute(f'DROP DATABASE IF EXISTS "{args.database}"')
+    cursor.execute(f"CREATE DATABASE \"{args.database}\" ENCODING 'UTF8' TEMPLATE template0")
+    admin.close()
+
+    conn = psycopg2.connect(
+        dbname=args.database, user=args.user, password=args.password, host=args.host, port=args.port
+    )
+    cursor = conn.cursor()
+    cursor.execute(
+        f"""
+        CREATE TABLE {TABLE} (
+            id bigserial PRIMARY KEY,
+            name text NOT NULL,
+            price numeric(12, 2),
+            quantity integer,
+            created_at timestamptz DEFAULT now(),
+            active boolean
+        )
+        """
+    )
+    start = time.perf_counter()
+    for first in range(1, args.rows + 1, SEED_CHUNK):
+        last = min(first + SEED_CHUNK - 1, args.rows)
+        cursor.execute(
+            f"""
+            INSERT INTO {TABLE} (name, price, quantity, created_at, active)
+            SELECT 'item ' || i, (i %% 100000) / 100.0, i %% 1000,
+                   timestamptz '2024-01-01' + i * interval '1 second', i %% 2 = 0
+            FROM generate_series(%s, %s) AS i
+            """,
+            (first, last),
+        )
+        conn.commit()
+        log(f"seeded {last:,} of {args.rows:,} rows")
+    cursor.execute(f"ANALYZE {TABLE}")
+    conn.commit()
+    conn.close()
+    log(f"seeded in {time.perf_counter() - start:.1f}s")
+
+
+class PubDevStub(http.server.BaseHTTPRequestHandler):
+    """
+    Answers every package lookup with the same version after `delay` seconds.
+    """
+
+    delay = 0.0
+
+    def do_GET(self):
+        if self.delay:
+            time.sleep(self.delay)
+        body = json.dumps({"latest": {"version": STUB_VERSION}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_pubdev_stub(delay):
+    handler = type("PubDevStub", (PubDevStub,), {"delay": delay})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_server(args, pubdev_url):
+    """
+    Starts the app in a subprocess and waits until it answers.
+
+    :return: Returns the (process, base URL) of the server.
+    """
+    port = free_port()
+    command = (args.command or SERVERS[args.server]).format(python=sys.executable, port=port)
+    env = dict(os.environ, OYDA_PUBDEV_URL=pubdev_url)
+    output = open(args.server_log, "ab") if args.server_log else subprocess.DEVNULL
+    process = subprocess.Popen(command.split(), env=env, stdout=output, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with status {process.returncode}: {command}")
+        try:
+            requests.get(f"{base_url}/api/pool_stats", timeout=1)
+            return process, base_url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"Server did not start within 30s: {command}")
+
+
+class RssSampler:
+    """
+    Samples the resident set size of a process from /proc while a scenario runs. Where /proc is
+    not available, only the peak over the whole run is reported, from `getrusage`.
+    """
+
+    def __init__(self, pid, interval=0.05):
+        self.path = f"/proc/{pid}/status"
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _read(self, field):
+        try:
+            with open(self.path) as status:
+                for line in status:
+                    if line.startswith(field):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def _sample(self):
+        while not self._stop.is_set():
+            rss = self._read("VmRSS:")
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = None
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def high_water_mark(self):
+        return self._read("VmHWM:")
+
+
+def payloads(args, endpoint):
+    """
+    :return: Returns a function that builds the body of the n-th request to `endpoint`.
+    """
+    credentials = {
+        "host": args.host,
+        "port": str(args.port),
+        "oydaBase": args.database,
+        "user": args.user,
+        "password": args.password or "bench",
+    }
+    cache = {"cache": args.cache}
+    rows = max(args.rows, 1)
+    run = random.getrandbits(32)
+
+    def select_table(n):
+        body = {**credentials, **cache, "table_name": TABLE}
+        if args.page_size:
+            body["limit"] = args.page_size
+        return body
+
+    def select_rows(n):
+        first = random.randint(1, max(rows - args.page_size, 1))
+        where = {"id": {"gte": first, "lt": first + args.page_size}}
+        return {**credentials, **cache, "table_name": TABLE, "where": where}
+
+    def insert_row(n):
+        row = {"name": f"bench {n}", "price": f"{n % 1000}.50", "quantity": n % 1000, "active": "true"}
+        return {**credentials, "table_name": TABLE, "row": row}
+
+    def update_row(n):
+        where = {"id": random.randint(1, rows)}
+        return {**credentials, "table_name": TABLE, "where": where, "row": {"quantity": n % 1000}}
+
+    def set_oydabase(n):
+        return credentials
+
+    def add_dependency(n):
+        return {**credentials, "package_name": f"bench_{run:x}_{n}"}
+
+    builders = {
+        "select_table": select_table,
+        "select_rows": select_rows,
+        "insert_row": insert_row,
+        "update_row": update_row,
+        "set_oydabase": set_oydabase,
+        "add_dependency": add_dependency,
+    }
+    return builders[endpoint]
+
+
+def percentile(latencies, fraction):
+    index = min(len(latencies) - 1, max(0, round(fraction * len(latencies)) - 1))
+    return latencies[index]
+
+
+def drive(base_url, endpoint, payload, args):
+    """
+    Sends requests to one endpoint from `args.concurrency` clients until `args.duration` seconds
+    or `args.requests` requests have passed, after `args.warmup` seconds that are not measured.
+
+    :return: Returns the endpoint's results.
+    """
+    counter = itertools.count()
+    url = f"{base_url}/api/{endpoint}"
+    warmup_end = time.monotonic() + args.warmup
+    deadline = warmup_end + args.duration
+    lock = threading.Lock()
+    latencies = []
+    errors = {}
+
+    def client():
+        session = requests.Session()
+        measured = []
+        while True:
+            n = next(counter)
+            now = time.monotonic()
+            if args.requests and n >= args.requests or not args.requests and now >= deadline:
+                break
+            body = json.dumps(payload(n))
+            start = time.perf_counter()
+            try:
+                response = session.post(url, data=body, timeout=args.timeout)
+                response.content
+                status = response.status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - start
+            if args.requests or now >= warmup_end:
+                if status in (200, 201):
+                    measured.append(elapsed)
+                else:
+                    with lock:
+                        errors[str(status)] = errors.get(str(status), 0) + 1
+        session.close()
+        with lock:
+            latencies.extend(measured)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for future in [executor.submit(client) for _ in range(args.concurrency)]:
+            future.result()
+    seconds = time.monotonic() - (start if args.requests else warmup_end)
+
+    latencies.sort()
+    result = {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "throughput": round(len(latencies) / seconds, 1) if seconds else None,
+    }
+    if latencies:
+        result["latency_ms"] = {
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3),
+            "p50": round(percentile(latencies, 0.50) * 1000, 3),
+            "p95": round(percentile(latencies, 0.95) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3),
+        }
+    return result
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = bool(
+            subprocess.run(
+                ["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True
+            ).stdout.strip()
+        )
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def run(args):
+    if not args.no_seed:
+        seed(args)
+
+    pubdev = start_pubdev_stub(args.pubdev_delay)
+    pubdev_url = f"http://127.0.0.1:{pubdev.server_address[1]}/api/packages"
+    process, base_url = start_server(args, pubdev_url)
+    sampler = RssSampler(process.pid)
+    commit, dirty = git_commit()
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "server": args.command or args.server,
+        "rows": args.rows,
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "requests": args.requests,
+        "page_size": args.page_size,
+        "cache": args.cache,
+        "results": {},
+    }
+    try:
+        # Bootstrap the dependencies table before add_dependency runs on its own.
+        requests.post(f"{base_url}/api/set_oydabase", data=json.dumps(payloads(args, "set_oydabase")(0)))
+        for endpoint in args.endpoints:
+            log(f"driving {endpoint} at concurrency {args.concurrency}")
+            with sampler:
+                result = drive(base_url, endpoint, payloads(args, endpoint), args)
+            result["peak_rss_bytes"] = sampler.peak
+            report["results"][endpoint] = result
+        peaks = [result["peak_rss_bytes"] for result in report["results"].values()]
+        peaks.append(sampler.high_water_mark())
+        report["peak_rss_bytes"] = max(filter(None, peaks), default=None)
+    finally:
+        process.terminate()
+        process.wait()
+        pubdev.shutdown()
+    if report.get("peak_rss_bytes") is None:
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+        peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        report["peak_rss_bytes"] = peak if sys.platform == "darwin" else peak * 1024
+    return report
+
+
+def print_report(report):
+    print(f"commit {report['commit']}{' (dirty)' if report['dirty'] else ''}, server {report['server']}, "
+          f"{report['rows']:,} rows, concurrency {report['concurrency']}")
+    print(f"{'endpoint':<16}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}{'RSS MiB':>9}")
+    for endpoint, result in report["results"].items():
+        latency = result.get("latency_ms", {})
+        rss = result["peak_rss_bytes"]
+        print(
+            f"{endpoint:<16}{result['throughput'] or 0:>10,.1f}"
+            f"{latency.get('p50', 0):>10.2f}{latency.get('p95', 0):>10.2f}{latency.get('p99', 0):>10.2f}"
+            f"{sum(result['errors'].values()):>8}{rss / 2**20 if rss else 0:>9.1f}"
+        )
+    print(f"peak RSS {report['peak_rss_bytes'] / 2**20:.1f} MiB")
+    print()
+
+
+def change(old, new):
+    if not old or new is None:
+        return "n/a"
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+def compare(baseline, report):
+    """
+    Prints the change of each endpoint's throughput, latency and peak RSS relative to a baseline
+    run. Lower latency and RSS and higher throughput are better.
+    """
+    print(f"compared with {baseline['commit']}, server {baseline['server']}, "
+          f"{baseline['rows']:,} rows, concurrency {baseline['concurrency']}")
+    print(f"{'endpoint':<16}{'req/s':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'RSS':>10}")
+    for endpoint, result in report["results"].items():
+        old = baseline["results"].get(endpoint)
+        if old is None:
+            continue
+        latency, old_latency = result.get("latency_ms", {}), old.get("latency_ms", {})
+        print(
+            f"{endpoint:<16}{change(old['throughput'], result['throughput']):>10}"
+            + "".join(
+                f"{change(old_latency.get(name), latency.get(name)):>10}" for name in ("p50", "p95", "p99")
+            )
+            + f"{change(old['peak_rss_bytes'], result['peak_rss_bytes']):>10}"
+        )
+    print(f"{'peak RSS':<16}{'':>40}{change(baseline['peak_rss_bytes'], report['peak_rss_bytes']):>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5432)
+    parser.add_argument("--user", default=os.environ.get("USER", "postgres"))
+    parser.add_argument("--password", default="")
+    parser.add_argument("--database", default="oyda_bench", help="dropped and recreated unless --no-seed")
+    parser.add_argument("--maintenance-db", default="postgres")
+    parser.add_argument("--throwaway", action="store_true", help="run a temporary cluster with initdb")
+    parser.add_argument("--pg-bin", help="directory of initdb and pg_ctl for --throwaway")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--no-seed", action="store_true", help="reuse the database of an earlier run")
+    parser.add_argument("--server", choices=sorted(SERVERS), default="flask")
+    parser.add_argument("--command", help="server command line with {python} and {port} placeholders")
+    parser.add_argument("--server-log", help="append the server's output to this file")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=ENDPOINTS)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per endpoint")
+    parser.add_argument("--warmup", type=float, default=2.0, help="unmeasured seconds per endpoint")
+    parser.add_argument("--requests", type=int, help="send this many requests instead of timing")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--page-size", type=int, default=100, help="rows per select, 0 reads whole tables")
+    parser.add_argument("--cache", action="store_true", help="let selects use the result cache")
+    parser.add_argument("--pubdev-delay", type=float, default=0.0, help="seconds the pub.dev stub waits")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--load", help="JSON results to report or compare instead of running")
+    args = parser.parse_args()
+
+    if args.load:
+        with open(args.load) as f:
+            report = json.load(f)
+    elif args.throwaway:
+        with ThrowawayPostgres(args.pg_bin, args.user) as cluster:
+            args.host, args.port = "127.0.0.1", cluster.port
+            report = run(args)
+    else:
+        report = run(args)
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Microbenchmark of the row serializers used by the select endpoints.
+
+Compares the previous path (a dict per row, then Flask's `jsonify`) with the `json` and `orjson`
+serializers of `app.serializers`, and the row-object output with the columnar response formats
+that are installed, on rows shaped like a typical table: integers, text, numeric, timestamps,
+UUIDs and booleans. Run from the repository root:
+
+    python -m benchmarks.serialization --rows 100000 --repeat 5
+"""
+import argparse
+import datetime
+import decimal
+import time
+import uuid
+
+from flask import jsonify
+
+from app import create_app
+from app.serializers import SERIALIZERS, available_formats, encode
+
+COLUMNS = ["id", "name", "price", "created_at", "token", "active"]
+
+
+def make_rows(count):
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    return [
+        (
+            i,
+            f"row {i}",
+            decimal.Decimal(i) / 100,
+            start + datetime.timedelta(seconds=i),
+            uuid.UUID(int=i),
+            i % 2 == 0,
+        )
+        for i in range(count)
+    ]
+
+
+def flask_jsonify(columns, rows):
+    result = []
+    for row in rows:
+        result.append(dict(zip(columns, row)))
+    return jsonify(result).get_data()
+
+
+def report(title, candidates, rows, repeat):
+    baseline = None
+    print(f"{title:<15}{'seconds':>10}{'rows/s':>14}{'bytes':>12}{'speedup':>9}")
+    for name, function in candidates.items():
+        seconds, size = best_of(repeat, function, COLUMNS, rows)
+        baseline = baseline or seconds
+        print(
+            f"{name:<15}{seconds:>10.4f}{len(rows) / seconds:>14,.0f}"
+            f"{size:>12,}{baseline / seconds:>8.1f}x"
+        )
+    print()
+
+
+def best_of(repeat, function, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = function(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    candidates = {"flask jsonify": flask_jsonify}
+    for name, serializer_class in SERIALIZERS.items():
+        candidates[name] = serializer_class().dumps_rows
+
+    formats = {
+        name: lambda columns, rows, name=name: encode(name, columns, rows)
+        for name in available_formats()
+    }
+
+    with create_app().app_context():
+        report("serializer", candidates, rows, args.repeat)
+        report("format", formats, rows, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
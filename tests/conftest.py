@@ -0,0 +1,23 @@
+import os
+
+import pytest
+
+# The integration tests run against the database named by OYDA_TEST_DATABASE, with the
+# credentials in the other OYDA_TEST_* variables, and are skipped without it
+TEST_DATABASE = os.environ.get("OYDA_TEST_DATABASE")
+
+
+@pytest.fixture
+def credentials():
+    """
+    :return: Returns the (host, port, oydaBase, user, password) tuple of the test database.
+    """
+    if not TEST_DATABASE:
+        pytest.skip("OYDA_TEST_DATABASE is not set")
+    return (
+        os.environ.get("OYDA_TEST_HOST", "localhost"),
+        int(os.environ.get("OYDA_TEST_PORT", "5432")),
+        TEST_DATABASE,
+        os.environ.get("OYDA_TEST_USER", "postgres"),
+        os.environ.get("OYDA_TEST_PASSWORD", ""),
+    )
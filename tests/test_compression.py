@@ -0,0 +1,61 @@
+import gzip
+
+import pytest
+
+import app.compression as compression
+import app.config as config
+
+
+@pytest.fixture(autouse=True)
+def all_encodings(monkeypatch):
+    # Negotiation only depends on which packages are installed, not on the packages themselves.
+    for name in compression.ENCODINGS:
+        monkeypatch.setitem(compression.ENCODINGS[name], "package", compression.zlib)
+    monkeypatch.setattr(config, "COMPRESSION_ENABLED", True)
+    monkeypatch.setattr(config, "COMPRESSION_MIN_SIZES", {})
+    monkeypatch.setattr(config, "COMPRESSION_LEVELS", {})
+
+
+def test_server_preference_among_equal_qualities():
+    assert compression.negotiate("gzip, br, zstd") == "zstd"
+    assert compression.negotiate("gzip, br") == "br"
+
+
+def test_client_qualities_win():
+    assert compression.negotiate("zstd;q=0.5, gzip") == "gzip"
+    assert compression.negotiate("*;q=0.1, br") == "br"
+
+
+def test_nothing_acceptable():
+    assert compression.negotiate("identity") is None
+    assert compression.negotiate("") is None
+    assert compression.negotiate("gzip;q=0") is None
+
+
+def test_missing_packages_are_not_offered(monkeypatch):
+    monkeypatch.setitem(compression.ENCODINGS["zstd"], "package", None)
+    assert compression.available_encodings() == ["br", "gzip"]
+    assert compression.negotiate("zstd, gzip") == "gzip"
+
+
+def test_endpoints_can_opt_out(monkeypatch):
+    monkeypatch.setattr(config, "COMPRESSION_MIN_SIZES", {"export_table": -1})
+    assert compression.negotiate("gzip", "export_table") is None
+    assert compression.negotiate("gzip", "select_table") == "gzip"
+    monkeypatch.setattr(config, "COMPRESSION_ENABLED", False)
+    assert compression.negotiate("gzip", "select_table") is None
+
+
+def test_levels_are_configurable_and_clamped(monkeypatch):
+    monkeypatch.setattr(config, "COMPRESSION_LEVELS", {"gzip": 3, "select_table.gzip": 99})
+    assert compression.level("gzip", "export_table") == 3
+    assert compression.level("gzip", "select_table") == 9
+    assert compression.level("br", "select_table") == 4
+
+
+def test_streamed_chunks_decode_as_they_arrive():
+    stream = compression.compress_stream("gzip", 6, [b"a" * 100, b"b" * 100])
+    first = next(stream)
+    decoder = gzip.zlib.decompressobj(31)
+    assert decoder.decompress(first) == b"a" * 100
+    assert gzip.decompress(first + b"".join(stream)) == b"a" * 100 + b"b" * 100
@@ -0,0 +1,63 @@
+import pytest
+
+from app.filters import FilterError, compile_where
+
+COLUMN_TYPES = {"age": "integer", "name": "text", "50%": "text"}
+
+
+def test_equality_and_null_shorthands():
+    condition, params = compile_where({"age": 30, "name": None}, COLUMN_TYPES, "people")
+    assert condition == '("age" = %s::integer AND "name" IS NULL)'
+    assert params == [30]
+
+
+def test_operators_cast_to_the_column_type():
+    condition, params = compile_where(
+        {"age": {"gte": 18, "lt": 65}, "name": {"in": ["a", "b"]}}, COLUMN_TYPES, "people"
+    )
+    assert condition == (
+        '("age" >= %s::integer AND "age" < %s::integer AND "name" = ANY(%s::text[]))'
+    )
+    assert params == [18, 65, ["a", "b"]]
+
+
+def test_nested_and_or_not():
+    condition, params = compile_where(
+        {"or": [{"age": {"gt": 30}}, {"not": {"name": {"like": "a%"}}}]}, COLUMN_TYPES, "people"
+    )
+    assert condition == '("age" > %s::integer OR NOT ("name" LIKE %s))'
+    assert params == [30, "a%"]
+
+
+def test_percent_signs_in_column_names_are_escaped():
+    condition, params = compile_where({"50%": {"null": False}}, COLUMN_TYPES, "people")
+    assert condition == '"50%%" IS NOT NULL'
+    assert params == []
+
+
+def test_the_sql_depends_only_on_the_shape():
+    first = compile_where({"age": 1}, COLUMN_TYPES, "people")
+    second = compile_where({"age": 2}, COLUMN_TYPES, "people")
+    assert first[0] == second[0]
+
+
+@pytest.mark.parametrize(
+    "where, message",
+    [
+        ({}, "A filter must be a non-empty object"),
+        ({"height": 1}, "Table people has no column height"),
+        ({"age": {"between": [1, 2]}}, "Unknown filter operator: between"),
+        ({"age": {"in": 1}}, "in takes a list of values"),
+        ({"age": {"eq": None}}, "Use null to compare age with null"),
+        ({"age": {}}, "The filter on age has no operator"),
+        ({"or": []}, "or takes a non-empty list of filters"),
+    ],
+)
+def test_invalid_filters(where, message):
+    with pytest.raises(FilterError, match=message):
+        compile_where(where, COLUMN_TYPES, "people")
+
+
+def test_unknown_table():
+    with pytest.raises(FilterError, match="Table missing does not exist"):
+        compile_where({"age": 1}, {}, "missing")
@@ -0,0 +1,79 @@
+import pytest
+
+from app.pagination import (
+    PaginationError,
+    _after_nullable,
+    build_page,
+    decode_token,
+    encode_token,
+    keyset_query,
+    page_order,
+)
+
+
+def test_tokens_round_trip():
+    token = encode_token(["name", "id"], False, ["bolt", 3])
+    assert "=" not in token
+    assert decode_token(token, ["name", "id"], False) == ["bolt", 3]
+
+
+def test_tokens_of_another_order_are_rejected():
+    token = encode_token(["name", "id"], False, ["bolt", 3])
+    with pytest.raises(PaginationError, match="different order_by"):
+        decode_token(token, ["name", "id"], True)
+    with pytest.raises(PaginationError, match="different order_by"):
+        decode_token(token, ["id"], False)
+
+
+def test_malformed_tokens_are_rejected():
+    with pytest.raises(PaginationError, match="Invalid after token"):
+        decode_token("not a token", ["id"], False)
+
+
+def test_page_order_appends_the_primary_key():
+    assert page_order(["name"], ["id"], "items") == ["name", "id"]
+    assert page_order(["id", "name"], ["id"], "items") == ["id", "name"]
+    assert page_order([], ["id"], "items") == ["id"]
+    with pytest.raises(PaginationError, match="no primary key"):
+        page_order([], [], "items")
+
+
+def test_not_null_keys_use_a_row_comparison():
+    query, params = keyset_query(
+        "*", "items", None, ["name", "id"], False, 10,
+        encode_token(["name", "id"], False, ["bolt", 3]), not_null=("name", "id"),
+    )
+    assert '("name", "id") > (%s, %s)' in query
+    assert query.endswith('ORDER BY "name" ASC, "id" ASC LIMIT 11')
+    assert params == ["bolt", 3]
+
+
+def test_nullable_keys_ascending_sort_nulls_last():
+    condition, params = _after_nullable(['"name"', '"id"'], ["bolt", 3], False)
+    assert condition == (
+        '((("name" > %s OR "name" IS NULL)) OR ("name" = %s AND ("id" > %s OR "id" IS NULL)))'
+    )
+    assert params == ["bolt", "bolt", 3]
+
+
+def test_nullable_keys_after_a_null_ascending():
+    # Only rows with the same NULL and a later tie-breaker follow a NULL ascending.
+    condition, params = _after_nullable(['"name"', '"id"'], [None, 3], False)
+    assert condition == '(("name" IS NULL AND ("id" > %s OR "id" IS NULL)))'
+    assert params == [3]
+
+
+def test_nullable_keys_descending_sort_nulls_first():
+    condition, params = _after_nullable(['"name"', '"id"'], [None, 3], True)
+    assert condition == '(("name" IS NOT NULL) OR ("name" IS NULL AND "id" < %s))'
+    assert params == [3]
+
+
+def test_build_page_strips_the_key_aliases_and_sets_next():
+    columns = ["id", "name", "_oyda_key_0"]
+    rows = [(1, "a", 1), (2, "b", 2), (3, "c", 3)]
+    page = build_page(columns, rows, ["id"], False, 2)
+    assert page["columns"] == ["id", "name"]
+    assert page["rows"] == [(1, "a"), (2, "b")]
+    assert decode_token(page["next"], ["id"], False) == [2]
+    assert build_page(columns, rows, ["id"], False, 3)["next"] is None
@@ -0,0 +1,17 @@
+from app.parallel_scan import MIN_BLOCKS_PER_PART, block_ranges
+
+
+def test_small_tables_are_not_split():
+    assert block_ranges(MIN_BLOCKS_PER_PART * 2 - 1, 4) == ["true"]
+
+
+def test_ranges_cover_all_blocks_with_open_ends():
+    assert block_ranges(300, 3) == [
+        "ctid < '(100,0)'::tid",
+        "ctid >= '(100,0)'::tid AND ctid < '(200,0)'::tid",
+        "ctid >= '(200,0)'::tid",
+    ]
+
+
+def test_parts_are_limited_by_the_table_size():
+    assert len(block_ranges(MIN_BLOCKS_PER_PART * 3, 8)) == 3
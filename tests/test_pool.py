@@ -0,0 +1,50 @@
+import pytest
+
+from app.pool import ConnectionPool, PoolExhausted
+
+
+@pytest.fixture
+def pool():
+    pool = ConnectionPool(min_size=0, max_size=2, max_total=2, checkout_timeout=0.2)
+    yield pool
+    pool.close_all()
+
+
+def test_returned_connections_are_reused(pool, credentials):
+    conn = pool.getconn(*credentials)
+    pool.putconn(conn)
+    assert pool.stats()["idle"] == 1
+    assert pool.getconn(*credentials) is conn
+    pool.putconn(conn)
+    stats = pool.stats()
+    assert (stats["misses"], stats["hits"], stats["in_use"]) == (1, 1, 0)
+
+
+def test_open_transactions_are_rolled_back_on_return(pool, credentials):
+    with pool.connection(*credentials) as conn:
+        cursor = conn.cursor()
+        cursor.execute("CREATE TEMPORARY TABLE oyda_pool_test (id int)")
+    with pool.connection(*credentials) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT to_regclass('pg_temp.oyda_pool_test')")
+        assert cursor.fetchone()[0] is None
+
+
+def test_checkout_at_capacity(pool, credentials):
+    held = [pool.getconn(*credentials) for _ in range(2)]
+    try:
+        assert pool.getconn(*credentials, wait=False) is None
+        with pytest.raises(PoolExhausted):
+            pool.getconn(*credentials)
+        assert pool.stats()["timeouts"] == 1
+    finally:
+        for conn in held:
+            pool.putconn(conn)
+    assert pool.stats()["idle"] == 2
+
+
+def test_idle_connections_need_the_same_password(pool, credentials):
+    with pool.connection(*credentials):
+        pass
+    assert pool.authenticated(*credentials)
+    assert not pool.authenticated(*credentials[:4], credentials[4] + "x")
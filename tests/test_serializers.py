@@ -0,0 +1,81 @@
+import datetime
+import decimal
+import json
+import uuid
+
+import pytest
+from psycopg2.extras import NumericRange
+
+import app.serializers as serializers
+from app.serializers import FormatError, SERIALIZERS, encode, response_format
+
+ROW = (
+    decimal.Decimal("1.10"),
+    datetime.datetime(2024, 1, 2, 3, 4, 5),
+    uuid.UUID("12345678-1234-5678-1234-567812345678"),
+    b"\x00\x01",
+    datetime.timedelta(minutes=1),
+    NumericRange(1, 10),
+    None,
+)
+COLUMNS = ["price", "at", "u", "data", "wait", "span", "note"]
+EXPECTED = {
+    "price": "1.10",
+    "at": "2024-01-02T03:04:05",
+    "u": "12345678-1234-5678-1234-567812345678",
+    "data": "AAE=",
+    "wait": 60.0,
+    "span": {"lower": 1, "upper": 10, "bounds": "[)"},
+    "note": None,
+}
+
+
+@pytest.fixture(params=sorted(SERIALIZERS))
+def serializer(request):
+    return SERIALIZERS[request.param]()
+
+
+def test_rows_keep_the_column_order(serializer):
+    body = serializer.dumps_rows(COLUMNS, [ROW])
+    assert json.loads(body) == [EXPECTED]
+    assert list(json.loads(body)[0]) == COLUMNS
+
+
+def test_ndjson_has_one_line_per_row(serializer):
+    body = serializer.dumps_ndjson(COLUMNS, [ROW, ROW])
+    lines = body.split(b"\n")
+    assert lines[-1] == b""
+    assert [json.loads(line) for line in lines[:-1]] == [EXPECTED, EXPECTED]
+
+
+def test_rows_with_extra_members(monkeypatch):
+    monkeypatch.setattr(serializers, "serializer", SERIALIZERS["json"]())
+    body = encode("rows", ["id"], [(1,), (2,)], next="abc")
+    assert json.loads(body) == {"rows": [{"id": 1}, {"id": 2}], "next": "abc"}
+
+
+def test_columnar_sends_the_columns_once(monkeypatch):
+    monkeypatch.setattr(serializers, "serializer", SERIALIZERS["json"]())
+    assert json.loads(encode("columnar", ["id", "name"], [(1, "a"), (2, "b")])) == {
+        "columns": ["id", "name"],
+        "data": [[1, 2], ["a", "b"]],
+    }
+    assert json.loads(encode("columnar", ["id"], [])) == {"columns": ["id"], "data": [[]]}
+
+
+def test_response_format_negotiation(monkeypatch):
+    monkeypatch.setitem(serializers.FORMAT_PACKAGES, "msgpack", object())
+    assert response_format("columnar", None) == "columnar"
+    assert response_format(None, "application/x-msgpack, application/json;q=0.5") == "msgpack"
+    assert response_format(None, "application/vnd.msgpack") == "msgpack"
+    assert response_format(None, "text/html") == "rows"
+    assert response_format(None, "") == "rows"
+    with pytest.raises(FormatError, match="Unknown format: xml"):
+        response_format("xml", None)
+
+
+def test_unavailable_formats(monkeypatch):
+    monkeypatch.setitem(serializers.FORMAT_PACKAGES, "msgpack", None)
+    assert response_format(None, "application/x-msgpack") == "rows"
+    with pytest.raises(FormatError, match="not available"):
+        response_format("msgpack", None)
@@ -0,0 +1,17 @@
+from app.slow_queries import normalize_sql
+
+
+def test_literals_and_placeholders_are_replaced():
+    assert normalize_sql("SELECT * FROM t WHERE a = 'x''y' AND b > 4.5 AND c = %s") == (
+        "SELECT * FROM t WHERE a = ? AND b > ? AND c = ?"
+    )
+
+
+def test_quoted_identifiers_and_names_with_digits_are_kept():
+    assert normalize_sql('SELECT "col 1", t2.x FROM "t 3" t2 WHERE y = $1') == (
+        'SELECT "col 1", t2.x FROM "t 3" t2 WHERE y = ?'
+    )
+
+
+def test_whitespace_is_collapsed_and_bytes_are_decoded():
+    assert normalize_sql(b"SELECT\n  1,\t2") == "SELECT ?, ?"